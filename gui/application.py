@@ -84,6 +84,7 @@ from overlays import LastPaintPosOverlay
 from overlays import ScaleOverlay
 from buttonmap import ButtonMapping
 import lib.glib
+import lib.idletask
 import gui.cursor
 import lib.fileutils
 import gui.picker
@@ -91,6 +92,7 @@ import gui.factoryaction  # registration only
 import gui.autorecover
 import lib.xml
 import gui.profiling
+import gui.dialogs
 
 
 ## Utility methods
@@ -328,6 +330,8 @@ class Application (object):
             join(self.state_dirs.app_data, 'brushes'),
             join(self.state_dirs.user_data, 'brushes'),
             self,
+            stock_cache_file = join(self.state_dirs.user_data,
+                                    'stockbrushes.cache'),
         )
         signal_callback_objs.append(self.filehandler)
         self.brushmodifier = brushmodifier.BrushModifier(self)
@@ -387,6 +391,7 @@ class Application (object):
 
         # Profiling & debug stuff
         self.profiler = gui.profiling.Profiler()
+        self.latency_monitor = gui.profiling.LatencyMonitor()
 
         # Show main UI.
         self.drawWindow.show_all()
@@ -447,6 +452,7 @@ class Application (object):
         self._apply_pressure_mapping_settings()
         self._apply_button_mapping_settings()
         self._apply_autosave_settings()
+        self._apply_undo_settings()
         self.preferences_window.update_ui()
 
     def load_settings(self):
@@ -504,6 +510,8 @@ class Application (object):
 
             'document.autosave_backups': True,
             'document.autosave_interval': 10,
+            'document.undo_memory_limit': 512,  # MiB
+            'document.undo_min_steps': 10,
 
             'display.colorspace': "srgb",
             # sRGB is a good default even for OS X since v10.6 / Snow
@@ -630,6 +638,17 @@ class Application (object):
         model.autosave_backups = active
         model.autosave_interval = interval
 
+    def _apply_undo_settings(self):
+        limit = self.preferences["document.undo_memory_limit"]
+        min_steps = self.preferences["document.undo_min_steps"]
+        logger.debug(
+            "Applying undo settings: memory_limit=%rMiB, min_steps=%r",
+            limit, min_steps,
+        )
+        stack = self.doc.model.command_stack
+        stack.max_bytes = int(limit) * 1024 * 1024
+        stack.min_steps = int(min_steps)
+
     def save_gui_config(self):
         Gtk.AccelMap.save(join(self.user_confpath, 'accelmap.conf'))
         workspace = self.workspace
@@ -809,6 +828,54 @@ class Application (object):
         """Starts profiling, or stops it (and tries to show the results)"""
         self.profiler.toggle_profiling()
 
+    def record_latency_cb(self, action):
+        """Toggles collection of input-to-pixel latency statistics"""
+        self.latency_monitor.active = action.get_active()
+
+    def show_latency_stats_cb(self, action):
+        """Shows the current input-to-pixel latency statistics"""
+        monitor = self.latency_monitor
+        self.message_dialog(
+            _(u"Input-to-pixel latency (milliseconds)"),
+            title = _(u"Input Latency Statistics"),
+            secondary_text = _(
+                u"Latencies for the most recent freehand painting events, "
+                u"by processing stage."
+            ),
+            long_text = monitor.format_table(),
+        )
+
+    def save_latency_stats_cb(self, action):
+        """Saves the current input-to-pixel latency statistics as JSON"""
+        file_format, filename = gui.dialogs.save_dialog(
+            _(u"Save Input Latency Statistics"),
+            self.drawWindow,
+            [(_(u"JSON"), "*.json")],
+            default_format = (0, ".json"),
+        )
+        if not filename:
+            return
+        with open(filename, "wb") as fp:
+            fp.write(self.latency_monitor.to_json())
+        logger.info("Latency statistics written to %r", filename)
+
+    def reset_latency_stats_cb(self, action):
+        """Discards all collected input-to-pixel latency statistics"""
+        self.latency_monitor.reset()
+
+    def show_scheduler_stats_cb(self, action):
+        """Shows how background tasks fared against painting and redraws"""
+        scheduler = lib.idletask.get_scheduler()
+        self.message_dialog(
+            _(u"Background scheduler statistics"),
+            title = _(u"Background Scheduler Statistics"),
+            secondary_text = _(
+                u"Time spent per kind of work, and how often background "
+                u"tasks had to wait for a later frame."
+            ),
+            long_text = scheduler.format_stats(),
+        )
+
     def print_memory_leak_cb(self, action):
         helpers.record_memory_leak_status(print_diff=True)
 
@@ -30,8 +30,11 @@ from gi.repository import GdkPixbuf
 
 import dialogs
 from lib.brush import BrushInfo
+from lib.brush import BrushInfoCache
+from lib.brush import ParseError
 from lib.observable import event
 import lib.pixbuf
+import lib.idletask
 import drawutils
 
 import gui.mode
@@ -154,13 +157,27 @@ class BrushManager (object):
 
     ## Initialization
 
-    def __init__(self, stock_brushpath, user_brushpath, app):
-        """Initialize, with paths and a ref to the main app."""
+    def __init__(self, stock_brushpath, user_brushpath, app,
+                 stock_cache_file=None):
+        """Initialize, with paths and a ref to the main app.
+
+        :param unicode stock_brushpath: Read-only stock brushes.
+        :param unicode user_brushpath: The user's own brushes.
+        :param gui.application.Application app: The main app.
+        :param unicode stock_cache_file: Precompiled stock brush cache.
+
+        """
         super(BrushManager, self).__init__()
         self.stock_brushpath = stock_brushpath
         self.user_brushpath = user_brushpath
         self.app = app
 
+        #: Parsed brush settings, shared by all the ManagedBrushes,
+        #: so that reloading or switching brushes avoids reparsing.
+        self.brushinfo_cache = BrushInfoCache()
+        self._stock_cache_file = stock_cache_file
+        self._stock_cache_processor = lib.idletask.Processor()
+
         #: The selected brush, as a ManagedBrush. Its settings are
         #: automatically reflected into the working brush engine brush when
         #: it changes.
@@ -176,6 +193,7 @@ class BrushManager (object):
 
         if not os.path.isdir(self.user_brushpath):
             os.mkdir(self.user_brushpath)
+        self._init_stock_cache()
         self._init_groups()
 
         # Brush order saving when that changes.
@@ -188,6 +206,53 @@ class BrushManager (object):
         # preset.
         self.brush_selected += self._brush_selected_cb
 
+    def _init_stock_cache(self):
+        """Loads the precompiled stock brush cache, or starts building it.
+
+        The stock brushes are parsed once, in the background, and saved
+        to a single binary file. Later runs load that instead of reading
+        and parsing each stock brush file when it is first used.
+
+        """
+        if not self._stock_cache_file:
+            return
+        cache = self.brushinfo_cache
+        if os.path.isfile(self._stock_cache_file):
+            try:
+                cache.load(self._stock_cache_file)
+            except (IOError, ValueError) as e:
+                logger.warning("Ignoring stock brush cache: %s", e)
+        stock_bp = self.stock_brushpath
+        paths = [
+            os.path.join(stock_bp, name + '.myb')
+            for name in self._list_brushes(stock_bp)
+        ]
+        uncached = [p for p in paths if p not in cache]
+        if uncached:
+            logger.info("Precompiling %d stock brushes", len(uncached))
+            self._stock_cache_processor.add_work(
+                self._precompile_stock_brushes_task,
+                uncached,
+            )
+
+    def _precompile_stock_brushes_task(self, paths):
+        """Background task: parse one stock brush into the cache."""
+        if paths:
+            path = paths.pop()
+            try:
+                self.brushinfo_cache.load_into(BrushInfo(), path)
+            except (IOError, ParseError) as e:
+                logger.warning("%r: %s (not cached)", path, e)
+            return True
+        try:
+            self.brushinfo_cache.save(
+                self._stock_cache_file,
+                prefix=self.stock_brushpath,
+            )
+        except (IOError, OSError):
+            logger.exception("Failed to save the stock brush cache")
+        return False
+
     def _load_brush(self, brush_cache, name, **kwargs):
         """Load a ManagedBrush from disk by name, via a cache."""
         if name not in brush_cache:
@@ -1172,6 +1237,7 @@ class ManagedBrush(object):
         logger.debug("Saving brush settings to %r", settings_filename)
         with open(settings_filename, 'w') as settings_fp:
             settings_fp.write(brushinfo.save_to_string())
+        self.bm.brushinfo_cache.discard(settings_filename)
         # Record metadata
         self._remember_mtimes()
 
@@ -1231,17 +1297,22 @@ class ManagedBrush(object):
         self._remember_mtimes()
 
     def _load_settings(self):
-        """Loads the brush settings/dynamics from disk."""
+        """Loads the brush settings/dynamics, via the shared cache.
+
+        The file is only read and parsed if the brush manager's cache
+        holds nothing for it, or if it has changed on disk.
+
+        """
         prefix = self._get_fileprefix()
         filename = prefix + '.myb'
-        with open(filename) as fp:
-            brushinfo_str = fp.read()
         try:
-            self._brushinfo.load_from_string(brushinfo_str)
-        except BrushInfo.ParseError as e:
+            mtime = self.bm.brushinfo_cache.load_into(self._brushinfo,
+                                                      filename)
+        except ParseError as e:
             logger.warning('Failed to load brush %r: %s', filename, e)
             self._brushinfo.load_defaults()
-        self._remember_mtimes()
+            mtime = os.path.getmtime(filename)
+        self._settings_mtime = mtime
         self._settings_loaded = True
         if self.bm.is_in_brushlist(self):  # FIXME: get rid of this check
             self._brushinfo.set_string_property("parent_brush_name", None)
@@ -1249,8 +1320,10 @@ class ManagedBrush(object):
 
     def _has_changed_on_disk(self):
         prefix = self._get_fileprefix()
-        if self._preview_mtime != os.path.getmtime(prefix + '_prev.png'):
-            return True
+        if self._preview_mtime is not None:
+            preview_mtime = os.path.getmtime(prefix + '_prev.png')
+            if self._preview_mtime != preview_mtime:
+                return True
         if self._settings_mtime != os.path.getmtime(prefix + '.myb'):
             return True
         return False
@@ -1258,8 +1331,6 @@ class ManagedBrush(object):
     def reload_if_changed(self):
         if self._settings_mtime is None:
             return
-        if self._preview_mtime is None:
-            return
         if not self.name:
             return
         if not self._has_changed_on_disk():
@@ -1273,7 +1344,9 @@ class ManagedBrush(object):
         """Ensures the brush's settings are loaded, if persistent"""
         if self.persistent and not self._settings_loaded:
             logger.debug("Loading %r...", self)
-            self.load()
+            # The preview is loaded on demand by get_preview(),
+            # so selecting a brush by device or key doesn't decode it.
+            self._load_settings()
             assert self._settings_loaded
 
 
@@ -437,6 +437,7 @@ class Document (CanvasController):  # TODO: rename to "DocumentController"
             for event in events:
                 event += observer_method
             observer_method()
+        cmdstack.spill_started += self._undo_spill_started_cb
 
     def _init_context_actions(self):
         """Internal: initializes several brush shortcut-key actions"""
@@ -546,10 +547,12 @@ class Document (CanvasController):  # TODO: rename to "DocumentController"
         if len(stack.undo_stack) > 0:
             cmd = stack.undo_stack[-1]
             desc = _("Undo %s") % cmd.display_name
+            tooltip = self._get_command_tooltip(desc, cmd, stack)
         else:
             desc = _("Undo")  # Used when initializing the prefs dialog
+            tooltip = desc
         undo_action.set_label(desc)
-        undo_action.set_tooltip(desc)
+        undo_action.set_tooltip(tooltip)
 
         # Redo
         redo_action = ag.get_action("Redo")
@@ -558,10 +561,46 @@ class Document (CanvasController):  # TODO: rename to "DocumentController"
         if len(stack.redo_stack) > 0:
             cmd = stack.redo_stack[-1]
             desc = _("Redo %s") % cmd.display_name
+            tooltip = self._get_command_tooltip(desc, cmd, stack)
         else:
             desc = _("Redo")  # Used when initializing the prefs dialog
+            tooltip = desc
         redo_action.set_label(desc)
-        redo_action.set_tooltip(desc)
+        redo_action.set_tooltip(tooltip)
+
+    @staticmethod
+    def _get_command_tooltip(desc, cmd, stack):
+        """Describes an undo or redo step, with its memory use"""
+        # TRANSLATORS: Tooltip for Undo and Redo. {desc} is the action
+        # TRANSLATORS: name, {footprint} is the memory used by that
+        # TRANSLATORS: step, and {total} the memory used by all of them.
+        template = _(u"{desc}\nUses {footprint} (undo history: {total})")
+        return template.format(
+            desc = desc,
+            footprint = GLib.format_size(cmd.footprint),
+            total = GLib.format_size(stack.get_footprint()),
+        )
+
+    def _undo_spill_started_cb(self, stack, progress, reloading):
+        """Show progress of undo history moving to or from disk"""
+        if reloading:
+            msg = C_(
+                "Statusbar message: undo history progress",
+                u"Loading undo history from disk… {percent}%",
+            )
+        else:
+            msg = C_(
+                "Statusbar message: undo history progress",
+                u"Moving old undo history to disk… {percent}%",
+            )
+
+        def _progress_changed_cb(progress):
+            if progress.fraction is None:
+                return
+            percent = int(round(progress.fraction * 100))
+            self.app.show_transient_message(msg.format(percent=percent))
+
+        progress.changed += _progress_changed_cb
 
     ## Event handling
 
@@ -25,6 +25,7 @@ from gi.repository import GLib
 import numpy as np
 
 import gui.mode
+import lib.idletask
 from drawutils import spline_4p
 
 logger = logging.getLogger(__name__)
@@ -132,6 +133,11 @@ class FreehandMode (gui.mode.BrushworkModeMixin,
             # average times.
             self.avgtime = None
 
+            # Latency instrumentation: (event_time, origin, received)
+            # for each queued raw event, in order of receipt. Only
+            # filled while the app's latency monitor is active.
+            self.latency_stamps = deque()
+
             # Button pressed while drawing
             # Not every device sends button presses, but evdev ones
             # do, and this is used as a workaround for an evdev bug:
@@ -465,6 +471,11 @@ class FreehandMode (gui.mode.BrushworkModeMixin,
         x, y = tdw.display_to_model(x, y)
         event_data = (time, x, y, pressure, xtilt, ytilt, viewzoom, viewrotation)
         drawstate.queue_motion(event_data)
+        monitor = self._get_latency_monitor(tdw)
+        if monitor:
+            received = monitor.now()
+            origin = monitor.event_received(time, now=received)
+            drawstate.latency_stamps.append((time, origin, received))
         # Start the motion event processor, if it isn't already running
         if not drawstate.motion_processing_cbid:
             cbid = GLib.idle_add(
@@ -478,10 +489,18 @@ class FreehandMode (gui.mode.BrushworkModeMixin,
 
     def _motion_queue_idle_cb(self, tdw):
         """Idle callback; processes each queued event"""
+        # Input processing time is accounted so that background tasks
+        # scheduled in the same frame can be throttled accordingly.
+        with lib.idletask.get_scheduler().timed("input"):
+            return self._process_motion_queue(tdw)
+
+    def _process_motion_queue(self, tdw):
+        """Forwards queued motion events (see `_motion_queue_idle_cb()`)"""
         drawstate = self._get_drawing_state(tdw)
         # Stop if asked to stop
         if drawstate.motion_processing_cbid is None:
             drawstate.motion_queue = deque()
+            drawstate.latency_stamps.clear()
             return False
         # Forward one or more motion events to the canvas
         for event in drawstate.next_processing_events():
@@ -535,13 +554,57 @@ class FreehandMode (gui.mode.BrushworkModeMixin,
         pressure = clamp(pressure, 0.0, 1.0)
         xtilt = clamp(xtilt, -1.0, 1.0)
         ytilt = clamp(ytilt, -1.0, 1.0)
+        monitor = self._get_latency_monitor(tdw)
+        if monitor:
+            t0 = monitor.now()
         self.stroke_to(model, dtime, x, y, pressure, xtilt, ytilt, viewzoom, viewrotation)
+        if monitor:
+            self._record_latency(monitor, tdw, drawstate, time, t0)
 
         # Update the TDW's idea of where we last painted
         # FIXME: this should live in the model, not the view
         if pressure:
             tdw.set_last_painting_pos((x, y))
 
+    ## Latency instrumentation
+
+    @staticmethod
+    def _get_latency_monitor(tdw):
+        """The app's latency monitor, or None if it isn't collecting"""
+        if tdw.app is None:
+            return None
+        monitor = tdw.app.latency_monitor
+        if not monitor.active:
+            return None
+        return monitor
+
+    def _record_latency(self, monitor, tdw, drawstate, time, t0):
+        """Record queue and paint timings for the raw events up to time
+
+        :param gui.profiling.LatencyMonitor monitor: Target monitor
+        :param tdw: The TiledDrawWidget being painted on
+        :param drawstate: tdw's drawing state
+        :param time: Timestamp of the event just painted
+        :param float t0: Monitor time when painting of it began
+
+        Interpolation means that painted events don't map one-to-one
+        onto raw events, so every raw event stamped at or before the
+        painted one is treated as having been painted by it.
+
+        """
+        stamps = drawstate.latency_stamps
+        if not stamps or stamps[0][0] > time:
+            return
+        t1 = monitor.now()
+        monitor.record("paint", t1 - t0)
+        origin = None
+        while stamps and stamps[0][0] <= time:
+            event_time, event_origin, received = stamps.popleft()
+            monitor.record("queue", t0 - received)
+            if origin is None:
+                origin = event_origin
+        monitor.painted(tdw, origin, now=t1)
+
     ## Mode options
 
     def get_options_widget(self):
@@ -15,6 +15,12 @@ import time
 import tempfile
 import subprocess
 import shutil
+import math
+import json
+import bisect
+import weakref
+from collections import deque
+from collections import OrderedDict
 import logging
 logger = logging.getLogger(__name__)
 
@@ -138,3 +144,236 @@ class Profiler (object):
             logger.exception("Cleanup of %r failed", self.__temp_dir)
         else:
             self.__temp_dir = None
+
+
+## Input-to-pixel latency
+
+
+class RollingHistogram (object):
+    """Rolling window of timing samples, with percentiles and buckets.
+
+    Only the most recent samples are retained, so the statistics track
+    what the user is experiencing now rather than over the whole
+    session.
+
+    >>> h = RollingHistogram(window=100)
+    >>> for i in range(1, 201):
+    ...     h.add(float(i))
+    >>> len(h)
+    100
+    >>> h.percentile(50)
+    150.0
+    >>> h.percentile(99)
+    199.0
+    >>> h.percentile(100)
+    200.0
+    >>> s = h.get_summary()
+    >>> (s["count"], s["p50"], s["max"])
+    (100, 150.0, 200.0)
+    >>> sum(s["buckets"].values())
+    100
+    >>> RollingHistogram().percentile(95) is None
+    True
+
+    """
+
+    #: Upper bounds of the histogram buckets, in milliseconds.
+    BUCKET_BOUNDS = (1, 2, 4, 8, 16, 33, 50, 100, 200, 500, 1000)
+
+    def __init__(self, window=2000):
+        super(RollingHistogram, self).__init__()
+        self._samples = deque(maxlen=window)
+
+    def __len__(self):
+        return len(self._samples)
+
+    def add(self, ms):
+        """Adds a sample, discarding the oldest if the window is full."""
+        self._samples.append(float(ms))
+
+    def clear(self):
+        """Discards all samples."""
+        self._samples.clear()
+
+    def percentile(self, p):
+        """Returns the nearest-rank percentile, or None if empty.
+
+        :param float p: Percentile to return, in the range [0, 100].
+
+        """
+        if not self._samples:
+            return None
+        samples = sorted(self._samples)
+        rank = int(math.ceil((p / 100.0) * len(samples)))
+        rank = min(max(rank, 1), len(samples))
+        return samples[rank - 1]
+
+    def get_summary(self):
+        """Returns a JSON-serializable summary of the current window."""
+        buckets = OrderedDict()
+        for bound in self.BUCKET_BOUNDS:
+            buckets["<={}".format(bound)] = 0
+        buckets[">{}".format(self.BUCKET_BOUNDS[-1])] = 0
+        keys = list(buckets.keys())
+        for ms in self._samples:
+            i = bisect.bisect_left(self.BUCKET_BOUNDS, ms)
+            buckets[keys[i]] += 1
+        return OrderedDict([
+            ("count", len(self._samples)),
+            ("p50", self.percentile(50)),
+            ("p95", self.percentile(95)),
+            ("p99", self.percentile(99)),
+            ("max", max(self._samples) if self._samples else None),
+            ("buckets", buckets),
+        ])
+
+
+class LatencyMonitor (object):
+    """Per-stage input-to-pixel latency statistics for freehand painting.
+
+    Timestamps are carried from the GDK event time through to the
+    redraw of the canvas which shows its dabs. Each stage feeds a
+    `RollingHistogram`:
+
+    * ``delivery``: event timestamp to receipt by the motion handler.
+    * ``queue``: time spent waiting in the freehand motion queue.
+    * ``paint``: brush engine time, including ``end_atomic()``.
+    * ``expose_wait``: end of painting to the start of the redraw.
+    * ``redraw``: time spent inside the canvas draw handler.
+    * ``total``: event timestamp to the end of that redraw.
+
+    GDK event times do not necessarily share an epoch with the local
+    monotonic clock, so event delivery times are measured relative to
+    the fastest delivery seen so far. This makes ``delivery`` and
+    ``total`` lower bounds, which is fine for comparisons.
+
+    >>> m = LatencyMonitor()
+    >>> m.active = True
+    >>> origin = m.event_received(1000, now=5000.0)
+    >>> origin
+    5000.0
+    >>> m.event_received(1010, now=5014.0)
+    5010.0
+    >>> m.record("paint", 3.0)
+    >>> class View (object): pass
+    >>> key = View()
+    >>> m.painted(key, origin, now=5020.0)
+    >>> m.exposed(key, draw_start=5030.0, now=5035.0)
+    >>> stats = m.get_summary()
+    >>> stats["delivery"]["max"], stats["paint"]["count"]
+    (4.0, 1)
+    >>> stats["expose_wait"]["p50"], stats["redraw"]["p50"]
+    (10.0, 5.0)
+    >>> stats["total"]["p50"]
+    35.0
+    >>> import json
+    >>> json.loads(m.to_json())["total"]["count"]
+    1
+
+    """
+
+    STAGES = ("delivery", "queue", "paint", "expose_wait", "redraw", "total")
+
+    def __init__(self, window=2000):
+        super(LatencyMonitor, self).__init__()
+        #: Whether timings should be collected (see Help→Debug).
+        self.active = False
+        self._window = window
+        self._histograms = OrderedDict(
+            (stage, RollingHistogram(window=window))
+            for stage in self.STAGES
+        )
+        self._event_clock_offset = None
+        self._pending = weakref.WeakKeyDictionary()  # {key: (origin, t)}
+
+    @staticmethod
+    def now():
+        """Monotonic time in milliseconds, as a float."""
+        return GLib.get_monotonic_time() / 1000.0
+
+    def reset(self):
+        """Discards all collected statistics."""
+        for hist in self._histograms.values():
+            hist.clear()
+        self._event_clock_offset = None
+        self._pending.clear()
+
+    def record(self, stage, ms):
+        """Adds a sample for a named stage."""
+        self._histograms[stage].add(ms)
+
+    def event_received(self, event_time, now=None):
+        """Records delivery of an input event.
+
+        :param int event_time: the GDK event's timestamp (ms)
+        :param float now: override for the current time (ms)
+        :returns: the event's estimated origin time on the local clock
+        :rtype: float
+
+        """
+        if now is None:
+            now = self.now()
+        offset = now - event_time
+        best_offset = self._event_clock_offset
+        if best_offset is None or offset < best_offset:
+            self._event_clock_offset = offset
+        origin = event_time + self._event_clock_offset
+        self.record("delivery", now - origin)
+        return origin
+
+    def painted(self, key, origin, now=None):
+        """Records that an event's dabs are now awaiting a redraw.
+
+        :param key: the view which will show the dabs (weakref-able)
+        :param float origin: origin time from `event_received()`
+        :param float now: override for the current time (ms)
+
+        Only the oldest unexposed event for each view is remembered.
+
+        """
+        if now is None:
+            now = self.now()
+        if key not in self._pending:
+            self._pending[key] = (origin, now)
+
+    def exposed(self, key, draw_start, now=None):
+        """Records the end of a redraw of a view.
+
+        :param key: the view which was redrawn
+        :param float draw_start: time the draw handler was entered (ms)
+        :param float now: override for the current time (ms)
+
+        """
+        if now is None:
+            now = self.now()
+        pending = self._pending.pop(key, None)
+        if pending is None:
+            return
+        origin, painted = pending
+        self.record("expose_wait", max(0.0, draw_start - painted))
+        self.record("redraw", now - draw_start)
+        self.record("total", now - origin)
+
+    def get_summary(self):
+        """Returns JSON-serializable summaries of every stage."""
+        return OrderedDict(
+            (stage, hist.get_summary())
+            for stage, hist in self._histograms.items()
+        )
+
+    def to_json(self):
+        """Returns the summary of every stage as a JSON string."""
+        return json.dumps(self.get_summary(), indent=2)
+
+    def format_table(self):
+        """Returns a plain text table of the per-stage percentiles."""
+        lines = ["{:<12} {:>6} {:>8} {:>8} {:>8} {:>8}".format(
+            "stage", "n", "p50", "p95", "p99", "max",
+        )]
+        fmt = lambda v: ("-" if v is None else "{:.1f}".format(v))
+        for stage, s in self.get_summary().items():
+            lines.append("{:<12} {:>6} {:>8} {:>8} {:>8} {:>8}".format(
+                stage, s["count"],
+                fmt(s["p50"]), fmt(s["p95"]), fmt(s["p99"]), fmt(s["max"]),
+            ))
+        return "\n".join(lines)
@@ -17,6 +17,7 @@ import math
 import weakref
 import contextlib
 import logging
+from collections import defaultdict
 
 from gi.repository import Gtk
 from gi.repository import Gdk
@@ -27,6 +28,7 @@ import numpy as np
 from lib import helpers, tiledsurface, pixbufsurface
 from lib.observable import event
 import lib.layer
+import lib.idletask
 import cursor
 from drawutils import render_checks
 import gui.style
@@ -207,7 +209,7 @@ class TiledDrawWidget (Gtk.EventBox):
     def set_model(self, model):
         assert self.doc is None
         renderer = self.renderer
-        model.canvas_area_modified += renderer.canvas_modified_cb
+        DirtyTileTracker.get_for_model(model).add_renderer(renderer)
         root = model.layer_stack
         root.current_path_updated += renderer.current_layer_changed_cb
         root.layer_properties_changed += renderer.layer_props_changed_cb
@@ -545,6 +547,162 @@ class CanvasTransformation (object):
         )
 
 
+class DirtyTileTracker (object):
+    """Per-frame dirty tile set, shared by all views of a model.
+
+    Painting reports many small, overlapping redraw rectangles via
+    `lib.document.Document.canvas_area_modified()`, one for each
+    `end_atomic()`. Rather than having every view transform and queue
+    each one of those separately, they are accumulated here as a set of
+    dirty tile indices. The set is flushed once per frame clock tick to
+    every registered renderer, as a minimal list of tile-aligned
+    rectangles.
+
+    Use `get_for_model()` to access the tracker for a document model.
+
+    """
+
+    #: Updates bigger than this many tiles are kept as plain rectangles
+    MAX_RECT_TILES = 1024
+
+    _INSTANCES = weakref.WeakKeyDictionary()  # {model: tracker}
+
+    @classmethod
+    def get_for_model(cls, model):
+        """Returns the shared tracker for a model, creating it if needed."""
+        tracker = cls._INSTANCES.get(model)
+        if tracker is None:
+            tracker = cls(model)
+            cls._INSTANCES[model] = tracker
+        return tracker
+
+    def __init__(self, model):
+        """Initialize, observing a model's redraw notifications."""
+        super(DirtyTileTracker, self).__init__()
+        self._tiles = set()
+        self._rects = []
+        self._full = False
+        self._renderers = weakref.WeakSet()
+        self._tick_ids = weakref.WeakKeyDictionary()  # {renderer: id}
+        model.canvas_area_modified += self._canvas_area_modified_cb
+
+    def add_renderer(self, renderer):
+        """Registers a CanvasRenderer to be told about flushed updates."""
+        self._renderers.add(renderer)
+
+    def _canvas_area_modified_cb(self, model, x, y, w, h):
+        """Accumulates a model redraw notification."""
+        if w == 0 and h == 0:
+            self._full = True
+            self._tiles.clear()
+            self._rects = []
+        elif not self._full:
+            N = tiledsurface.N
+            tx0 = int(x // N)
+            ty0 = int(y // N)
+            tx1 = int((x + w - 1) // N)
+            ty1 = int((y + h - 1) // N)
+            ntiles = (tx1 - tx0 + 1) * (ty1 - ty0 + 1)
+            if ntiles > self.MAX_RECT_TILES:
+                self._rects.append((x, y, w, h))
+            else:
+                self._tiles.update(
+                    (tx, ty)
+                    for ty in xrange(ty0, ty1 + 1)
+                    for tx in xrange(tx0, tx1 + 1)
+                )
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        """Ensures that a flush will happen on the next frame."""
+        scheduled = False
+        for renderer in list(self._renderers):
+            if not renderer.get_mapped():
+                continue
+            scheduled = True
+            if renderer in self._tick_ids:
+                continue
+            tick_id = renderer.add_tick_callback(self._tick_cb)
+            self._tick_ids[renderer] = tick_id
+        # Unmapped views are redrawn in full when they next get mapped.
+        if not scheduled:
+            self._discard()
+
+    def _tick_cb(self, renderer, frame_clock):
+        """Frame clock tick callback: flush, then stop ticking."""
+        self._tick_ids.pop(renderer, None)
+        self.flush()
+        return False
+
+    def _discard(self):
+        self._tiles.clear()
+        self._rects = []
+        self._full = False
+
+    def flush(self):
+        """Sends all accumulated updates to the registered renderers."""
+        if self._full:
+            rects = None
+        elif self._tiles or self._rects:
+            rects = _tiles_to_model_rects(self._tiles) + self._rects
+        else:
+            return
+        self._discard()
+        for renderer in list(self._renderers):
+            renderer.canvas_rects_modified(rects)
+
+
+def _tiles_to_model_rects(tiles, n=tiledsurface.N):
+    """Merges a set of tile indices into covering model rectangles.
+
+    :param tiles: Tile indices, as (tx, ty)
+    :param int n: Tile size, in model pixels
+    :returns: List of rectangles, as (x, y, w, h) in model pixels
+    :rtype: list
+
+    Horizontal runs of tiles become single rectangles, and identical
+    runs on consecutive rows are then merged.
+
+    >>> tiles = {(0, 0), (1, 0), (0, 1), (1, 1), (5, 1), (5, 3)}
+    >>> _tiles_to_model_rects(tiles, n=10)
+    [(0, 0, 20, 20), (50, 10, 10, 10), (50, 30, 10, 10)]
+    >>> _tiles_to_model_rects(set())
+    []
+
+    """
+    rows = defaultdict(list)
+    for tx, ty in tiles:
+        rows[ty].append(tx)
+    open_runs = {}  # {(tx0, tx1): [ty0, ty1]}
+    closed = []
+    for ty in sorted(rows):
+        txs = sorted(rows[ty])
+        runs = []
+        tx0 = tx1 = txs[0]
+        for tx in txs[1:]:
+            if tx == tx1 + 1:
+                tx1 = tx
+            else:
+                runs.append((tx0, tx1))
+                tx0 = tx1 = tx
+        runs.append((tx0, tx1))
+        for run in runs:
+            span = open_runs.get(run)
+            if span is not None and span[1] == ty - 1:
+                span[1] = ty
+                continue
+            if span is not None:
+                closed.append((run, span))
+            open_runs[run] = [ty, ty]
+    closed.extend(open_runs.items())
+    rects = [
+        (tx0 * n, ty0 * n, (tx1 - tx0 + 1) * n, (ty1 - ty0 + 1) * n)
+        for ((tx0, tx1), (ty0, ty1)) in closed
+    ]
+    rects.sort(key=lambda r: (r[1], r[0]))
+    return rects
+
+
 class DrawCursorMixin(object):
     """Mixin for renderer widgets needing a managed drawing cursor.
 
@@ -856,25 +1014,44 @@ class CanvasRenderer (Gtk.DrawingArea, DrawCursorMixin):
     ## Redrawing
 
     def canvas_modified_cb(self, model, x, y, w, h):
-        """Handles area redraw notifications from the underlying model"""
+        """Handles area redraw notifications from the underlying model
+
+        Views normally receive their updates in coalesced form, once per
+        frame, via `canvas_rects_modified()`. See `DirtyTileTracker`.
 
+        """
+        if w == 0 and h == 0:
+            # Full redraw (used when background has changed).
+            self.canvas_rects_modified(None)
+        else:
+            self.canvas_rects_modified([(x, y, w, h)])
+
+    def canvas_rects_modified(self, rects):
+        """Queues redraws for a list of model rectangles
+
+        :param list rects: Model rectangles (x, y, w, h), or None.
+
+        Passing None queues a redraw of the entire view.
+
+        """
         if self._insensitive_state_content:
             return False
 
         if not self.get_window():
             return
 
-        if w == 0 and h == 0:
+        if rects is None:
             # Full redraw (used when background has changed).
             # logger.debug('Full redraw')
             self.queue_draw()
             return
 
-        # Create an expose event with the event bbox rotated/zoomed.
-        corners = [(x, y), (x + w, y), (x, y + h), (x + w, y + h)]
-        corners = [self.model_to_display(x, y) for (x, y) in corners]
-        bbox = helpers.rotated_rectangle_bbox(corners)
-        self.queue_draw_area(*bbox)
+        # Create expose events with the bboxes rotated/zoomed.
+        for (x, y, w, h) in rects:
+            corners = [(x, y), (x + w, y), (x, y + h), (x + w, y + h)]
+            corners = [self.model_to_display(x, y) for (x, y) in corners]
+            bbox = helpers.rotated_rectangle_bbox(corners)
+            self.queue_draw_area(*bbox)
 
     def queue_draw(self):
         if self._idle_redraw_priority is None:
@@ -1084,6 +1261,25 @@ class CanvasRenderer (Gtk.DrawingArea, DrawCursorMixin):
 
     def _draw_cb(self, widget, cr):
         """Draw handler"""
+        # Tell the background scheduler about each new frame, and how
+        # long its visible redraws took.
+        scheduler = lib.idletask.get_scheduler()
+        frame_clock = self.get_frame_clock()
+        if frame_clock is not None:
+            scheduler.begin_frame(key=(
+                frame_clock.get_frame_counter(),
+                frame_clock.get_frame_time(),
+            ))
+        with scheduler.timed("redraw"):
+            return self._draw(cr)
+
+    def _draw(self, cr):
+        """Render the document and overlays (see `_draw_cb()`)"""
+
+        monitor = None
+        if self.app is not None and self.app.latency_monitor.active:
+            monitor = self.app.latency_monitor
+            draw_start = monitor.now()
 
         # Don't render any partial views of the document if the widget
         # isn't sensitive to user input. If we don't do this, loading a
@@ -1156,6 +1352,9 @@ class CanvasRenderer (Gtk.DrawingArea, DrawCursorMixin):
             overlay.paint(cr)
             cr.restore()
 
+        if monitor:
+            monitor.exposed(self._tdw, draw_start)
+
         return True
 
     def _render_get_clip_region(self, cr, device_bbox):
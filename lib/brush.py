@@ -11,10 +11,14 @@ from __future__ import division, print_function
 import mypaintlib
 import helpers
 
+import os
 import urllib
 import copy
 import math
 import json
+import marshal
+
+import numpy as np
 
 from lib import brushsettings
 
@@ -33,6 +37,8 @@ OLDFORMAT_BRUSHFILE_VERSION = 2
 BRUSH_SETTINGS = set([s.cname for s in brushsettings.settings])
 ALL_SETTINGS = BRUSH_SETTINGS.union(STRING_VALUE_SETTINGS)
 
+_INPUTS_BY_INDEX = sorted(brushsettings.inputs, key=lambda i: i.index)
+
 _BRUSHINFO_MATCH_IGNORES = [
     "color_h", "color_s", "color_v",
     "parent_brush_name",
@@ -204,7 +210,13 @@ class BrushInfo (object):
         return res
 
     def load_from_brushinfo(self, other):
-        """Updates the brush's Settings from (a clone of) ``brushinfo``."""
+        """Updates the brush's Settings from (a clone of) ``brushinfo``.
+
+        Observers are notified about all settings. Brush engine
+        instances compare against the values they last uploaded, so
+        only the settings which really changed are sent to the engine.
+
+        """
         self.settings = copy.deepcopy(other.settings)
         for f in self.observers:
             f(ALL_SETTINGS)
@@ -521,6 +533,145 @@ class BrushInfo (object):
         return s1 == s2
 
 
+class BrushInfoCache (object):
+    """Cache of parsed brush definitions, keyed by path and mtime.
+
+    Parsing a brush file, especially one in the old format, costs far
+    more than copying the settings of an already parsed brush. This
+    cache remembers the parsed settings of each file it reads, together
+    with the file's mtime and size, so that reloading an unchanged file
+    costs only a stat() and a copy. Entries can be saved to and loaded
+    from a compact binary file, which lets the stock brushes be loaded
+    without opening or parsing their individual files.
+
+    >>> import tempfile, shutil, os
+    >>> tmpdir = tempfile.mkdtemp()
+    >>> path = os.path.join(tmpdir, "test.myb")
+    >>> b1 = BrushInfo()
+    >>> b1.set_base_value("radius_logarithmic", 4.2)
+    >>> with open(path, "w") as fp:
+    ...     fp.write(b1.save_to_string())
+    >>> cache = BrushInfoCache()
+    >>> b2 = BrushInfo()
+    >>> cache.load_into(b2, path) == os.path.getmtime(path)
+    True
+    >>> b2.get_base_value("radius_logarithmic")
+    4.2
+    >>> path in cache
+    True
+
+    The cache survives being saved and reloaded:
+
+    >>> cache_file = os.path.join(tmpdir, "brushes.cache")
+    >>> cache.save(cache_file)
+    >>> cache2 = BrushInfoCache()
+    >>> cache2.load(cache_file)
+    >>> b3 = BrushInfo()
+    >>> _ = cache2.load_into(b3, path)
+    >>> b3.settings == b2.settings
+    True
+
+    Entries for files which have changed are discarded:
+
+    >>> b1.set_base_value("radius_logarithmic", 1.5)
+    >>> with open(path, "w") as fp:
+    ...     fp.write(b1.save_to_string())
+    >>> os.utime(path, (0, 0))
+    >>> _ = cache2.load_into(b3, path)
+    >>> b3.get_base_value("radius_logarithmic")
+    1.5
+    >>> shutil.rmtree(tmpdir)
+
+    """
+
+    #: Version of the binary file format written by save()
+    FILE_FORMAT_VERSION = 1
+
+    def __init__(self):
+        super(BrushInfoCache, self).__init__()
+        self._entries = {}  # {path: (mtime, size, settings)}
+
+    def __contains__(self, path):
+        return path in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def load_into(self, brushinfo, path):
+        """Loads a brush file's settings into a BrushInfo, via the cache.
+
+        :param BrushInfo brushinfo: Target for the loaded settings.
+        :param unicode path: The brush file to load.
+        :returns: The modification time of the file.
+        :raises IOError: if the file cannot be read.
+        :raises ParseError: if the file cannot be parsed.
+
+        The file is only opened and parsed if it is not in the cache,
+        or if it has changed on disk since it was cached. Observers of
+        `brushinfo` are told about all the settings, as for
+        `BrushInfo.load_from_brushinfo()`.
+
+        """
+        try:
+            st = os.stat(path)
+        except OSError as e:
+            raise IOError(e.errno, e.strerror, path)
+        entry = self._entries.get(path)
+        if entry is None or entry[:2] != (st.st_mtime, st.st_size):
+            with open(path) as fp:
+                settings_str = fp.read()
+            parsed = BrushInfo()
+            parsed.load_from_string(settings_str)
+            entry = (st.st_mtime, st.st_size, parsed.settings)
+            self._entries[path] = entry
+        cached = BrushInfo()
+        cached.settings = entry[2]
+        brushinfo.load_from_brushinfo(cached)
+        return st.st_mtime
+
+    def discard(self, path):
+        """Forgets any cached settings for a brush file."""
+        self._entries.pop(path, None)
+
+    def save(self, filename, prefix=None):
+        """Saves the cache's entries to a binary file.
+
+        :param unicode filename: The file to write.
+        :param unicode prefix: Only save entries with paths under this.
+
+        """
+        entries = dict(
+            (path, entry) for (path, entry) in self._entries.iteritems()
+            if prefix is None or path.startswith(prefix)
+        )
+        tmp_filename = filename + ".tmp"
+        with open(tmp_filename, "wb") as fp:
+            marshal.dump((self.FILE_FORMAT_VERSION, entries), fp)
+        os.rename(tmp_filename, filename)
+
+    def load(self, filename):
+        """Adds the entries saved in a binary file to the cache.
+
+        :param unicode filename: A file written by save().
+        :raises IOError: if the file cannot be read.
+        :raises ValueError: if the file is not a valid cache file.
+
+        Entries are not checked against their brush files until they
+        are first used.
+
+        """
+        with open(filename, "rb") as fp:
+            try:
+                version, entries = marshal.load(fp)
+            except (EOFError, TypeError):
+                raise ValueError("%r: not a brush cache file" % (filename,))
+        if version != self.FILE_FORMAT_VERSION or not isinstance(entries,
+                                                                 dict):
+            raise ValueError("%r: unsupported brush cache format %r"
+                             % (filename, version))
+        self._entries.update(entries)
+
+
 class Brush (mypaintlib.PythonBrush):
     """A brush, capable of painting to a surface
 
@@ -532,27 +683,64 @@ class Brush (mypaintlib.PythonBrush):
     def __init__(self, brushinfo):
         super(Brush, self).__init__()
         self.brushinfo = brushinfo
+        self._engine_values = {}  # {cname: (base, mappings)}, as uploaded
         brushinfo.observers.append(self._update_from_brushinfo)
         self._update_from_brushinfo(ALL_SETTINGS)
 
     def _update_from_brushinfo(self, settings):
-        """Updates changed low-level settings from the BrushInfo"""
-        for cname in settings:
-            self._update_setting_from_brushinfo(cname)
+        """Updates changed low-level settings from the BrushInfo
 
-    def _update_setting_from_brushinfo(self, cname):
-        setting = brushsettings.settings_dict.get(cname)
-        if not setting:
+        The values of the named settings are compared with those last
+        uploaded to the brush engine. Only the ones which differ are
+        uploaded, and all of those are sent in a single native call.
+
+        """
+        ids = []
+        base_values = []
+        counts = []
+        points = []
+        for cname in settings:
+            setting = brushsettings.settings_dict.get(cname)
+            if not setting:
+                continue
+            value = self._get_engine_value(cname)
+            if self._engine_values.get(cname) == value:
+                continue
+            self._engine_values[cname] = value
+            base, mappings = value
+            ids.append(setting.index)
+            base_values.append(base)
+            for input_points in mappings:
+                assert len(input_points) != 1
+                counts.append(len(input_points))
+                for x, y in input_points:
+                    points.append(x)
+                    points.append(y)
+        if not ids:
             return
-        base = self.brushinfo.get_base_value(cname)
-        self.set_base_value(setting.index, base)
-        for input in brushsettings.inputs:
-            points = self.brushinfo.get_points(cname, input.name,
-                                               readonly=True)
-            assert len(points) != 1
-            self.set_mapping_n(setting.index, input.index, len(points))
-            for i, (x, y) in enumerate(points):
-                self.set_mapping_point(setting.index, input.index, i, x, y)
+        self.set_settings_from_arrays(
+            np.array(ids, dtype='int32'),
+            np.array(base_values, dtype='float32'),
+            np.array(counts, dtype='int32'),
+            np.array(points, dtype='float32'),
+        )
+
+    def _get_engine_value(self, cname):
+        """Returns a setting's value, in hashable brush engine form.
+
+        :returns: (base_value, mappings), where mappings holds a tuple
+            of (x, y) points for each input, in input index order.
+
+        """
+        brushinfo = self.brushinfo
+        mappings = tuple(
+            tuple(
+                (x, y) for (x, y)
+                in brushinfo.get_points(cname, i.name, readonly=True)
+            )
+            for i in _INPUTS_BY_INDEX
+        )
+        return (brushinfo.get_base_value(cname), mappings)
 
 
 if __name__ == "__main__":
@@ -11,6 +11,7 @@
 from __future__ import division, print_function
 
 import lib.layer
+import lib.tiledsurface
 import helpers
 from observable import event
 import lib.stroke
@@ -27,14 +28,58 @@ logger = getLogger(__name__)
 
 
 class CommandStack (object):
-    """Undo/redo stack"""
+    """Undo/redo stack
 
-    MAXLEN = 30   # FIXME: dynamic size (psutil)?
+    The undo history is limited by the memory it uses, not by its
+    length. Each command's footprint is the size of the tile data which
+    only it keeps alive: tiles not shared with the live document or
+    with any other command. The oldest commands are dropped when the
+    total footprint goes over `max_bytes`, but at least `min_steps`
+    undoable steps are always kept, and never more than `max_steps`.
 
-    def __init__(self, **kwargs):
+    Footprints are worked out once, when each command is performed,
+    from the tiles written since the command's snapshots were taken.
+    The stack keeps a running total, so the cost of each new command
+    doesn't depend on the length of the history.
+
+    If a `spill` file is set, the tiles of undo steps older than the
+    most recent `resident_steps` are moved out of memory into it, and
+    don't count towards the budget. They're loaded back in the
+    background as undo gets near them.
+
+    """
+
+    #: Default memory budget for the undo history, in bytes.
+    MAX_BYTES = 512 * 1024 * 1024
+
+    #: Default number of undo steps kept regardless of their footprint.
+    MIN_STEPS = 10
+
+    #: Default hard limit on the number of undo steps.
+    MAX_STEPS = 500
+
+    #: Default number of recent undo steps never spilled to disk.
+    RESIDENT_STEPS = 20
+
+    def __init__(self, max_bytes=MAX_BYTES, min_steps=MIN_STEPS,
+                 max_steps=MAX_STEPS, resident_steps=RESIDENT_STEPS,
+                 **kwargs):
         super(CommandStack, self).__init__()
         self.undo_stack = []
         self.redo_stack = []
+        #: Memory budget for the undo history, in bytes.
+        self.max_bytes = max_bytes
+        #: Number of undo steps to keep whatever their footprint.
+        self.min_steps = min_steps
+        #: Maximum number of undo steps to keep.
+        self.max_steps = max_steps
+        #: Number of recent undo steps whose tiles stay in memory.
+        self.resident_steps = resident_steps
+        #: Where to move older tiles (lib.tilespill.TileSpillFile).
+        self.spill = None
+        self._owned_tiles = {}  # {command: [tile]}
+        self._spilled_tiles = {}  # {command: [tile]}
+        self._total_footprint = 0
         self.stack_updated()
 
     def __repr__(self):
@@ -44,14 +89,28 @@ class CommandStack (object):
     def clear(self):
         self._discard_undo()
         self._discard_redo()
+        self._owned_tiles = {}
+        self._spilled_tiles = {}
+        self._total_footprint = 0
+        if self.spill is not None:
+            self.spill.reset()
         self.stack_updated()
 
     def _discard_undo(self):
+        self._forget_commands(self.undo_stack)
         self.undo_stack = []
 
     def _discard_redo(self):
+        self._forget_commands(self.redo_stack)
         self.redo_stack = []
 
+    def _forget_commands(self, commands):
+        """Drops the stack's records of commands being discarded"""
+        for cmd in commands:
+            self._total_footprint -= cmd.footprint
+            self._owned_tiles.pop(cmd, None)
+            self._spilled_tiles.pop(cmd, None)
+
     def do(self, command):
         """Performs a new command
 
@@ -64,6 +123,7 @@ class CommandStack (object):
         self._discard_redo()
         command.redo()
         self.undo_stack.append(command)
+        self._update_footprint(command)
         self.reduce_undo_history()
         self.stack_updated()
 
@@ -76,6 +136,8 @@ class CommandStack (object):
         if not self.undo_stack:
             return
         command = self.undo_stack.pop()
+        if self.spill is not None:
+            self._load_spilled(command)
         command.undo()
         self.redo_stack.append(command)
         self.stack_updated()
@@ -97,16 +159,109 @@ class CommandStack (object):
         return command
 
     def reduce_undo_history(self):
-        """Trims the undo stack"""
+        """Trims the undo stack to the memory budget"""
+        if self.spill is not None:
+            self._spill_old_commands()
         stack = self.undo_stack
-        self.undo_stack = []
-        steps = 0
-        for item in reversed(stack):
-            self.undo_stack.insert(0, item)
-            if not item.automatic_undo:
-                steps += 1
-            if steps == self.MAXLEN:  # and memory > ...
-                break
+        steps = sum(1 for cmd in stack if not cmd.automatic_undo)
+        nbytes = self._total_footprint
+        nbytes -= sum(cmd.footprint for cmd in self.redo_stack)
+        cut = 0
+        for i, cmd in enumerate(stack):
+            if not cmd.automatic_undo:
+                too_many = (steps > self.max_steps)
+                over_budget = (nbytes > self.max_bytes)
+                if not (too_many or (over_budget and
+                                     steps > self.min_steps)):
+                    break
+                steps -= 1
+                cut = i + 1
+            nbytes -= cmd.footprint
+        if cut == 0:
+            return
+        self._forget_commands(stack[:cut])
+        self.undo_stack = stack[cut:]
+        logger.debug(
+            "Undo history trimmed to %d commands (%d bytes)",
+            len(self.undo_stack), nbytes,
+        )
+        if self.spill is not None:
+            self.spill.reset()
+
+    def _spill_old_commands(self):
+        """Starts moving the tiles of older undo steps to disk"""
+        n = len(self.undo_stack) - self.resident_steps
+        old = [
+            cmd for cmd in self.undo_stack[:max(0, n)]
+            if cmd.footprint > 0 and cmd not in self._spilled_tiles
+        ]
+        tiles = []
+        for cmd in old:
+            tiles.extend(self._owned_tiles.get(cmd, ()))
+        progress = self.spill.spill(tiles)
+        for cmd in old:
+            owned = self._owned_tiles.get(cmd, [])
+            self._set_footprint(cmd, _count_resident_bytes(owned))
+            self._spilled_tiles[cmd] = owned
+        if progress is not None:
+            self.spill_started(progress, False)
+
+    def _load_spilled(self, command):
+        """Reloads a command's spilled tiles, and prefetches the next's
+
+        Normally the background prefetch has done this before the user
+        undoes this far, but if it hasn't, the tiles are loaded now.
+
+        """
+        tiles = self._spilled_tiles.pop(command, ())
+        self.spill.load(tiles)
+        if tiles:
+            self._set_footprint(command, _count_resident_bytes(tiles))
+        n = max(1, self.resident_steps)
+        if len(self.undo_stack) < n:
+            return
+        cmd = self.undo_stack[-n]
+        tiles = self._spilled_tiles.pop(cmd, None)
+        if not tiles:
+            return
+        progress = self.spill.prefetch(tiles)
+        # The tiles will be back in memory soon
+        self._set_footprint(cmd, len(tiles) * _TILE_BYTES)
+        if progress is not None:
+            self.spill_started(progress, True)
+
+    def _update_footprint(self, command):
+        """Works out the memory footprint of a command just performed
+
+        Tiles held by the command's snapshots are counted if they have
+        been overwritten in the document since the snapshot was taken.
+        Later commands take their own snapshots before they write, so
+        the tiles they overwrite are counted against them instead.
+        Tiles of layers no longer in the document are counted in full.
+        Spilled tiles are counted as using no memory.
+
+        """
+        sshots, surfaces = command.get_tile_holders()
+        tiles = []
+        for sshot in sshots:
+            changes = sshot.tilemap.get_changes_since(sshot)
+            tiles.extend(t for t in changes.itervalues() if t is not None)
+        for surf in surfaces:
+            # Nothing may write to these in place if they're spilled
+            surf.tiledict.share_all()
+            tiles.extend(surf.tiledict.itervalues())
+        owned = _claim_tiles(tiles, set())
+        self._owned_tiles[command] = owned
+        self._set_footprint(command, _count_resident_bytes(owned))
+
+    def _set_footprint(self, command, nbytes):
+        """Updates a command's footprint, and the running total"""
+        self._total_footprint += nbytes - command.footprint
+        command.footprint = nbytes
+
+    def get_footprint(self):
+        """Returns the total footprint of the undo and redo stacks"""
+        return self._total_footprint
 
     def get_last_command(self):
         """Returns the most recently performed command"""
@@ -120,6 +275,7 @@ class CommandStack (object):
         if cmd is None:
             return None
         cmd.update(**kwargs)
+        self._update_footprint(cmd)
         self.stack_updated()  # the display_name may have changed
         return cmd
 
@@ -128,6 +284,83 @@ class CommandStack (object):
         """Event: command stack was updated"""
         pass
 
+    @event
+    def spill_started(self, progress, reloading):
+        """Event: tiles started moving to or from the spill file
+
+        :param lib.feedback.Progress progress: Progress of the transfer.
+        :param bool reloading: True if the tiles are being reloaded.
+
+        """
+        pass
+
+
+def _find_tile_holders(objs):
+    """Finds surface snapshots and detached surfaces among objects
+
+    :param iterable objs: Objects to search, e.g. command attributes.
+    :returns: (surface_snapshots, detached_surfaces)
+
+    Containers, layer snapshots, and layers not in the document are
+    searched recursively. Layers in the document are skipped because
+    their tiles are not undo data.
+
+    """
+    sshots = []
+    surfaces = []
+    seen = set()
+    pending = list(objs)
+    while pending:
+        obj = pending.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        if isinstance(obj, lib.tiledsurface._SurfaceSnapshot):
+            sshots.append(obj)
+        elif isinstance(obj, lib.tiledsurface.MyPaintSurface):
+            surfaces.append(obj)
+        elif isinstance(obj, lib.layer.LayerBase):
+            if obj.root is None:
+                pending.extend(obj.__dict__.values())
+        elif isinstance(obj, lib.layer.LayerBaseSnapshot):
+            pending.extend(obj.__dict__.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            pending.extend(obj)
+        elif isinstance(obj, dict):
+            pending.extend(obj.values())
+    return sshots, surfaces
+
+
+def _claim_tiles(tiles, claimed):
+    """Returns the tiles not already claimed, and claims them"""
+    result = []
+    for tile in tiles:
+        if id(tile) in claimed:
+            continue
+        claimed.add(id(tile))
+        result.append(tile)
+    return result
+
+
+#: Size of the pixel data of a tile, in bytes.
+_TILE_BYTES = lib.tiledsurface.N * lib.tiledsurface.N * 4 * 2
+
+
+def _count_resident_bytes(tiles):
+    """Sums the sizes of tile pixel data which is in memory
+
+    Spilled tiles, and tiles being spilled, count as zero bytes.
+    Their pixels are not reloaded.
+
+    """
+    nbytes = 0
+    for tile in tiles:
+        tile_dict = tile.__dict__
+        rgba = tile_dict.get("rgba")
+        if rgba is not None and "_spilled" not in tile_dict:
+            nbytes += rgba.nbytes
+    return nbytes
+
 
 class Command (object):
     """A reversible change to the document model
@@ -157,6 +390,10 @@ class Command (object):
     automatic_undo = False
     display_name = _("Unknown Command")
 
+    #: Bytes of tile data kept alive by this command alone.
+    #: Maintained by the CommandStack.
+    footprint = 0
+
     ## Method defs
 
     def __init__(self, doc, **kwargs):
@@ -208,6 +445,22 @@ class Command (object):
         """
         raise NotImplementedError
 
+    ## Memory use
+
+    def get_tile_holders(self):
+        """Returns the tile-holding objects kept alive by this command
+
+        :returns: (surface_snapshots, detached_surfaces)
+        :rtype: tuple
+
+        The command stack uses this to work out the command's memory
+        footprint. The default implementation searches the command's
+        attributes for layer snapshots, and for layers which are not
+        part of any document.
+
+        """
+        return _find_tile_holders(self.__dict__.values())
+
     ## Deprecated utility functions for subclasses
 
     def _notify_canvas_observers(self, layer_bboxes):
@@ -37,13 +37,15 @@ import lib.layer as layer
 import lib.brush as brush
 from lib.observable import event
 import lib.pixbuf
+import lib.surface
 from lib.errors import FileHandlingError
-from lib.errors import AllocationError
 import lib.idletask
 from lib.gettext import C_
 import lib.xml
 import lib.glib
 import lib.feedback
+import lib.tilespill
+import lib.tilecache
 
 logger = logging.getLogger(__name__)
 
@@ -58,6 +60,7 @@ CACHE_APP_SUBDIR_NAME = u"mypaint"
 CACHE_DOC_SUBDIR_PREFIX = u"doc."
 CACHE_DOC_AUTOSAVE_SUBDIR = u"autosave"
 CACHE_ACTIVITY_FILE = u"active"
+CACHE_APP_TILES_SUBDIR = u"tiles"
 CACHE_UPDATE_INTERVAL = 10  # seconds
 
 # Logging and error reporting strings
@@ -291,6 +294,7 @@ class Document (object):
                     "to an existing directory",
                 )
             self._owns_cache_dir = False
+            self._start_undo_spill()
         else:
             self._owns_cache_dir = True
         self._cache_updater_id = None
@@ -299,6 +303,8 @@ class Document (object):
         self._autosave_processor = None
         self._autosave_countdown_id = None
         self._autosave_dirty = False
+        self._last_ora_save = None  # (path, signature, copier)
+        self._last_tile_cache = None  # TileCache or TileCacheWriter
         if (not painting_only) and self._owns_cache_dir:
             self._autosave_processor = lib.idletask.Processor()
             self.command_stack.stack_updated += self._command_stack_updated_cb
@@ -361,6 +367,7 @@ class Document (object):
             doc_cache_dir = doc_cache_dir.decode(sys.getfilesystemencoding())
         logger.debug("Created working-doc cache dir %r", doc_cache_dir)
         self._cache_dir = doc_cache_dir
+        self._start_undo_spill()
         # Start the cache updater, which kicks off background autosaves,
         # and updates an activity canary file.
         # Not a perfect solution, but maybe a better cross-platform one
@@ -385,6 +392,7 @@ class Document (object):
             return
         self._stop_cache_updater()
         self._stop_autosave_writes()
+        self._stop_undo_spill()
         shutil.rmtree(self._cache_dir, ignore_errors=True)
         if os.path.exists(self._cache_dir):
             logger.error(
@@ -398,6 +406,24 @@ class Document (object):
             )
         self._cache_dir = None
 
+    def _start_undo_spill(self):
+        """Internal: lets old undo steps move their tiles to the cache"""
+        self._stop_undo_spill()
+        try:
+            spill = lib.tilespill.TileSpillFile(self._cache_dir)
+        except EnvironmentError:
+            logger.exception("Undo history will be kept in memory only")
+            return
+        self.command_stack.spill = spill
+
+    def _stop_undo_spill(self):
+        """Internal: stops old undo steps moving their tiles to the cache"""
+        spill = self.command_stack.spill
+        if spill is None:
+            return
+        self.command_stack.spill = None
+        spill.close()
+
     def cleanup(self):
         """Cleans up any persistent state belonging to the document.
 
@@ -549,6 +575,7 @@ class Document (object):
         root_elem = self.layer_stack.queue_autosave(
             oradir, taskproc, manifest,
             save_srgb_chunks = True,  # internal-only, so sure.
+            png_compression = "fast",  # rewritten often, so speed wins
             bbox = image_bbox,
         )
         # Build the image element
@@ -829,6 +856,8 @@ class Document (object):
         else:
             self._layers.current_path = None
         self.unsaved_painting_time = 0.0
+        self._last_ora_save = None
+        self._last_tile_cache = None
         self.set_frame([0, 0, 0, 0])
         self.set_frame_enabled(False)
         self._xres = None
@@ -1545,48 +1574,240 @@ class Document (object):
 
     @fileutils.via_tempfile
     def save_jpg(self, filename, quality=90, **kwargs):
+        """Saves the document as a JPEG file, one strip at a time"""
         x, y, w, h = self.get_user_bbox()
         if w == 0 or h == 0:
             x, y, w, h = 0, 0, N, N  # allow to save empty documents
-        try:
-            pixbuf = self.layer_stack.render_as_pixbuf(x, y, w, h, **kwargs)
-        except (AllocationError, MemoryError) as e:
-            hint_tmpl = C_(
-                "Document IO: hint templates for user-facing exceptions",
-                u"Unable to save as JPEG: {original_msg}\n\n"
-                u"Try saving in PNG format instead, "
-                u"if your machine doesn’t have a lot of memory. "
-                u"MyPaint’s PNG save function is more efficient."
-            )
-            raise AllocationError(hint_tmpl.format(
-                original_msg = str(e),
-            ))
-        lib.pixbuf.save(pixbuf, filename, 'jpeg', quality=str(quality))
+        lib.surface.save_as_jpeg(
+            self.layer_stack,
+            filename,
+            x, y, w, h,
+            quality=quality,
+            **kwargs
+        )
 
     save_jpeg = save_jpg
 
-    @fileutils.via_tempfile
-    def save_ora(self, filename, options=None, **kwargs):
-        """Saves OpenRaster data to a file"""
+    def save_ora(self, filename, options=None, incremental=True,
+                 **kwargs):
+        """Saves OpenRaster data to a file
+
+        :param unicode filename: The file to save to.
+        :param bool incremental: Reuse data from the last save if possible.
+
+        When saving over the file this document was last saved to, if it
+        hasn't been modified by anything else since, an incremental save
+        copies the data of unchanged layers from it as it is.
+
+        >>> tmpdir = tempfile.mkdtemp()
+        >>> orafile = os.path.join(tmpdir, "test.ora")
+        >>> doc = Document(painting_only=True)
+        >>> doc.load_ora("tests/smallimage.ora")
+        >>> def copied_layers(filename):
+        ...     copier = doc._last_ora_save[2]
+        ...     with zipfile.ZipFile(filename) as orazip:
+        ...         image_elem = ET.fromstring(orazip.read("stack.xml"))
+        ...     return [
+        ...         copier.is_copied(elem.attrib["src"])
+        ...         for elem in image_elem.iter("layer")
+        ...     ]
+        >>> thumb = doc.save_ora(orafile)
+        >>> copied_layers(orafile)
+        [False, False, False]
+
+        Only the layers edited since are encoded again the next time.
+        The previews are only copied if nothing changed at all.
+
+        >>> edited, untouched = list(doc.layer_stack)
+        >>> with edited._surface.tile_request(0, 0, readonly=False) as t:
+        ...     t[...] = 1 << 15
+        >>> thumb = doc.save_ora(orafile)
+        >>> copied_layers(orafile)
+        [False, True, True]
+        >>> doc._last_ora_save[2].is_copied("Thumbnails/thumbnail.png")
+        False
+        >>> thumb = doc.save_ora(orafile)
+        >>> copied_layers(orafile)
+        [True, True, True]
+        >>> doc._last_ora_save[2].is_copied("Thumbnails/thumbnail.png")
+        True
+
+        The result loads the same as a full save.
+
+        >>> fullfile = os.path.join(tmpdir, "full.ora")
+        >>> thumb = doc.save_ora(fullfile, incremental=False)
+        >>> doc1 = Document(painting_only=True)
+        >>> doc1.load_ora(orafile)
+        >>> doc2 = Document(painting_only=True)
+        >>> doc2.load_ora(fullfile)
+        >>> for layer1, layer2 in zip(doc1.layer_stack, doc2.layer_stack):
+        ...     surf1, surf2 = layer1._surface, layer2._surface
+        ...     for tx, ty in set(surf1.get_tiles()) | set(surf2.get_tiles()):
+        ...         with surf1.tile_request(tx, ty, readonly=True) as t1:
+        ...             with surf2.tile_request(tx, ty, readonly=True) as t2:
+        ...                 assert (t1 == t2).all()
+
+        Files changed by anything else since are saved in full.
+
+        >>> os.utime(fullfile, (0, 0))
+        >>> thumb = doc.save_ora(fullfile)
+        >>> copied_layers(fullfile)
+        [False, False, False]
+        >>> for d in (doc, doc1, doc2):
+        ...     d.cleanup()
+        >>> shutil.rmtree(tmpdir)
+
+        """
         logger.info('save_ora: %r (%r, %r)', filename, options, kwargs)
         t0 = time.time()
-        thumbnail = _save_layers_to_new_orazip(
-            self.layer_stack,
+        target_path = os.path.realpath(filename)
+        prev_copier, prev_orazip = None, None
+        if incremental and self._last_ora_save:
+            prev_copier, prev_orazip = self._open_last_ora_save(target_path)
+        ora_copier = layer.OpenRasterMemberCopier(prev_copier, prev_orazip)
+        tiles_dir = self._get_tile_cache_dir()
+        cache_writer = None
+        if tiles_dir:
+            # Only the layers not already in the cache file are written.
+            cache_writer = lib.tilecache.TileCacheWriter(
+                previous = self._last_tile_cache,
+            )
+        self._last_ora_save = None
+        thumbnail = self._save_ora_via_tempfile(
             filename,
-            bbox=tuple(self.get_user_bbox()),
-            xres=self._xres if self._xres else None,
-            yres=self._yres if self._yres else None,
-            frame_active = self.frame_enabled,
+            ora_copier=ora_copier,
+            tile_cache_writer=cache_writer,
             **kwargs
         )
+        self._last_ora_save = (
+            target_path,
+            _get_file_signature(target_path),
+            ora_copier,
+        )
+        if cache_writer:
+            cache_writer.write_in_background(tiles_dir, target_path)
+            self._last_tile_cache = cache_writer
         logger.info('%.3fs save_ora total', time.time() - t0)
         return thumbnail
 
+    @fileutils.via_tempfile
+    def _save_ora_via_tempfile(self, filename, ora_copier=None,
+                               tile_cache_writer=None, **kwargs):
+        """Internal: saves OpenRaster data to a temporary file"""
+        try:
+            return _save_layers_to_new_orazip(
+                self.layer_stack,
+                filename,
+                bbox=tuple(self.get_user_bbox()),
+                xres=self._xres if self._xres else None,
+                yres=self._yres if self._yres else None,
+                frame_active = self.frame_enabled,
+                ora_copier = ora_copier,
+                tile_cache_writer = tile_cache_writer,
+                **kwargs
+            )
+        finally:
+            # The old file must be closed before it's replaced.
+            if ora_copier:
+                ora_copier.close()
+
+    def _open_last_ora_save(self, path):
+        """Internal: reopens the file written by the last ORA save
+
+        :param unicode path: Real path of the file about to be written.
+        :returns: (copier used for the last save, zipfile)
+        :rtype: tuple
+
+        Returns (None, None) if the file is a different one, or if it
+        has been modified since it was last saved.
+
+        """
+        last_path, last_signature, last_copier = self._last_ora_save
+        if path != last_path:
+            return (None, None)
+        if _get_file_signature(path) != last_signature:
+            logger.info("%r was modified: saving it in full", path)
+            return (None, None)
+        try:
+            orazip = zipfile.ZipFile(path)
+        except (IOError, OSError, zipfile.BadZipfile):
+            logger.exception("Cannot reopen %r: saving it in full", path)
+            return (None, None)
+        return (last_copier, orazip)
+
+    def _get_tile_cache_dir(self):
+        """Internal: where tile caches of OpenRaster files are kept
+
+        :returns: The directory, or None if caches aren't used.
+        :rtype: unicode
+
+        Tile caches outlive documents, so they are shared app-wide.
+        Painting-only documents don't use them.
+
+        """
+        if self._painting_only:
+            return None
+        return os.path.join(get_app_cache_root(), CACHE_APP_TILES_SUBDIR)
+
     def load_ora(self, filename, progress=None, **kwargs):
-        """Loads from an OpenRaster file"""
+        """Loads from an OpenRaster file
+
+        Layer PNGs are decoded in parallel. Hidden layers, and layers
+        outside the frame, are only decoded when their pixels are first
+        needed. Big ones start out with unloaded tiles.
+
+        >>> tmpdir = tempfile.mkdtemp()
+        >>> orafile = os.path.join(tmpdir, "test.ora")
+        >>> with zipfile.ZipFile("tests/bigimage.ora") as src_orazip:
+        ...     image_elem = ET.fromstring(src_orazip.read("stack.xml"))
+        ...     elems = image_elem.find("stack").findall("layer")[:-1]
+        ...     elems[1].attrib["visibility"] = "hidden"
+        ...     elems[6].attrib["visibility"] = "hidden"
+        ...     elems[9].attrib["x"] = "4000"
+        ...     with zipfile.ZipFile(orafile, "w") as orazip:
+        ...         for info in src_orazip.infolist():
+        ...             data = src_orazip.read(info)
+        ...             if info.filename == "stack.xml":
+        ...                 data = ET.tostring(image_elem)
+        ...             orazip.writestr(info, data)
+        >>> doc = Document(painting_only=True)
+        >>> doc.load_ora(orafile)
+        >>> layers = list(doc.layer_stack)
+        >>> len(layers) == len(elems)
+        True
+        >>> def unloaded():
+        ...     return [
+        ...         i for (i, l) in enumerate(layers)
+        ...         if l._surface.get_unloaded_tiles()
+        ...     ]
+        >>> unloaded()
+        [6, 9]
+
+        However they were loaded, the layers have the same pixels as
+        after a plain sequential decode.
+
+        >>> with zipfile.ZipFile(orafile) as orazip:
+        ...     for elem, l in zip(elems, layers):
+        ...         src = elem.attrib["src"]
+        ...         x, y = int(elem.attrib["x"]), int(elem.attrib["y"])
+        ...         ref = tiledsurface.Surface()
+        ...         with orazip.open(src) as fp:
+        ...             ref.load_from_png_file(fp, x, y, convert_to_srgb=False)
+        ...         surf = l._surface
+        ...         for tx, ty in set(surf.get_tiles()) | set(ref.get_tiles()):
+        ...             with surf.tile_request(tx, ty, readonly=True) as t1:
+        ...                 with ref.tile_request(tx, ty, readonly=True) as t2:
+        ...                     assert (t1 == t2).all(), src
+        >>> unloaded()
+        []
+        >>> doc.cleanup()
+        >>> shutil.rmtree(tmpdir)
+
+        """
         logger.info('load_ora: %r', filename)
         t0 = time.time()
         cache_dir = self._cache_dir
+        self._last_ora_save = None
         orazip = zipfile.ZipFile(filename)
         logger.debug('mimetype: %r', orazip.read('mimetype').strip())
         xml = orazip.read('stack.xml')
@@ -1598,16 +1819,53 @@ class Document (object):
         image_xres = max(0, int(image_elem.attrib.get('xres', 0)))
         image_yres = max(0, int(image_elem.attrib.get('yres', 0)))
 
-        # Delegate loading of image data to the layers tree itself
-        self.layer_stack.clear()
-        self.layer_stack.load_from_openraster(
+        # Start decoding all the layer PNGs in parallel, then delegate
+        # loading of image data to the layers tree itself. The layers
+        # pick up their decoded surfaces in stack order. Layers in a
+        # valid tile cache are not decoded at all; if there's no cache,
+        # the decoded layers are written to a new one afterwards.
+        # Hidden layers and layers outside the image's area are only
+        # decoded when something first needs their pixels.
+        tiles_dir = self._get_tile_cache_dir()
+        tile_cache = None
+        cache_writer = None
+        if tiles_dir:
+            tile_cache = lib.tilecache.TileCache.open(tiles_dir, filename)
+            if tile_cache is None:
+                cache_writer = lib.tilecache.TileCacheWriter()
+        self._last_tile_cache = tile_cache or cache_writer
+        png_decoder = layer.OpenRasterPNGDecoder(
             orazip,
+            tile_cache=tile_cache,
+            cache_writer=cache_writer,
+        )
+        visible_bbox = None
+        if image_width and image_height:
+            visible_bbox = (0, 0, image_width, image_height)
+        decode_progress = None
+        if progress:
+            # Decoding is where the time goes.
+            progress.items = 10
+            decode_progress = progress.open(9)
+            progress = progress.open(1)
+        png_decoder.submit_stack(
             root_stack_elem,
-            cache_dir,
-            progress,
-            x=0, y=0,
-            **kwargs
+            visible_bbox = visible_bbox,
+            progress = decode_progress,
         )
+        self.layer_stack.clear()
+        try:
+            self.layer_stack.load_from_openraster(
+                orazip,
+                root_stack_elem,
+                cache_dir,
+                progress,
+                x=0, y=0,
+                png_decoder=png_decoder,
+                **kwargs
+            )
+        finally:
+            png_decoder.close()
         assert len(self.layer_stack) > 0
 
         # Resolution information if specified
@@ -1630,6 +1888,8 @@ class Document (object):
         self.set_frame_enabled(frame_enab, user_initiated=False)
 
         orazip.close()
+        if cache_writer:
+            cache_writer.write_in_background(tiles_dir, filename)
 
         logger.info('%.3fs load_ora total', time.time() - t0)
 
@@ -1732,10 +1992,26 @@ class Document (object):
         self.set_frame_enabled(frame_enab, user_initiated=False)
 
 
+def _get_file_signature(path):
+    """Gets a tuple which changes if a file is modified
+
+    :param unicode path: File to check.
+    :returns: (size, mtime), or None if the file doesn't exist.
+
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_size, st.st_mtime)
+
+
 def _save_layers_to_new_orazip(root_stack, filename, bbox=None,
                                xres=None, yres=None,
                                frame_active=False,
                                progress=None,
+                               ora_copier=None,
+                               tile_cache_writer=None,
                                **kwargs):
     """Save a root layer stack to a new OpenRaster zipfile
 
@@ -1747,6 +2023,10 @@ def _save_layers_to_new_orazip(root_stack, filename, bbox=None,
     :param frame_active: True if the frame is enabled
     :param progress: Unsized UI feedback object
     :type progress: lib.feedback.Progress or None
+    :param ora_copier: Reuses unchanged data from the previous save
+    :type ora_copier: lib.layer.OpenRasterMemberCopier or None
+    :param tile_cache_writer: Collects the saved layers for caching
+    :type tile_cache_writer: lib.tilecache.TileCacheWriter or None
     :param \*\*kwargs: Passed through to root_stack.save_to_openraster()
     :rtype: GdkPixbuf
     :returns: Thumbnail preview image (256x256 max) of what was saved
@@ -1761,6 +2041,22 @@ def _save_layers_to_new_orazip(root_stack, filename, bbox=None,
     >>> isinstance(thumb, GdkPixbuf.Pixbuf)
     True
     >>> assert os.path.isfile(orafile)
+
+    Saves can reuse the data of unchanged layers from the last save.
+
+    >>> copier1 = layer.OpenRasterMemberCopier()
+    >>> thumb = _save_layers_to_new_orazip(root, orafile, ora_copier=copier1)
+    >>> copier1.close()
+    >>> copier2 = layer.OpenRasterMemberCopier(
+    ...     copier1,
+    ...     zipfile.ZipFile(orafile),
+    ... )
+    >>> orafile2 = os.path.join(tmpdir, "test2.ora")
+    >>> thumb = _save_layers_to_new_orazip(root, orafile2, ora_copier=copier2)
+    >>> copier2.close()
+    >>> with zipfile.ZipFile(orafile) as z1, zipfile.ZipFile(orafile2) as z2:
+    ...     all(z1.read(n) == z2.read(n) for n in z1.namelist())
+    True
     >>> shutil.rmtree(tmpdir)
     >>> assert not os.path.exists(tmpdir)
 
@@ -1770,6 +2066,8 @@ def _save_layers_to_new_orazip(root_stack, filename, bbox=None,
         progress = lib.feedback.Progress()
     progress.items = 100
 
+    # Only used for spilling big layer PNGs which are waiting to be
+    # written to the zipfile. Nothing else goes via temporary files.
     tempdir = tempfile.mkdtemp(suffix='mypaint', prefix='save')
     if not isinstance(tempdir, unicode):
         tempdir = tempdir.decode(sys.getfilesystemencoding())
@@ -1791,7 +2089,8 @@ def _save_layers_to_new_orazip(root_stack, filename, bbox=None,
         data_bbox.expandToIncludeRect(s_layer.get_bbox())
     data_bbox = tuple(data_bbox)
 
-    # First 90%: save the layer stack
+    # First 20%: save the layer stack. Layer PNGs are only queued for
+    # encoding in the background here.
     image = ET.Element('image')
     if bbox is None:
         bbox = data_bbox
@@ -1799,10 +2098,14 @@ def _save_layers_to_new_orazip(root_stack, filename, bbox=None,
     image.attrib['w'] = str(w0)
     image.attrib['h'] = str(h0)
     root_stack_path = ()
+    png_encoder = layer.OpenRasterPNGEncoder(orazip, tempdir)
     root_stack_elem = root_stack.save_to_openraster(
         orazip, tempdir, root_stack_path,
         data_bbox, bbox,
-        progress=progress.open(90),
+        progress=progress.open(20),
+        png_encoder=png_encoder,
+        ora_copier=ora_copier,
+        tile_cache_writer=tile_cache_writer,
         **kwargs
     )
     image.append(root_stack_elem)
@@ -1819,32 +2122,47 @@ def _save_layers_to_new_orazip(root_stack, filename, bbox=None,
     # OpenRaster version declaration
     image.attrib["version"] = lib.xml.OPENRASTER_VERSION
 
-    # Last 10%: previews.
-    # Thumbnail preview (256x256)
-    thumbnail = root_stack.render_thumbnail(
-        bbox,
-        progress=progress.open(1),
-    )
-    tmpfile = join(tempdir, 'tmp.png')
-    lib.pixbuf.save(thumbnail, tmpfile, 'png')
-    orazip.write(tmpfile, 'Thumbnails/thumbnail.png')
-    os.remove(tmpfile)
-
-    # Save fully rendered image too
-    tmpfile = os.path.join(tempdir, "mergedimage.png")
-    root_stack.save_as_png(
-        tmpfile, *bbox,
-        alpha=False, background=True,
-        progress=progress.open(9),
-        **kwargs
-    )
-    orazip.write(tmpfile, 'mergedimage.png')
-    os.remove(tmpfile)
-
     # Prettification
     lib.xml.indent_etree(image)
     xml = ET.tostring(image, encoding='UTF-8')
 
+    # Next 10%: previews, rendered while the layers are encoding.
+    # If nothing at all changed since the last save, copy them instead.
+    thumbnail_name = 'Thumbnails/thumbnail.png'
+    merged_name = 'mergedimage.png'
+    previews_copied = ora_copier and ora_copier.copy_previews(
+        orazip, xml,
+        [thumbnail_name, merged_name],
+    )
+    if previews_copied:
+        thumbnail = lib.pixbuf.load_from_zipfile(
+            ora_copier.prev_orazip,
+            thumbnail_name,
+            progress=progress.open(10),
+        )
+    else:
+        # Render the full image once. The thumbnail (256x256 max) is
+        # downscaled from the same strips as they're written.
+        if w0 and h0:
+            thumb_scaler = lib.surface.ScanlineStripDownscaler(w0, h0)
+        else:
+            # save_as_png() writes 1x1 for empty docs
+            thumb_scaler = lib.surface.ScanlineStripDownscaler(1, 1)
+        with helpers.ZipfileEntryWriter(orazip, merged_name) as fp:
+            lib.surface.save_as_png(
+                root_stack, fp, *bbox,
+                alpha=False, background=True,
+                progress=progress.open(10),
+                strip_consumer=thumb_scaler,
+                **kwargs
+            )
+        thumbnail = helpers.rgb_array_to_gdkpixbuf(thumb_scaler.get_array())
+        with helpers.ZipfileEntryWriter(orazip, thumbnail_name) as fp:
+            lib.pixbuf.save(thumbnail, fp, 'png')
+
+    # Remaining 70%: wait for the layer PNGs, and archive them.
+    png_encoder.finish(progress=progress.open(70))
+
     # Finalize
     helpers.zipfile_writestr(orazip, 'stack.xml', xml)
     orazip.close()
@@ -0,0 +1,446 @@
+// Fast saving of JPEG files using scanlines
+// Copyright (C) 2017  MyPaint Development Team
+//
+// This program is free software; you can redistribute it and/or modify it
+// under the terms of the GNU General Public License as published by the Free
+// Software Foundation; either version 2 of the License, or (at your option)
+// any later version.
+//
+// This program is distributed in the hope that it will be useful, but WITHOUT
+// ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+// FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+// more details.
+//
+// You should have received a copy of the GNU General Public License along with
+// this program; if not, write to the Free Software Foundation, Inc., 51
+// Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+
+#include "fastjpeg.hpp"
+#ifdef _WIN32
+#ifndef __MINGW64_VERSION_MAJOR
+// include this before third party libs
+#include <windows.h>
+#endif
+#endif
+#include <stdio.h>
+#include <stdlib.h>
+#include <setjmp.h>
+#include "jpeglib.h"
+#include "jerror.h"
+
+#include "common.hpp"
+#define NPY_NO_DEPRECATED_API NPY_1_7_API_VERSION
+#define NO_IMPORT_ARRAY
+#include <numpy/arrayobject.h>
+
+
+// Size of the buffer for data going to Python file-like objects
+static const size_t JPEG_PYFILE_BUFFER_SIZE = 64 * 1024;
+
+
+// libjpeg error handler: errors longjmp back to the caller, with the
+// formatted message kept for the Python exception.
+
+struct JPEGErrorManager
+{
+    struct jpeg_error_mgr pub;  // must be first
+    jmp_buf setjmp_buffer;
+    char message[JMSG_LENGTH_MAX];
+};
+
+
+static void
+jpeg_error_exit_callback (j_common_ptr cinfo)
+{
+    JPEGErrorManager *err = (JPEGErrorManager *)cinfo->err;
+    (*cinfo->err->format_message)(cinfo, err->message);
+    longjmp(err->setjmp_buffer, 1);
+}
+
+
+// Destination manager for Python file-like objects. As with the PNG
+// writer, the GIL is released while libjpeg compresses rows, and the
+// callbacks reacquire it to call write().
+
+struct JPEGPyFileDestination
+{
+    struct jpeg_destination_mgr pub;  // must be first
+    PyObject *file;
+    PyThreadState *thread_state;   // saved state while the GIL is released
+    JOCTET buffer[JPEG_PYFILE_BUFFER_SIZE];
+
+    JPEGPyFileDestination()
+        : file(NULL), thread_state(NULL)
+    { }
+
+    void release_gil() {
+        assert(thread_state == NULL);
+        thread_state = PyEval_SaveThread();
+    }
+
+    void acquire_gil() {
+        if (thread_state) {
+            PyEval_RestoreThread(thread_state);
+            thread_state = NULL;
+        }
+    }
+};
+
+
+static void
+jpeg_pyfile_write_data (j_compress_ptr cinfo, size_t length)
+{
+    // On errors, keep the GIL: ERREXIT() longjmps back to code which
+    // expects to hold it.
+    JPEGPyFileDestination *dest = (JPEGPyFileDestination *)cinfo->dest;
+    bool was_released = (dest->thread_state != NULL);
+    dest->acquire_gil();
+    PyObject *buf = PyString_FromStringAndSize((char *)dest->buffer, length);
+    PyObject *result = NULL;
+    if (buf) {
+        result = PyObject_CallMethod(dest->file, (char *)"write",
+                                     (char *)"O", buf);
+        Py_DECREF(buf);
+    }
+    if (!result) {
+        ERREXIT(cinfo, JERR_FILE_WRITE);
+    }
+    Py_DECREF(result);
+    if (was_released) {
+        dest->release_gil();
+    }
+}
+
+
+static void
+jpeg_pyfile_init_destination (j_compress_ptr cinfo)
+{
+    JPEGPyFileDestination *dest = (JPEGPyFileDestination *)cinfo->dest;
+    dest->pub.next_output_byte = dest->buffer;
+    dest->pub.free_in_buffer = JPEG_PYFILE_BUFFER_SIZE;
+}
+
+
+static boolean
+jpeg_pyfile_empty_output_buffer (j_compress_ptr cinfo)
+{
+    // Called when the whole buffer is full, whatever free_in_buffer says.
+    JPEGPyFileDestination *dest = (JPEGPyFileDestination *)cinfo->dest;
+    jpeg_pyfile_write_data(cinfo, JPEG_PYFILE_BUFFER_SIZE);
+    dest->pub.next_output_byte = dest->buffer;
+    dest->pub.free_in_buffer = JPEG_PYFILE_BUFFER_SIZE;
+    return TRUE;
+}
+
+
+static void
+jpeg_pyfile_term_destination (j_compress_ptr cinfo)
+{
+    JPEGPyFileDestination *dest = (JPEGPyFileDestination *)cinfo->dest;
+    size_t length = JPEG_PYFILE_BUFFER_SIZE - dest->pub.free_in_buffer;
+    if (length > 0) {
+        jpeg_pyfile_write_data(cinfo, length);
+    }
+}
+
+
+struct ProgressiveJPEGWriter::State
+{
+    int width;
+    int height;
+    int y;
+    PyObject *file;
+    bool compressing;
+    JSAMPLE *row;   // one row of RGB data
+    struct jpeg_compress_struct cinfo;
+    JPEGErrorManager err;
+    JPEGPyFileDestination dest;
+
+    State()
+        : width(0), height(0),
+          y(0),
+          file(NULL),
+          compressing(false),
+          row(NULL)
+    { }
+
+    ~State() {
+        cleanup();
+    }
+
+    bool check_valid();
+
+    void cleanup() {
+        if (compressing) {
+            jpeg_destroy_compress(&cinfo);
+            compressing = false;
+        }
+        if (row) {
+            free(row);
+            row = NULL;
+        }
+        if (file) {
+            Py_DECREF(file);
+            file = NULL;
+        }
+    }
+};
+
+
+bool
+ProgressiveJPEGWriter::State::check_valid()
+{
+    bool valid = true;
+    if (! file) {
+        PyErr_SetString(
+            PyExc_RuntimeError,
+            "writer object's internal state is invalid (no file)"
+        );
+        valid = false;
+    }
+    if (! compressing) {
+        PyErr_SetString(
+            PyExc_RuntimeError,
+            "writer object's internal state is invalid (not compressing)"
+        );
+        valid = false;
+    }
+    return valid;
+}
+
+
+ProgressiveJPEGWriter::ProgressiveJPEGWriter(PyObject *file,
+                                             const int w, const int h,
+                                             const int quality)
+    : state(new ProgressiveJPEGWriter::State())
+{
+    state->width = w;
+    state->height = h;
+
+    if (w <= 0 || h <= 0 ||
+            w > JPEG_MAX_DIMENSION || h > JPEG_MAX_DIMENSION) {
+        PyErr_Format(
+            PyExc_ValueError,
+            "JPEG images must be between 1 and %d pixels wide and high",
+            (int)JPEG_MAX_DIMENSION
+        );
+        return;
+    }
+    if (quality < 0 || quality > 100) {
+        PyErr_SetString(PyExc_ValueError, "quality must be in 0..100");
+        return;
+    }
+
+    // Builtin file objects are written to directly. Anything else
+    // needs a write() method, which is called with each chunk of data.
+    FILE *fp = NULL;
+    if (PyFile_Check(file)) {
+        fp = PyFile_AsFile(file);
+        if (!fp) {
+            PyErr_SetString(
+                PyExc_TypeError,
+                "file arg has no FILE* associated with it?"
+            );
+            return;
+        }
+    }
+    else if (! PyObject_HasAttrString(file, "write")) {
+        PyErr_SetString(
+            PyExc_TypeError,
+            "file arg must be a file object, or have a write() method"
+        );
+        return;
+    }
+    state->file = file;
+    Py_INCREF(file);
+
+    state->row = (JSAMPLE *)malloc(w * 3 * sizeof(JSAMPLE));
+    if (!state->row) {
+        PyErr_SetString(PyExc_MemoryError, "failed to allocate row buffer");
+        state->cleanup();
+        return;
+    }
+
+    struct jpeg_compress_struct *cinfo = &state->cinfo;
+    cinfo->err = jpeg_std_error(&state->err.pub);
+    state->err.pub.error_exit = jpeg_error_exit_callback;
+    if (setjmp(state->err.setjmp_buffer)) {
+        if (!PyErr_Occurred()) {
+            PyErr_Format(PyExc_RuntimeError,
+                         "libjpeg error during constructor: %s",
+                         state->err.message);
+        }
+        state->cleanup();
+        return;
+    }
+    jpeg_create_compress(cinfo);
+    state->compressing = true;
+
+    if (fp) {
+        jpeg_stdio_dest(cinfo, fp);
+    }
+    else {
+        state->dest.file = file;
+        state->dest.pub.init_destination = jpeg_pyfile_init_destination;
+        state->dest.pub.empty_output_buffer = jpeg_pyfile_empty_output_buffer;
+        state->dest.pub.term_destination = jpeg_pyfile_term_destination;
+        cinfo->dest = &state->dest.pub;
+    }
+
+    cinfo->image_width = w;
+    cinfo->image_height = h;
+    cinfo->input_components = 3;
+    cinfo->in_color_space = JCS_RGB;
+    jpeg_set_defaults(cinfo);
+    jpeg_set_quality(cinfo, quality, TRUE);
+
+    // Progressive-mode JPEGs would need the whole image's coefficients
+    // in memory, so stick to baseline sequential encoding.
+    jpeg_start_compress(cinfo, TRUE);
+}
+
+
+PyObject *
+ProgressiveJPEGWriter::write(PyObject *arr_obj)
+{
+    PyArrayObject* arr = (PyArrayObject*)arr_obj;
+    int rowcount = 0;
+    int rowstride = 0;
+    const char *err_text = NULL;
+    PyObject *err_type = PyExc_RuntimeError;
+
+    if (! state) {
+        err_type = PyExc_RuntimeError;
+        err_text = "writer object is not ready to write (internal state lost)";
+        goto errexit;
+    }
+    if (! state->check_valid()) {
+        state->cleanup();
+        return NULL;
+    }
+
+    if (!arr_obj || !PyArray_Check(arr_obj)) {
+        err_type = PyExc_TypeError;
+        err_text = "arg must be a numpy array (of HxWx4)";
+        goto errexit;
+    }
+    if (!PyArray_ISALIGNED(arr) || PyArray_NDIM(arr)!=3) {
+        err_type = PyExc_ValueError;
+        err_text = "arg must be an aligned HxWx4 numpy array";
+        goto errexit;
+    }
+    if (PyArray_DIM(arr, 1) != state->width) {
+        err_type = PyExc_ValueError;
+        err_text = "strip width must match writer width (must be HxWx4)";
+        goto errexit;
+    }
+    if (PyArray_DIM(arr, 2) != 4) {
+        err_type = PyExc_ValueError;
+        err_text = "strip must contain RGBU data (must be HxWx4)";
+        goto errexit;
+    }
+    if (PyArray_TYPE(arr) != NPY_UINT8) {
+        err_type = PyExc_ValueError;
+        err_text = "strip must contain uint8 RGBU only";
+        goto errexit;
+    }
+    assert(PyArray_STRIDE(arr, 1) == 4);
+    assert(PyArray_STRIDE(arr, 2) == 1);
+
+    rowcount = PyArray_DIM(arr, 0);
+    if (state->y + rowcount > state->height) {
+        err_type = PyExc_RuntimeError;
+        err_text = "too many pixel rows written";
+        goto errexit;
+    }
+
+    rowstride = PyArray_STRIDE(arr, 0);
+    if (setjmp(state->err.setjmp_buffer)) {
+        state->dest.acquire_gil();
+        if (!PyErr_Occurred()) {
+            PyErr_Format(PyExc_RuntimeError,
+                         "libjpeg error during write(): %s",
+                         state->err.message);
+        }
+        state->cleanup();
+        return NULL;
+    }
+    {
+        // Compression is the slow part, and doesn't need Python.
+        // The caller must keep arr alive and unchanged during the call.
+        const uint8_t *src_row = (const uint8_t *)PyArray_DATA(arr);
+        JSAMPROW row_pointer[1] = { state->row };
+        const int width = state->width;
+        state->dest.release_gil();
+        for (int r=0; r<rowcount; r++) {
+            const uint8_t *src = src_row;
+            JSAMPLE *dst = state->row;
+            for (int x=0; x<width; x++) {
+                dst[0] = src[0];
+                dst[1] = src[1];
+                dst[2] = src[2];
+                dst += 3;
+                src += 4;
+            }
+            jpeg_write_scanlines(&state->cinfo, row_pointer, 1);
+            src_row += rowstride;
+        }
+        state->dest.acquire_gil();
+    }
+    state->y += rowcount;
+    Py_RETURN_NONE;
+
+  errexit:
+    if (state) {
+        state->cleanup();
+    }
+    if (err_text) {
+        PyErr_SetString(err_type, err_text);
+        return NULL;
+    }
+    Py_RETURN_NONE;
+}
+
+
+PyObject *
+ProgressiveJPEGWriter::close()
+{
+    if (! state) {
+        PyErr_SetString(
+            PyExc_RuntimeError,
+            "writer object is not ready to write (internal state lost)"
+        );
+        return NULL;
+    }
+    if (! state->check_valid()) {
+        state->cleanup();
+        return NULL;
+    }
+    if (state->y != state->height) {
+        state->cleanup();
+        PyErr_SetString(
+            PyExc_RuntimeError,
+            "not enough pixel rows written"
+        );
+        return NULL;
+    }
+    if (setjmp(state->err.setjmp_buffer)) {
+        if (!PyErr_Occurred()) {
+            PyErr_Format(PyExc_RuntimeError,
+                         "libjpeg error during close(): %s",
+                         state->err.message);
+        }
+        state->cleanup();
+        return NULL;
+    }
+    jpeg_finish_compress(&state->cinfo);
+    state->cleanup();
+    Py_RETURN_NONE;
+}
+
+
+ProgressiveJPEGWriter::~ProgressiveJPEGWriter()
+{
+    delete state;
+}
@@ -0,0 +1,42 @@
+// Fast saving of JPEG files using scanlines
+// Copyright (C) 2017  MyPaint Development Team
+//
+// This program is free software; you can redistribute it and/or modify it
+// under the terms of the GNU General Public License as published by the Free
+// Software Foundation; either version 2 of the License, or (at your option)
+// any later version.
+//
+// This program is distributed in the hope that it will be useful, but WITHOUT
+// ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+// FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+// more details.
+//
+// You should have received a copy of the GNU General Public License along with
+// this program; if not, write to the Free Software Foundation, Inc., 51
+// Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+#ifndef FASTJPEG_HPP
+#define FASTJPEG_HPP
+
+#include <Python.h>
+
+
+// Writes a baseline JPEG file progressively in strips, like
+// ProgressivePNGWriter. Only one row of pixels is held at a time.
+// The quality is as for libjpeg's jpeg_set_quality(), 0..100.
+
+class ProgressiveJPEGWriter
+{
+public:
+    ProgressiveJPEGWriter(PyObject *file,
+                          const int w, const int h,
+                          const int quality = 90);
+    PyObject *write(PyObject *arr);  // write a h*w*4 uint8 numpy array
+    PyObject *close();   // finalize write
+    ~ProgressiveJPEGWriter();
+private:
+    struct State;
+    State *state;
+};
+
+#endif //FASTJPEG_HPP
@@ -37,10 +37,39 @@
 #include <numpy/arrayobject.h>
 
 
+// State shared with the libpng callbacks. The GIL is released while libpng
+// encodes or decodes rows, so that several PNGs can be processed in
+// parallel threads. Callbacks which need Python reacquire it.
+
+struct PNGIOContext
+{
+    PyObject *file;   // Python file-like object, or NULL if using a FILE*
+    PyThreadState *thread_state;   // saved state while the GIL is released
+
+    PNGIOContext(PyObject *file)
+        : file(file), thread_state(NULL)
+    { }
+
+    void release_gil() {
+        assert(thread_state == NULL);
+        thread_state = PyEval_SaveThread();
+    }
+
+    void acquire_gil() {
+        if (thread_state) {
+            PyEval_RestoreThread(thread_state);
+            thread_state = NULL;
+        }
+    }
+};
+
+
 static void
 png_write_error_callback (png_structp png_save_ptr,
                           png_const_charp error_msg)
 {
+    PNGIOContext *ctx = (PNGIOContext *)png_get_error_ptr(png_save_ptr);
+    ctx->acquire_gil();
     // we don't trust libpng to call the error callback only once, so
     // check for already-set error
     if (!PyErr_Occurred()) {
@@ -55,6 +84,41 @@ png_write_error_callback (png_structp png_save_ptr,
 }
 
 
+static void
+png_write_to_pyfile_callback (png_structp png_save_ptr,
+                              png_bytep data,
+                              png_size_t length)
+{
+    // Write data via the Python file-like object's write() method.
+    // On errors, keep the GIL: png_error() longjmps back to code which
+    // expects to hold it.
+    PNGIOContext *ctx = (PNGIOContext *)png_get_io_ptr(png_save_ptr);
+    bool was_released = (ctx->thread_state != NULL);
+    ctx->acquire_gil();
+    PyObject *buf = PyString_FromStringAndSize((char *)data, length);
+    PyObject *result = NULL;
+    if (buf) {
+        result = PyObject_CallMethod(ctx->file, (char *)"write",
+                                     (char *)"O", buf);
+        Py_DECREF(buf);
+    }
+    if (!result) {
+        png_error(png_save_ptr, "Error writing PNG: write() failed");
+    }
+    Py_DECREF(result);
+    if (was_released) {
+        ctx->release_gil();
+    }
+}
+
+
+static void
+png_flush_pyfile_callback (png_structp png_save_ptr)
+{
+    // Flushing is left to the owner of the file object.
+}
+
+
 struct ProgressivePNGWriter::State
 {
     int width;
@@ -63,12 +127,14 @@ struct ProgressivePNGWriter::State
     png_infop info_ptr;
     int y;
     PyObject *file;
+    PNGIOContext ctx;
 
     State()
         : width(0), height(0),
           png_ptr(NULL), info_ptr(NULL),
           y(0),
-          file(NULL)
+          file(NULL),
+          ctx(NULL)
     { }
 
     ~State() {
@@ -123,7 +189,10 @@ ProgressivePNGWriter::State::check_valid()
 ProgressivePNGWriter::ProgressivePNGWriter(PyObject *file,
                                            const int w, const int h,
                                            const bool has_alpha,
-                                           const bool save_srgb_chunks)
+                                           const bool save_srgb_chunks,
+                                           const int zlib_level,
+                                           const int zlib_strategy,
+                                           const int png_filters)
     : state(new ProgressivePNGWriter::State())
 {
     state->width = w;
@@ -133,26 +202,47 @@ ProgressivePNGWriter::ProgressivePNGWriter(PyObject *file,
 
     const int bpc = 8;
 
-    if (! PyFile_Check(file)) {
+    if (zlib_level < 0 || zlib_level > 9) {
+        PyErr_SetString(PyExc_ValueError, "zlib_level must be in 0..9");
+        return;
+    }
+    if (zlib_strategy < 0 || zlib_strategy > 4) {
+        PyErr_SetString(PyExc_ValueError, "zlib_strategy must be in 0..4");
+        return;
+    }
+    if ((png_filters & ~PNG_ALL_FILTERS) || !png_filters) {
         PyErr_SetString(
-            PyExc_TypeError,
-            "file arg must be a builtin file object"
+            PyExc_ValueError,
+            "png_filters must be a nonzero mask of PNG_FILTER_* flags"
         );
+        return;
     }
-    state->file = file;
-    Py_INCREF(file);
 
-    FILE *fp = PyFile_AsFile(file);
-    if (!fp) {
+    // Builtin file objects are written to directly. Anything else
+    // needs a write() method, which is called with each chunk of data.
+    FILE *fp = NULL;
+    if (PyFile_Check(file)) {
+        fp = PyFile_AsFile(file);
+        if (!fp) {
+            PyErr_SetString(
+                PyExc_TypeError,
+                "file arg has no FILE* associated with it?"
+            );
+            return;
+        }
+    }
+    else if (! PyObject_HasAttrString(file, "write")) {
         PyErr_SetString(
             PyExc_TypeError,
-            "file arg has no FILE* associated with it?"
+            "file arg must be a file object, or have a write() method"
         );
         return;
     }
+    state->file = file;
+    Py_INCREF(file);
 
     png_ptr = png_create_write_struct (PNG_LIBPNG_VER_STRING,
-                                       (png_voidp)NULL,
+                                       (png_voidp)&state->ctx,
                                        png_write_error_callback,
                                        NULL);
     if (!png_ptr) {
@@ -181,7 +271,15 @@ ProgressivePNGWriter::ProgressivePNGWriter(PyObject *file,
         return;
     }
 
-    png_init_io(png_ptr, fp);
+    if (fp) {
+        png_init_io(png_ptr, fp);
+    }
+    else {
+        state->ctx.file = file;
+        png_set_write_fn(png_ptr, &state->ctx,
+                         png_write_to_pyfile_callback,
+                         png_flush_pyfile_callback);
+    }
 
     png_set_IHDR (png_ptr, info_ptr,
                   w, h, bpc,
@@ -197,15 +295,21 @@ ProgressivePNGWriter::ProgressivePNGWriter(PyObject *file,
                                     PNG_sRGB_INTENT_PERCEPTUAL);
     }
 
-    // default (all filters enabled):                 1350ms, 3.4MB
-    //png_set_filter(png_ptr, 0, PNG_FILTER_NONE);  // 790ms, 3.8MB
-    //png_set_filter(png_ptr, 0, PNG_FILTER_PAETH); // 980ms, 3.5MB
-    png_set_filter(png_ptr, 0, PNG_FILTER_SUB);     // 760ms, 3.4MB
-
-    //png_set_compression_level(png_ptr, 0); // 0.49s, 32MB
-    //png_set_compression_level(png_ptr, 1); // 0.98s, 9.6MB
-    png_set_compression_level(png_ptr, 2);   // 1.08s, 9.4MB
-    //png_set_compression_level(png_ptr, 9); // 18.6s, 9.3MB
+    // Row filters, as measured for one test image:
+    // PNG_ALL_FILTERS (the default):   1350ms, 3.4MB
+    // PNG_FILTER_NONE:                  790ms, 3.8MB
+    // PNG_FILTER_PAETH:                 980ms, 3.5MB
+    // PNG_FILTER_SUB:                   760ms, 3.4MB
+    png_set_filter(png_ptr, 0, png_filters);
+
+    // zlib compression levels, as measured for another:
+    // 0: 0.49s, 32MB
+    // 1: 0.98s, 9.6MB
+    // 2: 1.08s, 9.4MB
+    // 9: 18.6s, 9.3MB
+    // See lib.surface.PNG_COMPRESSION_PROFILES for the choices made.
+    png_set_compression_level(png_ptr, zlib_level);
+    png_set_compression_strategy(png_ptr, zlib_strategy);
 
     png_write_info(png_ptr, info_ptr);
 
@@ -266,7 +370,15 @@ ProgressivePNGWriter::write(PyObject *arr_obj)
     assert(PyArray_STRIDE(arr, 1) == 4);
     assert(PyArray_STRIDE(arr, 2) == 1);
 
+    rowcount = PyArray_DIM(arr, 0);
+    if (state->y + rowcount > state->height) {
+        err_type = PyExc_RuntimeError;
+        err_text = "too many pixel rows written";
+        goto errexit;
+    }
+
     if (setjmp(png_jmpbuf(state->png_ptr))) {
+        state->ctx.acquire_gil();
         if (PyErr_Occurred()) {
             state->cleanup();
             return NULL;
@@ -275,23 +387,18 @@ ProgressivePNGWriter::write(PyObject *arr_obj)
         err_text = "libpng error during write()";
         goto errexit;
     }
-    rowcount = PyArray_DIM(arr, 0);
     rowstride = PyArray_STRIDE(arr, 0);
     rowdata = (png_bytep)PyArray_DATA(arr);
     row_p = (png_bytep)rowdata;
+    // Filtering and compression are the slow part, and don't need Python.
+    // The caller must keep arr alive and unchanged during the call.
+    state->ctx.release_gil();
     for (row=0; row<rowcount; row++) {
         png_write_row(state->png_ptr, row_p);
-        if (! state->check_valid()) {
-            state->cleanup();
-            return NULL;
-        }
         row_p += rowstride;
-        if (++(state->y) > state->height) {
-            err_type = PyExc_RuntimeError;
-            err_text = "too many pixel rows written";
-            goto errexit;
-        }
     }
+    state->ctx.acquire_gil();
+    state->y += rowcount;
     Py_RETURN_NONE;
 
   errexit:
@@ -349,6 +456,8 @@ static void
 png_read_error_callback (png_structp png_read_ptr,
                          png_const_charp error_msg)
 {
+    PNGIOContext *ctx = (PNGIOContext *)png_get_error_ptr(png_read_ptr);
+    ctx->acquire_gil();
     // we don't trust libpng to call the error callback only once, so
     // check for already-set error
     if (!PyErr_Occurred()) {
@@ -365,6 +474,39 @@ png_read_error_callback (png_structp png_read_ptr,
 }
 
 
+static void
+png_read_from_pyfile_callback (png_structp png_read_ptr,
+                               png_bytep data,
+                               png_size_t length)
+{
+    // Read data via the Python file-like object's read() method.
+    // On errors, keep the GIL: png_error() longjmps back to code which
+    // expects to hold it.
+    PNGIOContext *ctx = (PNGIOContext *)png_get_io_ptr(png_read_ptr);
+    bool was_released = (ctx->thread_state != NULL);
+    ctx->acquire_gil();
+    PyObject *chunk = PyObject_CallMethod(ctx->file, (char *)"read",
+                                          (char *)"n", (Py_ssize_t)length);
+    if (!chunk) {
+        png_error(png_read_ptr, "Error reading PNG: read() failed");
+    }
+    if (!PyString_Check(chunk)
+        || (png_size_t)PyString_GET_SIZE(chunk) != length)
+    {
+        Py_DECREF(chunk);
+        if (!PyErr_Occurred()) {
+            PyErr_SetString(PyExc_IOError, "Unexpected end of PNG data");
+        }
+        png_error(png_read_ptr, "Error reading PNG: short read");
+    }
+    memcpy(data, PyString_AS_STRING(chunk), length);
+    Py_DECREF(chunk);
+    if (was_released) {
+        ctx->release_gil();
+    }
+}
+
+
 static const double PNG_gAMA_scale = 100000;
 static const double PNG_cHRM_scale = 100000;
 
@@ -377,38 +519,24 @@ log_lcms2_error (cmsContext context_id, cmsUInt32Number err_code,
 }
 
 
-/** load_png_fast_progressive:
- *
- * @filename: filename to load, in the system encoding
- * @get_buffer_callback: a Python callable returning writeable arrays
- * @convert_to_srgb: apply colorspace conversions, to sRGB display pixels
- * returns: a dict of flags describing what was read.
- *
- * Read a PNG progressively as 8bit RGBA. The callback must have the signature
- *
- *   numpy_array = callback(full_image_width, full_image_height)
- *
- * @get_buffer_callback  must return a writeable array of the image width.  If
- * the height is smaller than the image height, the callback will be called
- * again until the full image has been processed. The buffer will be written
- * with 8-bit RGBA data
- *
- */
+// Common part of the progressive loaders: reads from either a FILE
+// pointer, or (if fp is NULL) the read() method of a Python file object.
 
-PyObject *
-load_png_fast_progressive (char *filename,
-                           PyObject *get_buffer_callback,
-                           bool convert_to_srgb)
+static PyObject *
+load_png_progressive (FILE *fp,
+                      PyObject *file,
+                      PyObject *get_buffer_callback,
+                      bool convert_to_srgb)
 {
     // Note: we are not using the method that libpng calls "Reading PNG
     // files progressively". That method would involve feeding the data
     // into libpng piece by piece, which is not necessary if we can give
-    // libpng a simple FILE pointer.
+    // libpng a simple FILE pointer, or a read callback.
 
     png_structp png_ptr = NULL;
     png_infop info_ptr = NULL;
     PyObject *result = NULL;
-    FILE *fp = NULL;
+    PNGIOContext ctx(file);
     uint32_t width, height;
     uint32_t rows_left;
     png_byte color_type;
@@ -455,38 +583,7 @@ load_png_fast_progressive (char *filename,
 
     cmsSetLogErrorHandler(log_lcms2_error);
 
-#ifdef _WIN32
-    wchar_t *win32_filename;
-#ifdef __MINGW64_VERSION_MAJOR
-    // mbstowcs seems mismatch with default python encoding, force to be utf8
-    __mingw_str_utf8_wide(filename, &win32_filename, NULL);
-#else
-    size_t len;
-    wchar_t *buf;
-    // what __mingw_str_utf8_wide is
-    len = MultiByteToWideChar(CP_UTF8, MB_ERR_INVALID_CHARS, filename, -1, NULL, 0); 
-    buf = (wchar_t *) calloc(len + 1, sizeof (wchar_t));
-    if(!buf)
-        len = 0;
-    else {
-        if (len != 0)
-            MultiByteToWideChar(CP_UTF8, MB_ERR_INVALID_CHARS, filename, -1, buf, len);
-        buf[len] = L'0'; // Must null-terminated
-    }
-    win32_filename = buf;
-#endif
-    fp = _wfopen(win32_filename, L"rb");
-    if (win32_filename)
-        free(win32_filename);
-#else
-    fp = fopen(filename, "rb");
-#endif
-    if (!fp) {
-        PyErr_SetFromErrno(PyExc_IOError);
-        goto cleanup;
-    }
-
-    png_ptr = png_create_read_struct (PNG_LIBPNG_VER_STRING, (png_voidp)NULL,
+    png_ptr = png_create_read_struct (PNG_LIBPNG_VER_STRING, (png_voidp)&ctx,
                                       png_read_error_callback, NULL);
     if (!png_ptr) {
         PyErr_SetString(PyExc_MemoryError, "png_create_read_struct() failed");
@@ -503,7 +600,12 @@ load_png_fast_progressive (char *filename,
         goto cleanup;
     }
 
-    png_init_io(png_ptr, fp);
+    if (fp) {
+        png_init_io(png_ptr, fp);
+    }
+    else {
+        png_set_read_fn(png_ptr, &ctx, png_read_from_pyfile_callback);
+    }
 
     png_read_info(png_ptr, info_ptr);
 
@@ -800,8 +902,11 @@ load_png_fast_progressive (char *filename,
             }
         }
 
-        // Populate the strip of memory with pixels decoded from the PNG stream
+        // Populate the strip of memory with pixels decoded from the PNG
+        // stream. Errors longjmp to cleanup with the GIL reacquired.
+        ctx.release_gil();
         png_read_rows(png_ptr, row_pointers, NULL, rows);
+        ctx.acquire_gil();
         rows_left -= rows;
 
         if (convert_to_srgb) {
@@ -845,13 +950,12 @@ load_png_fast_progressive (char *filename,
     );
 
 cleanup:
+    ctx.acquire_gil();
     if (info_ptr || info_ptr) {
         png_destroy_read_struct (&png_ptr, &info_ptr, NULL);
     }
     // libpng's style is to free internally allocated stuff like the icc
     // tables in png_destroy_*(). I think.
-    if (fp)
-        fclose(fp);
     if (convert_to_srgb) {
         if (input_buffer_profile)
             cmsCloseProfile(input_buffer_profile);
@@ -865,3 +969,93 @@ cleanup:
 
     return result;
 }
+
+
+/** load_png_fast_progressive:
+ *
+ * @filename: filename to load, in the system encoding
+ * @get_buffer_callback: a Python callable returning writeable arrays
+ * @convert_to_srgb: apply colorspace conversions, to sRGB display pixels
+ * returns: a dict of flags describing what was read.
+ *
+ * Read a PNG progressively as 8bit RGBA. The callback must have the signature
+ *
+ *   numpy_array = callback(full_image_width, full_image_height)
+ *
+ * @get_buffer_callback  must return a writeable array of the image width.  If
+ * the height is smaller than the image height, the callback will be called
+ * again until the full image has been processed. The buffer will be written
+ * with 8-bit RGBA data
+ *
+ */
+
+PyObject *
+load_png_fast_progressive (char *filename,
+                           PyObject *get_buffer_callback,
+                           bool convert_to_srgb)
+{
+    PyObject *result = NULL;
+    FILE *fp = NULL;
+
+#ifdef _WIN32
+    wchar_t *win32_filename;
+#ifdef __MINGW64_VERSION_MAJOR
+    // mbstowcs seems mismatch with default python encoding, force to be utf8
+    __mingw_str_utf8_wide(filename, &win32_filename, NULL);
+#else
+    size_t len;
+    wchar_t *buf;
+    // what __mingw_str_utf8_wide is
+    len = MultiByteToWideChar(CP_UTF8, MB_ERR_INVALID_CHARS, filename, -1, NULL, 0); 
+    buf = (wchar_t *) calloc(len + 1, sizeof (wchar_t));
+    if(!buf)
+        len = 0;
+    else {
+        if (len != 0)
+            MultiByteToWideChar(CP_UTF8, MB_ERR_INVALID_CHARS, filename, -1, buf, len);
+        buf[len] = L'0'; // Must null-terminated
+    }
+    win32_filename = buf;
+#endif
+    fp = _wfopen(win32_filename, L"rb");
+    if (win32_filename)
+        free(win32_filename);
+#else
+    fp = fopen(filename, "rb");
+#endif
+    if (!fp) {
+        PyErr_SetFromErrno(PyExc_IOError);
+        goto cleanup;
+    }
+
+    result = load_png_progressive(fp, NULL, get_buffer_callback,
+                                  convert_to_srgb);
+
+cleanup:
+    if (fp)
+        fclose(fp);
+    return result;
+}
+
+
+/** load_png_fast_progressive_from_file:
+ *
+ * @file: a Python file-like object with a read() method
+ * @get_buffer_callback: a Python callable returning writeable arrays
+ * @convert_to_srgb: apply colorspace conversions, to sRGB display pixels
+ * returns: a dict of flags describing what was read.
+ *
+ * Like load_png_fast_progressive(), but reads the PNG data from any
+ * object with a read(size) method, such as a zipfile member. Only the
+ * object's current position onwards is read, as a stream.
+ *
+ */
+
+PyObject *
+load_png_fast_progressive_from_file (PyObject *file,
+                                     PyObject *get_buffer_callback,
+                                     bool convert_to_srgb)
+{
+    return load_png_progressive(NULL, file, get_buffer_callback,
+                                convert_to_srgb);
+}
@@ -21,7 +21,10 @@
 #include <Python.h>
 
 
-// Writes a PNG file progressively in strips
+// Writes a PNG file progressively in strips.
+// The compression settings are as for libpng's png_set_compression_level(),
+// png_set_compression_strategy(), and png_set_filter(). The defaults are
+// zlib level 2, Z_FILTERED, and PNG_FILTER_SUB.
 
 class ProgressivePNGWriter
 {
@@ -29,7 +32,10 @@ public:
     ProgressivePNGWriter(PyObject *file,
                          const int w, const int h,
                          const bool has_alpha,
-                         const bool save_srgb_chunks);
+                         const bool save_srgb_chunks,
+                         const int zlib_level = 2,
+                         const int zlib_strategy = 1,
+                         const int png_filters = 0x10);
     PyObject *write(PyObject *arr);  // write a h*w*4 uint8 numpy array
     PyObject *close();   // finalize write
     ~ProgressivePNGWriter();
@@ -47,4 +53,11 @@ load_png_fast_progressive (char *filename,
                            PyObject *get_buffer_callback,
                            bool convert_to_srgb);
 
+// Same, but read from a Python file-like object's read() method.
+
+PyObject *
+load_png_fast_progressive_from_file (PyObject *file,
+                                     PyObject *get_buffer_callback,
+                                     bool convert_to_srgb);
+
 #endif //FASTPNG_HPP
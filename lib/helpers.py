@@ -14,6 +14,9 @@ from math import floor, isnan
 import os
 import hashlib
 import zipfile
+import zlib
+import struct
+import time
 import colorsys
 import gc
 import logging
@@ -230,6 +233,20 @@ def gdkpixbuf2numpy(pixbuf):
     # return arr
 
 
+def rgb_array_to_gdkpixbuf(arr):
+    """Makes a new pixbuf from an array of 8-bit RGB pixels
+
+    :param numpy.ndarray arr: Pixel data, of shape (h, w, 3).
+    :rtype: GdkPixbuf.Pixbuf
+    :returns: A new pixbuf with a copy of the data, and no alpha.
+
+    """
+    h, w = arr.shape[0:2]
+    pixbuf = GdkPixbuf.Pixbuf.new(GdkPixbuf.Colorspace.RGB, False, 8, w, h)
+    gdkpixbuf2numpy(pixbuf)[...] = arr
+    return pixbuf
+
+
 def freedesktop_thumbnail(filename, pixbuf=None):
     """Fetch or (re-)generate the thumbnail in $XDG_CACHE_HOME/thumbnails.
 
@@ -461,6 +478,210 @@ def zipfile_writestr(z, arcname, data):
     z.writestr(zi, data)
 
 
+class ZipfileEntryWriter (object):
+    """Writable file-like object for streaming into a new zipfile entry
+
+    Data written to this object goes straight into the zipfile, without
+    being buffered in full or copied via a temporary file first. The
+    entry's header is finalized when the writer is closed.
+
+    >>> import tempfile, shutil
+    >>> tmpdir = tempfile.mkdtemp()
+    >>> zpath = os.path.join(tmpdir, "test.zip")
+    >>> with zipfile.ZipFile(zpath, "w") as z:
+    ...     with ZipfileEntryWriter(z, "hello.txt") as fp:
+    ...         fp.write("Hello, ")
+    ...         fp.write("world")
+    ...     zipfile_writestr(z, "after.txt", "!")
+    >>> with zipfile.ZipFile(zpath, "r") as z:
+    ...     z.read("hello.txt") + z.read("after.txt")
+    'Hello, world!'
+    >>> shutil.rmtree(tmpdir)
+
+    Nothing else may be written to the zipfile while a writer is open.
+    Like `zipfile_writestr()`, entries get standard permissions.
+
+    """
+
+    def __init__(self, z, arcname, compress_type=None):
+        """Starts a new entry
+
+        :param zipfile.ZipFile z: A zip file open for write.
+        :param unicode arcname: Name of the file entry to add.
+        :param int compress_type: Override for the zipfile's compression.
+
+        """
+        super(ZipfileEntryWriter, self).__init__()
+        if not z.fp:
+            raise RuntimeError(
+                "Attempt to write to ZIP archive that was already closed"
+            )
+        zi = zipfile.ZipInfo(arcname, time.localtime()[0:6])
+        zi.external_attr = 0o644 << 16  # wider perms, should match z.write()
+        zi.external_attr |= 0o100000 << 16  # regular file
+        if compress_type is None:
+            compress_type = z.compression
+        zi.compress_type = compress_type
+        zi.flag_bits = 0x00
+        zi.file_size = 0
+        zi.compress_size = 0
+        zi.CRC = 0
+        zi.header_offset = z.fp.tell()
+        z._writecheck(zi)
+        z._didModify = True
+        # The size isn't known yet, so the header size must not depend
+        # on it when it's rewritten later.
+        self._zip64 = z._allowZip64
+        z.fp.write(zi.FileHeader(self._zip64))
+        self._zip = z
+        self._zinfo = zi
+        self._compressor = None
+        if compress_type == zipfile.ZIP_DEFLATED:
+            self._compressor = zlib.compressobj(
+                zlib.Z_DEFAULT_COMPRESSION,
+                zlib.DEFLATED,
+                -15,
+            )
+
+    def write(self, data):
+        """Appends data to the entry"""
+        zi = self._zinfo
+        if zi is None:
+            raise ValueError("I/O operation on closed zipfile entry")
+        zi.file_size += len(data)
+        zi.CRC = zipfile.crc32(data, zi.CRC) & 0xffffffff
+        if self._compressor:
+            data = self._compressor.compress(data)
+        zi.compress_size += len(data)
+        self._zip.fp.write(data)
+
+    def writelines(self, seq):
+        """Appends each string in a sequence to the entry"""
+        for data in seq:
+            self.write(data)
+
+    def close(self):
+        """Finishes the entry, writing its final header"""
+        zi = self._zinfo
+        if zi is None:
+            return
+        self._zinfo = None
+        z = self._zip
+        if self._compressor:
+            data = self._compressor.flush()
+            zi.compress_size += len(data)
+            z.fp.write(data)
+        limit = zipfile.ZIP64_LIMIT
+        if not self._zip64 and max(zi.file_size, zi.compress_size) > limit:
+            raise zipfile.LargeZipFile("Zipfile size would require ZIP64")
+        position = z.fp.tell()
+        z.fp.seek(zi.header_offset, 0)
+        z.fp.write(zi.FileHeader(self._zip64))
+        z.fp.seek(position, 0)
+        z.filelist.append(zi)
+        z.NameToInfo[zi.filename] = zi
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def zipfile_writefp(z, arcname, fp, chunk_size=1024*1024):
+    """Copy a readable file object into a zipfile entry
+
+    :param zipfile.ZipFile z: A zip file open for write.
+    :param unicode arcname: Name of the file entry to add.
+    :param fp: File-like object to read from, from its current position.
+    :param int chunk_size: Maximum number of bytes to copy at once.
+
+    """
+    with ZipfileEntryWriter(z, arcname) as writer:
+        while True:
+            data = fp.read(chunk_size)
+            if not data:
+                break
+            writer.write(data)
+
+
+def zipfile_copy_member(src, info, z, arcname, chunk_size=1024*1024):
+    """Copy a member of one zipfile into another, without recompressing
+
+    :param zipfile.ZipFile src: A zip file open for reading.
+    :param zipfile.ZipInfo info: The member of src to copy.
+    :param zipfile.ZipFile z: A zip file open for write.
+    :param unicode arcname: Name of the new file entry to add.
+    :param int chunk_size: Maximum number of bytes to copy at once.
+
+    The member's compressed data is copied as it is, so this is about
+    as fast as copying a file. It is never decoded, and its CRC is not
+    checked.
+
+    >>> import tempfile, shutil
+    >>> tmpdir = tempfile.mkdtemp()
+    >>> zpath1 = os.path.join(tmpdir, "test1.zip")
+    >>> zpath2 = os.path.join(tmpdir, "test2.zip")
+    >>> with zipfile.ZipFile(zpath1, "w", zipfile.ZIP_DEFLATED) as z:
+    ...     zipfile_writestr(z, "hello.txt", "Hello, world!" * 10)
+    >>> with zipfile.ZipFile(zpath1, "r") as src:
+    ...     with zipfile.ZipFile(zpath2, "w") as z:
+    ...         info = src.getinfo("hello.txt")
+    ...         zipfile_copy_member(src, info, z, "copy.txt")
+    >>> with zipfile.ZipFile(zpath2, "r") as z:
+    ...     z.read("copy.txt") == "Hello, world!" * 10
+    True
+    >>> shutil.rmtree(tmpdir)
+
+    """
+    if info.flag_bits & 0x1:
+        raise RuntimeError("Cannot copy encrypted zipfile members")
+    if not z.fp:
+        raise RuntimeError(
+            "Attempt to write to ZIP archive that was already closed"
+        )
+    # Skip the source member's local header to find its data
+    src.fp.seek(info.header_offset, 0)
+    fheader = src.fp.read(zipfile.sizeFileHeader)
+    if len(fheader) != zipfile.sizeFileHeader:
+        raise zipfile.BadZipfile("Truncated file header")
+    fheader = struct.unpack(zipfile.structFileHeader, fheader)
+    if fheader[zipfile._FH_SIGNATURE] != zipfile.stringFileHeader:
+        raise zipfile.BadZipfile("Bad magic number for file header")
+    src.fp.seek(
+        fheader[zipfile._FH_FILENAME_LENGTH]
+        + fheader[zipfile._FH_EXTRA_FIELD_LENGTH],
+        1,
+    )
+    # Write the new entry's header, with the source's sizes and CRC
+    zi = zipfile.ZipInfo(arcname, info.date_time)
+    zi.external_attr = 0o644 << 16  # wider perms, should match z.write()
+    zi.external_attr |= 0o100000 << 16  # regular file
+    zi.compress_type = info.compress_type
+    zi.flag_bits = 0x00
+    zi.file_size = info.file_size
+    zi.compress_size = info.compress_size
+    zi.CRC = info.CRC
+    zi.header_offset = z.fp.tell()
+    z._writecheck(zi)
+    z._didModify = True
+    limit = zipfile.ZIP64_LIMIT
+    zip64 = max(zi.file_size, zi.compress_size) > limit
+    if zip64 and not z._allowZip64:
+        raise zipfile.LargeZipFile("Filesize would require ZIP64 extensions")
+    z.fp.write(zi.FileHeader(zip64))
+    # Copy the data
+    remaining = info.compress_size
+    while remaining > 0:
+        data = src.fp.read(min(chunk_size, remaining))
+        if not data:
+            raise zipfile.BadZipfile("Truncated zipfile member data")
+        remaining -= len(data)
+        z.fp.write(data)
+    z.filelist.append(zi)
+    z.NameToInfo[zi.filename] = zi
+
+
 def run_garbage_collector():
     logger.info('MEM: garbage collector run, collected %d objects',
                 gc.collect())
@@ -13,9 +13,321 @@
 from __future__ import division, print_function
 
 import collections
+import contextlib
+import logging
 
 from gi.repository import GLib
 
+logger = logging.getLogger(__name__)
+
+
+## Frame-synchronized scheduling
+
+
+class Scheduler (object):
+    """Time-sliced, frame-aware runner for background processors
+
+    All `Processor` queues share a scheduler, which runs their tasks
+    from a single low-priority idle source in bounded time slices.
+
+    The GUI informs the scheduler of each frame it draws with
+    `begin_frame()`, and measures its own input processing and
+    visible redraws with `timed()`. Each frame, those two activities
+    are guaranteed their budgets (more if they actually took longer),
+    and background tasks get whatever is left of the frame period.
+    When a frame has nothing left for background work, the background
+    work is deferred to the next frame, and this is counted in the
+    scheduler's statistics as starvation.
+
+    When no frames are being drawn, the same accounting is applied to
+    synthetic frames, but without the reserved budgets.
+
+    >>> t = [0.0]
+    >>> sched = Scheduler(clock=lambda: t[0])
+    >>> work = []
+    >>> def task():
+    ...     t[0] += 0.002
+    ...     work.append(t[0])
+    ...     return len(work) < 100
+    >>> sched.begin_frame(key=1)
+    >>> with sched.timed("redraw"):
+    ...     t[0] += 0.003
+    >>> round(sched.background_budget(), 4)
+    0.0067
+    >>> proc = Processor(scheduler=sched)
+    >>> proc.add_work(task)
+    >>> sched.run_slice()
+    True
+    >>> len(work)
+    4
+    >>> sched.background_budget() < sched.MIN_SLICE
+    True
+
+    Starved frames are counted when background work is pending, but
+    there is no time left for it.
+
+    >>> sched._idle_cb()
+    False
+    >>> sched.get_stats()["starved_frames"]
+    1
+    >>> proc.stop()
+
+    """
+
+    #: Expected time between frames, in seconds.
+    FRAME_PERIOD = 1 / 60
+
+    #: Time per frame reserved for input processing, in seconds.
+    INPUT_BUDGET = 0.004
+
+    #: Time per frame reserved for visible redraws, in seconds.
+    REDRAW_BUDGET = 0.006
+
+    #: Background slices shorter than this are not worth running.
+    MIN_SLICE = 0.0005
+
+    _INSTANCE = None
+
+    def __init__(self, priority=GLib.PRIORITY_LOW, clock=None):
+        """Initialize
+
+        :param int priority: GLib priority for the idle source
+        :param callable clock: override for the time source (seconds)
+
+        """
+        object.__init__(self)
+        if clock is None:
+            clock = lambda: GLib.get_monotonic_time() / 1e6
+        self._clock = clock
+        self._priority = priority
+        self._ready = {}   # {priority: deque([processor, ...])}
+        self._source_id = None
+        self._frame_key = None
+        self._frame_start = None
+        self._frame_input = 0.0
+        self._frame_redraw = 0.0
+        self._frame_background = 0.0
+        self._frame_starved = False
+        self._last_interactive = None
+        self._starved_since = None
+        self.reset_stats()
+
+    ## Statistics
+
+    def reset_stats(self):
+        """Resets the accumulated statistics."""
+        self._stats = collections.OrderedDict([
+            ("frames", 0),
+            ("input_time", 0.0),
+            ("redraw_time", 0.0),
+            ("background_time", 0.0),
+            ("background_slices", 0),
+            ("max_background_slice", 0.0),
+            ("starved_frames", 0),
+            ("starved_time", 0.0),
+        ])
+
+    def get_stats(self):
+        """Returns a copy of the accumulated statistics.
+
+        Times are in seconds. The ``starved_frames`` count is the number
+        of frames in which background work was pending but could not be
+        run, and ``starved_time`` is the total time it spent waiting as
+        a result.
+
+        """
+        return collections.OrderedDict(self._stats)
+
+    def format_stats(self):
+        """Returns the accumulated statistics as plain text."""
+        lines = []
+        for name, value in self._stats.items():
+            if isinstance(value, float):
+                value = "{:.3f}s".format(value)
+            lines.append("{:<22} {:>12}".format(name, value))
+        return "\n".join(lines)
+
+    ## Frame accounting
+
+    def begin_frame(self, key=None):
+        """Notifies the scheduler that a new frame is being drawn.
+
+        :param key: identifies the frame (repeat calls are ignored)
+
+        """
+        if key is not None and key == self._frame_key:
+            return
+        self._frame_key = key
+        self._stats["frames"] += 1
+        self._start_frame(self._clock())
+
+    def _start_frame(self, now):
+        self._frame_start = now
+        self._frame_input = 0.0
+        self._frame_redraw = 0.0
+        self._frame_background = 0.0
+        self._frame_starved = False
+
+    def _update_frame(self, now):
+        """Starts a synthetic frame if the current one has expired."""
+        start = self._frame_start
+        if start is None or now - start >= self.FRAME_PERIOD:
+            self._frame_key = None
+            self._start_frame(now)
+
+    def account(self, kind, seconds):
+        """Records time spent on interactive work in the current frame.
+
+        :param str kind: "input" or "redraw"
+        :param float seconds: time spent
+
+        """
+        now = self._clock()
+        self._update_frame(now)
+        self._last_interactive = now
+        if kind == "input":
+            self._frame_input += seconds
+        elif kind == "redraw":
+            self._frame_redraw += seconds
+        else:
+            raise ValueError("Unknown kind of interactive work %r" % (kind,))
+        self._stats[kind + "_time"] += seconds
+
+    @contextlib.contextmanager
+    def timed(self, kind):
+        """Context manager: measures and accounts interactive work."""
+        t0 = self._clock()
+        try:
+            yield
+        finally:
+            self.account(kind, self._clock() - t0)
+
+    def background_budget(self):
+        """Time left for background work in the current frame (seconds)"""
+        now = self._clock()
+        self._update_frame(now)
+        used = self._frame_background
+        last = self._last_interactive
+        if last is not None and now - last < 2 * self.FRAME_PERIOD:
+            used += max(self.INPUT_BUDGET, self._frame_input)
+            used += max(self.REDRAW_BUDGET, self._frame_redraw)
+        else:
+            used += self._frame_input + self._frame_redraw
+        period = self.FRAME_PERIOD
+        return min(period - used, self._frame_start + period - now)
+
+    ## Processor queue
+
+    def wake(self, processor):
+        """Marks a processor as having work, and starts running."""
+        queue = self._ready.setdefault(processor.priority, collections.deque())
+        if processor not in queue:
+            queue.append(processor)
+        self._arm()
+
+    def remove(self, processor):
+        """Forgets about a processor (does nothing if unknown)."""
+        queue = self._ready.get(processor.priority)
+        if queue is None:
+            return
+        try:
+            queue.remove(processor)
+        except ValueError:
+            pass
+
+    def has_work(self):
+        """True if any processor has work pending."""
+        return any(self._ready.values())
+
+    def _pop_ready(self):
+        for priority in sorted(self._ready):
+            queue = self._ready[priority]
+            if queue:
+                return queue.popleft()
+        return None
+
+    def run_slice(self, budget=None):
+        """Runs background tasks for up to a given time.
+
+        :param float budget: seconds (default: `background_budget()`)
+        :returns: whether any work remains
+        :rtype: bool
+
+        At least one task step is always run if there is work.
+
+        """
+        if budget is None:
+            budget = self.background_budget()
+        t0 = self._clock()
+        deadline = t0 + budget
+        while True:
+            processor = self._pop_ready()
+            if processor is None:
+                break
+            if processor._process():
+                self._ready[processor.priority].append(processor)
+            if self._clock() >= deadline:
+                break
+        elapsed = self._clock() - t0
+        self._frame_background += elapsed
+        self._stats["background_time"] += elapsed
+        self._stats["background_slices"] += 1
+        if elapsed > self._stats["max_background_slice"]:
+            self._stats["max_background_slice"] = elapsed
+        return self.has_work()
+
+    ## Main loop integration
+
+    def _arm(self):
+        if self._source_id is None and self.has_work():
+            self._source_id = GLib.idle_add(
+                self._idle_cb,
+                priority=self._priority,
+            )
+
+    def _idle_cb(self):
+        """Idle callback: run a slice, or wait for the next frame."""
+        now = self._clock()
+        budget = self.background_budget()
+        if budget < self.MIN_SLICE:
+            if not self._frame_starved:
+                self._frame_starved = True
+                self._stats["starved_frames"] += 1
+            if self._starved_since is None:
+                self._starved_since = now
+            wait = self._frame_start + self.FRAME_PERIOD - now
+            self._source_id = GLib.timeout_add(
+                max(1, int(wait * 1000)),
+                self._next_frame_timeout_cb,
+                priority=self._priority,
+            )
+            return False
+        if self._starved_since is not None:
+            self._stats["starved_time"] += now - self._starved_since
+            self._starved_since = None
+        more = False
+        try:
+            more = self.run_slice(budget)
+        finally:
+            if not more:
+                self._source_id = None
+        return more
+
+    def _next_frame_timeout_cb(self):
+        self._source_id = None
+        self._arm()
+        return False
+
+
+def get_scheduler():
+    """Returns the shared default Scheduler."""
+    if Scheduler._INSTANCE is None:
+        Scheduler._INSTANCE = Scheduler()
+    return Scheduler._INSTANCE
+
+
+## Task queues
+
 
 class Processor (object):
     """Queue of low priority tasks for background processing
@@ -24,15 +336,73 @@ class Processor (object):
     They run when GTK is idle, or on demand.
 
     The default priority is much lower than gui event processing.
+    Processing is done in time slices by a shared `Scheduler`, which
+    prefers processors with numerically lower priorities.
+
+    A task which raises an exception is logged and discarded, so it
+    cannot stop the rest of the queue from being processed.
+
+    >>> sched = Scheduler(clock=lambda: 0.0)
+    >>> proc = Processor(scheduler=sched)
+    >>> def broken_task():
+    ...     raise ValueError("broken")
+    >>> done = []
+    >>> proc.add_work(broken_task)
+    >>> proc.add_work(done.append, "ok")
+    >>> proc.finish_all()
+    >>> done
+    ['ok']
+    >>> sched.has_work()
+    False
+
+    Tasks which are waiting for other threads can pause the processor
+    instead of returning true over and over again. The waiting task is
+    called again once the processor is resumed. To let `finish_all()`
+    block instead of spinning, such tasks should have a ``wait()``
+    method.
+
+    >>> def waiting_task():
+    ...     if not done:
+    ...         proc.pause()
+    ...         return True
+    >>> done = []
+    >>> proc.add_work(waiting_task)
+    >>> sched.has_work()
+    True
+    >>> sched.run_slice()
+    False
+    >>> done.append(True)
+    >>> proc.resume()
+    >>> sched.run_slice()
+    False
+    >>> proc.has_work()
+    False
 
     """
 
-    def __init__(self, priority=GLib.PRIORITY_LOW):
-        """Initialize, specifying a priority"""
+    def __init__(self, priority=GLib.PRIORITY_LOW, scheduler=None):
+        """Initialize, specifying a priority
+
+        :param int priority: GLib-style priority (lower runs first)
+        :param Scheduler scheduler: scheduler (default: the shared one)
+
+        """
         object.__init__(self)
         self._queue = collections.deque()
         self._priority = priority
-        self._idle_id = None
+        self._scheduler = scheduler
+        self._scheduled = False
+        self._paused = False
+
+    @property
+    def priority(self):
+        return self._priority
+
+    @property
+    def scheduler(self):
+        if self._scheduler is None:
+            return get_scheduler()
+        return self._scheduler
 
     def has_work(self):
         return len(self._queue) > 0
@@ -49,41 +419,73 @@ class Processor (object):
         until it returns false, at which point it's discarded.
 
         """
-        if not self._idle_id:
-            self._idle_id = GLib.idle_add(
-                self._process,
-                priority=self._priority,
-            )
         self._queue.append((func, args, kwargs))
+        if not self._scheduled:
+            self._scheduled = True
+            self.scheduler.wake(self)
 
     def finish_all(self):
-        """Complete processing: finishes all queued tasks."""
-        while self._process():
-            pass
-        assert self._idle_id is None
+        """Complete processing: finishes all queued tasks.
+
+        Paused processors are run too. The ``wait()`` method of the
+        task at the head of the queue is called first, if it has one.
+
+        """
+        while self._scheduled and self._queue:
+            wait = getattr(self._queue[0][0], "wait", None)
+            if wait is not None:
+                wait()
+            self._process()
+        self._paused = False
+        assert not self._scheduled
         assert len(self._queue) == 0
 
+    def pause(self):
+        """Stops the scheduler running tasks until `resume()` is called
+
+        The queue is kept, and `finish_all()` still runs it.
+
+        """
+        if self._scheduled and not self._paused:
+            self.scheduler.remove(self)
+        self._paused = True
+
+    def resume(self):
+        """Lets the scheduler run tasks again after `pause()`"""
+        if not self._paused:
+            return
+        self._paused = False
+        if self._scheduled:
+            self.scheduler.wake(self)
+
     def iter_work(self):
         """Iterate across the queued tasks."""
         return iter(self._queue)
 
     def stop(self):
         """Immediately stop processing and clear the queue."""
-        if self._idle_id:
-            GLib.source_remove(self._idle_id)
-            self._idle_id = None
+        if self._scheduled:
+            self.scheduler.remove(self)
+            self._scheduled = False
+        self._paused = False
         self._queue.clear()
-        assert self._idle_id is None
+        assert not self._scheduled
         assert len(self._queue) == 0
 
     def _process(self):
-        if not self._idle_id:
+        if not self._scheduled:
             return False
         if len(self._queue) > 0:
             func, args, kwargs = self._queue[0]
-            func_done = bool(func(*args, **kwargs))
+            try:
+                func_done = bool(func(*args, **kwargs))
+            except Exception:
+                logger.exception("Background task %r failed", func)
+                func_done = False
             if not func_done:
                 self._queue.popleft()
         if len(self._queue) == 0:
-            self._idle_id = None
-        return bool(self._queue)
+            self._scheduled = False
+            self._paused = False
+            self.scheduler.remove(self)
+        return bool(self._queue) and not self._paused
@@ -644,6 +644,18 @@ class LayerBase (TileBlittable, TileCompositable):
         """
         return True
 
+    def get_unloaded_tiles(self):
+        """Returns the tiles whose pixels have yet to be loaded
+
+        :rtype: list
+
+        Rendering the layer loads these tiles' pixels first, which can
+        take a while. Reading each tile's `rgba` from a worker thread
+        loads them in the background. Always empty in the base
+        implementation.
+        """
+        return []
+
     def get_paintable(self):
         """True if this layer currently accepts painting brushstrokes
 
@@ -13,7 +13,6 @@
 ## Imports
 from __future__ import division, print_function
 
-import zlib
 import logging
 import os
 from cStringIO import StringIO
@@ -25,6 +24,10 @@ from random import randint
 import uuid
 import struct
 import contextlib
+import zipfile
+import collections
+import threading
+import weakref
 
 from lib.gettext import C_
 from lib.tiledsurface import N
@@ -39,6 +42,8 @@ import lib.layer.error
 import lib.autosave
 import lib.xml
 import lib.feedback
+import lib.idletask
+import lib.workerpool
 
 import numpy as np
 
@@ -89,6 +94,9 @@ class SurfaceBackedLayer (core.LayerBase, lib.autosave.Autosaveable):
         else:
             self._surface = surface
 
+        # Tracks changes since the layer's PNG was last queued for autosave
+        self._autosave_tracker = None
+
     @classmethod
     def new_from_surface_backed_layer(cls, src):
         """Clone from another SurfaceBackedLayer
@@ -176,16 +184,35 @@ class SurfaceBackedLayer (core.LayerBase, lib.autosave.Autosaveable):
             src,
             progress,
             x, y,
+            **kwargs
         )
 
     def _load_surface_from_orazip_member(self, orazip, cache_dir,
-                                         src, progress, x, y):
+                                         src, progress, x, y,
+                                         png_decoder=None, **kwargs):
         """Loads the surface from a member of an OpenRaster zipfile
 
         Intended strictly for override by subclasses which need to first
         extract and then keep the file around afterwards.
 
+        PNG members are decoded progressively straight into the
+        layer's surface, one row of tiles at a time, or picked up from
+        an `OpenRasterPNGDecoder` which has already decoded them in the
+        background. Other formats are loaded via GdkPixbuf.
+
         """
+        if png_decoder is not None:
+            surface = png_decoder.take_surface(src, x, y)
+            if surface is not None:
+                self._surface.take_tiles(surface)
+                if progress:
+                    progress.items = 1
+                    progress.close()
+                return
+        if os.path.splitext(src)[1].lower() == ".png":
+            _load_orazip_png(self._surface, orazip, src, x, y,
+                             progress=progress)
+            return
         pixbuf = lib.pixbuf.load_from_zipfile(
             datazip=orazip,
             filename=src,
@@ -315,6 +342,10 @@ class SurfaceBackedLayer (core.LayerBase, lib.autosave.Autosaveable):
         """Tests whether the surface is empty"""
         return self._surface.is_empty()
 
+    def get_unloaded_tiles(self):
+        """Returns the surface's tiles whose pixels have yet to be loaded"""
+        return self._surface.get_unloaded_tiles()
+
     ## Flood fill
 
     def flood_fill(self, x, y, color, bbox, tolerance, dst_layer=None):
@@ -451,6 +482,13 @@ class SurfaceBackedLayer (core.LayerBase, lib.autosave.Autosaveable):
         png_relpath = os.path.join("data", png_basename)
         png_path = os.path.join(oradir, png_relpath)
         png_bbox = self._surface.looped and bbox or tuple(self.get_bbox())
+        tracker = self._autosave_tracker
+        if self.autosave_dirty and tracker and not self._surface.looped:
+            # The dirty flag is set by edits which may leave the tiles
+            # as they were, like an undone stroke. Only rewrite the PNG
+            # if some tiles really changed.
+            if not tracker.get_changed():
+                self.autosave_dirty = False
         if self.autosave_dirty or not os.path.exists(png_path):
             task = tiledsurface.PNGFileUpdateTask(
                 surface = self._surface,
@@ -461,6 +499,7 @@ class SurfaceBackedLayer (core.LayerBase, lib.autosave.Autosaveable):
             )
             taskproc.add_work(task)
             self.autosave_dirty = False
+            self._autosave_tracker = self._surface.track_changes()
         # Calculate appropriate offsets
         png_x, png_y = png_bbox[0:2]
         ref_x, ref_y = bbox[0:2]
@@ -483,19 +522,36 @@ class SurfaceBackedLayer (core.LayerBase, lib.autosave.Autosaveable):
         return "".join([prefix, sep, path_ref, suffix])
 
     def _save_rect_to_ora(self, orazip, tmpdir, prefix, path,
-                          frame_bbox, rect, progress=None, **kwargs):
+                          frame_bbox, rect, progress=None,
+                          png_encoder=None, ora_copier=None,
+                          tile_cache_writer=None, **kwargs):
         """Internal: saves a rectangle of the surface to an ORA zip"""
-        # Write PNG data via a tempfile
         pngname = self._make_refname(prefix, path, ".png")
-        pngpath = os.path.join(tmpdir, pngname)
-        t0 = time.time()
-        self._surface.save_as_png(pngpath, *rect, progress=progress, **kwargs)
-        t1 = time.time()
-        logger.debug('%.3fs surface saving %r', t1 - t0, pngname)
-        # Archive and remove
         storepath = "data/%s" % (pngname,)
-        orazip.write(pngpath, storepath)
-        os.remove(pngpath)
+        sshot = self._surface.save_snapshot()
+        if self._copy_unchanged_ora_png(orazip, ora_copier, "png",
+                                        storepath, rect, kwargs):
+            if progress:
+                progress.items = 1
+                progress.close()
+        elif png_encoder is not None:
+            # Encode a frozen copy in the background
+            surface = self._surface
+            if not surface.looped:
+                surface = tiledsurface.Surface()
+                surface.load_snapshot(sshot)
+            png_encoder.submit(surface, rect, storepath, **kwargs)
+            if progress:
+                progress.items = 1
+                progress.close()
+        else:
+            # Write PNG data straight into the zipfile
+            t0 = time.time()
+            with helpers.ZipfileEntryWriter(orazip, storepath) as fp:
+                self._surface.save_as_png(fp, *rect, progress=progress,
+                                          **kwargs)
+            t1 = time.time()
+            logger.debug('%.3fs surface saving %r', t1 - t0, pngname)
         # Return details
         png_bbox = tuple(rect)
         png_x, png_y = png_bbox[0:2]
@@ -503,10 +559,49 @@ class SurfaceBackedLayer (core.LayerBase, lib.autosave.Autosaveable):
         x = png_x - ref_x
         y = png_y - ref_y
         assert (x == y == 0) or not self._surface.looped
+        if tile_cache_writer and not self._surface.looped:
+            tile_cache_writer.add(storepath, x, y, sshot, -ref_x, -ref_y)
         elem = self._get_stackxml_element("layer", x, y)
         elem.attrib["src"] = storepath
         return elem
 
+    def _copy_unchanged_ora_png(self, orazip, ora_copier, key,
+                                storepath, rect, kwargs):
+        """Internal: reuses a PNG from the previous save if possible
+
+        :param zipfile.ZipFile orazip: OpenRaster zipfile being written.
+        :param OpenRasterMemberCopier ora_copier: Copier, or None.
+        :param str key: What the PNG is for, for the copier.
+        :param unicode storepath: Name of the member to write.
+        :param tuple rect: Rectangle of the surface being saved.
+        :param dict kwargs: The keyword args for save_as_png().
+        :returns: True if the PNG was copied
+        :rtype: bool
+
+        If the PNG is not copied, it is recorded as being written
+        afresh, so the caller must go on to write it. The surface's
+        changes are tracked from now on, ready for the next save.
+
+        """
+        if ora_copier is None:
+            return False
+        params = (tuple(rect), sorted(kwargs.items()))
+        prev_state = ora_copier.get_previous_state(self, key)
+        state = (params, self._surface.track_changes())
+        if prev_state is not None:
+            prev_params, prev_tracker = prev_state
+            unchanged = (
+                prev_params == params
+                and prev_tracker.tilemap is self._surface.tiledict
+                and not prev_tracker.get_changed()
+            )
+            if unchanged:
+                ora_copier.copy(orazip, self, key, storepath, state)
+                logger.debug("Copied unchanged %r", storepath)
+                return True
+        ora_copier.record(self, key, storepath, state)
+        return False
+
     ## Painting symmetry axis
 
     def set_symmetry_state(self, active, center_x, center_y,
@@ -677,7 +772,7 @@ class FileBackedLayer (SurfaceBackedLayer, core.ExternallyEditable):
         raise NotImplementedError
 
     def _load_surface_from_orazip_member(self, orazip, cache_dir,
-                                         src, progress, x, y):
+                                         src, progress, x, y, **kwargs):
         """Loads the surface from a member of an OpenRaster zipfile
 
         This override retains a managed copy of the extracted file in
@@ -1010,6 +1105,643 @@ class _ManagedFile (object):
                          file_path)
 
 
+class OpenRasterPNGDecoder (object):
+    """Decodes the PNG layers of an OpenRaster zipfile in parallel
+
+    Decoding is by far the slowest part of opening an OpenRaster file
+    with many layers. Given the parsed stack.xml, this starts decoding
+    every PNG layer into a standalone surface, using the shared worker
+    pool. Each worker opens its own handle on the zipfile, so members
+    are read independently. The layers built afterwards in stack order
+    pick up their surfaces with `take_surface()`, and only need to wait
+    if their decode is still running. At most `MAX_PENDING` decoded
+    surfaces are held at once, so memory use doesn't grow with the
+    number of layers.
+
+    Pass an instance to the layer loaders in the "png_decoder" keyword
+    argument. Layers which aren't found in it are loaded as usual.
+
+    Layers held by a valid `lib.tilecache.TileCache` for the file are
+    not decoded at all. Their surfaces come from the cache instead, and
+    load their tiles lazily.
+
+    Hidden layers, and layers outside the visible area if one is given,
+    are deferred: their surfaces get placeholder tiles covering the
+    size in the PNG header, so their bboxes are right straight away.
+    The PNG is decoded the first time any of its tiles' pixels are
+    needed, for example when the layer is shown or saved.
+
+    >>> import xml.etree.ElementTree as ET
+    >>> pool = lib.workerpool.WorkerPool(1)
+    >>> orazip = zipfile.ZipFile("tests/bigimage.ora")
+    >>> stack_elem = ET.fromstring(orazip.read("stack.xml")).find("stack")
+    >>> decoder = OpenRasterPNGDecoder(orazip, pool=pool)
+    >>> decoder.submit_stack(stack_elem)
+    >>> len(decoder._futures), len(decoder._queue)
+    (8, 7)
+
+    Layers taken out of stack order are decoded straight away, without
+    waiting for the others. Either way, the pixels are the same as for
+    a plain sequential decode, and no more than `MAX_PENDING` decodes
+    are ever in flight.
+
+    >>> keys = [
+    ...     (e.attrib["src"], int(e.attrib["x"]), int(e.attrib["y"]))
+    ...     for e in stack_elem.findall("layer")[:-1]
+    ... ]
+    >>> for src, x, y in keys[-1:] + keys[:-1]:
+    ...     surface = decoder.take_surface(src, x, y)
+    ...     assert len(decoder._futures) <= 8
+    ...     ref = tiledsurface.Surface()
+    ...     with contextlib.closing(orazip.open(src)) as fp:
+    ...         ref.load_from_png_file(fp, x, y, convert_to_srgb=False)
+    ...     assert sorted(surface.tiledict) == sorted(ref.tiledict)
+    ...     for pos, tile in surface.tiledict.iteritems():
+    ...         assert (tile.rgba == ref.tiledict[pos].rgba).all(), src
+    >>> decoder.close()
+    >>> orazip.close()
+    >>> pool.shutdown()
+
+    """
+
+    #: Maximum number of submitted decodes not yet taken by a layer.
+    MAX_PENDING = 8
+
+    #: How often progress is reported while waiting for a decode (s).
+    PROGRESS_INTERVAL = 0.1
+
+    def __init__(self, orazip, pool=None, tile_cache=None,
+                 cache_writer=None):
+        """Initialize, with nothing queued
+
+        :param zipfile.ZipFile orazip: OpenRaster zipfile being loaded.
+        :param lib.workerpool.WorkerPool pool: Pool to use for decoding.
+        :param lib.tilecache.TileCache tile_cache: Cached layer data.
+        :param lib.tilecache.TileCacheWriter cache_writer: Gets a
+            snapshot of each decoded surface, for caching it.
+
+        """
+        super(OpenRasterPNGDecoder, self).__init__()
+        self._filename = orazip.filename
+        if pool is None:
+            pool = lib.workerpool.get_pool()
+        self._pool = pool
+        self._max_pending = max(self.MAX_PENDING, 2 * pool.nworkers)
+        self._queue = collections.OrderedDict()  # {(src, x, y): None}
+        self._futures = {}  # {(src, x, y): Future}
+        self._unreported = []  # [Future]
+        self._progress = None
+        self._tile_cache = tile_cache
+        self._cache_writer = cache_writer
+        self._orazip = orazip
+        self._deferred = {}  # {(src, x, y): (w, h)}
+
+    def submit_stack(self, elem, x=0, y=0, visible_bbox=None,
+                     progress=None):
+        """Starts decoding the PNG layers in a <stack/>, recursively
+
+        :param elem: <stack/> element to scan (stack.xml)
+        :type elem: xml.etree.ElementTree.Element
+        :param int x: X offset of the stack's parent
+        :param int y: Y offset of the stack's parent
+        :param tuple visible_bbox: Area shown first, as (x, y, w, h).
+        :param progress: Unsized UI feedback object for the decoding.
+        :type progress: lib.feedback.Progress or None
+
+        Offsets are accumulated in the same way as the layer loaders
+        do, so that `take_surface()` can match up the decoded data.
+        Layers are decoded in stack order, which is the order the
+        loaders take them in. The progress object is advanced as
+        decodes complete, by `take_surface()`, and closed by `close()`.
+
+        """
+        if self._filename is not None:
+            self._submit_stack(elem, x, y, visible_bbox, False)
+        if progress:
+            progress.items = len(self._queue)
+            self._progress = progress
+        self._submit_queued()
+
+    def _submit_stack(self, elem, x, y, visible_bbox, hidden):
+        """Internal: recursive part of submit_stack()"""
+        x += int(elem.attrib.get("x", 0))
+        y += int(elem.attrib.get("y", 0))
+        hidden = hidden or _is_hidden_in_stackxml(elem)
+        for child_elem in elem.findall("./*"):
+            if child_elem.tag == "stack":
+                self._submit_stack(child_elem, x, y, visible_bbox, hidden)
+                continue
+            attrs = child_elem.attrib
+            if (BackgroundLayer.ORA_BGTILE_ATTR in attrs or
+                    BackgroundLayer.ORA_BGTILE_LEGACY_ATTR in attrs):
+                continue
+            src = attrs.get("src", None)
+            if not src or os.path.splitext(src)[1].lower() != ".png":
+                continue
+            layer_x = x + int(attrs.get("x", 0))
+            layer_y = y + int(attrs.get("y", 0))
+            key = (src, layer_x, layer_y)
+            if key in self._queue or key in self._deferred:
+                continue
+            if self._tile_cache and self._tile_cache.has_surface(*key):
+                continue
+            defer = hidden or _is_hidden_in_stackxml(child_elem)
+            if defer or visible_bbox:
+                size = _get_orazip_png_size(self._orazip, src)
+                if size is None or size[0] * size[1] <= N * N:
+                    # Small enough to tell if it's empty by decoding.
+                    defer = False
+                elif not defer:
+                    rect = helpers.Rect(layer_x, layer_y, *size)
+                    defer = not rect.overlaps(helpers.Rect(*visible_bbox))
+                if defer:
+                    self._deferred[key] = size
+                    continue
+            self._queue[key] = None
+
+    def _submit_queued(self):
+        """Starts decoding queued layers, up to the pending limit"""
+        while self._queue and len(self._futures) < self._max_pending:
+            key, junk = self._queue.popitem(last=False)
+            self._futures[key] = self._submit(key)
+
+    def _submit(self, key):
+        """Starts decoding a layer, returning its Future"""
+        future = self._pool.submit(_decode_orazip_png, self._filename, *key)
+        if self._progress:
+            self._unreported.append(future)
+        return future
+
+    def _report_progress(self):
+        """Advances the progress object by the newly completed decodes"""
+        if not self._progress:
+            return
+        ndone = 0
+        unreported = []
+        for future in self._unreported:
+            if future.done():
+                ndone += 1
+            else:
+                unreported.append(future)
+        self._unreported = unreported
+        if ndone:
+            self._progress += ndone
+
+    def take_surface(self, src, x, y):
+        """Gets the decoded surface for a layer, waiting if needed
+
+        :param unicode src: Zipfile member name of the layer's PNG
+        :param int x: Position of the layer data
+        :param int y: Position of the layer data
+        :returns: The decoded surface, or None if it wasn't submitted
+        :rtype: lib.tiledsurface.Surface
+
+        Exceptions raised while decoding are re-raised here.
+
+        """
+        size = self._deferred.pop((src, x, y), None)
+        if size is not None:
+            datafp, info = lib.pixbuf.open_zipfile_member(self._orazip, src)
+            with contextlib.closing(datafp):
+                data = datafp.read()
+            return _DeferredPNG(data, src, x, y).make_surface(*size)
+        key = (src, x, y)
+        future = self._futures.pop(key, None)
+        if future is None and key in self._queue:
+            # Taken out of stack order: don't wait for the others.
+            del self._queue[key]
+            future = self._submit(key)
+        if future is None:
+            if self._tile_cache:
+                return self._tile_cache.get_surface(src, x, y)
+            return None
+        self._submit_queued()
+        if self._progress:
+            while not future.wait(self.PROGRESS_INTERVAL):
+                self._report_progress()
+        self._report_progress()
+        surface = future.result()
+        if self._cache_writer:
+            self._cache_writer.add(src, x, y, surface.save_snapshot())
+        return surface
+
+    def close(self):
+        """Drops any decodes which weren't taken, and closes progress
+
+        Call this once the layers have been loaded.
+
+        """
+        self._queue.clear()
+        self._futures.clear()
+        self._unreported = []
+        if self._progress:
+            self._progress.close()
+        self._progress = None
+
+
+class OpenRasterPNGEncoder (object):
+    """Encodes the PNG layers of an OpenRaster zipfile in parallel
+
+    Saving the layers of a big document is dominated by PNG encoding.
+    Layers submit frozen copies of their surfaces to this object instead
+    of saving them directly, and carry on. The PNGs are encoded into
+    memory buffers by the shared worker pool, and the finished data is
+    streamed into the zipfile in the order it was submitted, which is
+    stack order. Buffers bigger than `SPOOL_SIZE` spill to temporary
+    files, and at most `MAX_PENDING` of them are held at once.
+
+    Pass an instance to the layer savers in the "png_encoder" keyword
+    argument, then call `finish()` before closing the zipfile.
+
+    """
+
+    #: Size of PNG data kept in memory before spilling to a tempfile.
+    SPOOL_SIZE = 32 * 1024 * 1024
+
+    #: Maximum number of submitted PNGs not yet written to the zipfile.
+    MAX_PENDING = 8
+
+    def __init__(self, orazip, tmpdir, pool=None):
+        """Initialize, with nothing queued
+
+        :param zipfile.ZipFile orazip: OpenRaster zipfile being written.
+        :param unicode tmpdir: Where to spill big PNGs to temporarily.
+        :param lib.workerpool.WorkerPool pool: Pool to use for encoding.
+
+        """
+        super(OpenRasterPNGEncoder, self).__init__()
+        self._orazip = orazip
+        self._tmpdir = tmpdir
+        if pool is None:
+            pool = lib.workerpool.get_pool()
+        self._pool = pool
+        self._max_pending = max(self.MAX_PENDING, 2 * pool.nworkers)
+        self._queue = collections.deque()  # [(storepath, Future)]
+        self._submitted = 0
+        self._written = 0
+        self._progress = None
+
+    def submit(self, surface, rect, storepath, **kwargs):
+        """Starts encoding a rectangle of a surface as a PNG
+
+        :param lib.tiledsurface.MyPaintSurface surface: Surface to save.
+        :param tuple rect: Rectangle (x, y, w, h) to save.
+        :param unicode storepath: Name of the member in the zipfile.
+        :param \*\*kwargs: Passed to the surface's save_as_png().
+
+        The surface is read from a worker thread, so it must not be
+        changed until the PNG has been written.
+
+        """
+        if len(self._queue) >= self._max_pending:
+            self._write_finished(wait=True, limit=1)
+        buf = tempfile.SpooledTemporaryFile(
+            max_size=self.SPOOL_SIZE,
+            dir=self._tmpdir,
+        )
+        future = self._pool.submit(
+            _encode_surface_png,
+            surface, buf, rect, kwargs,
+        )
+        self._queue.append((storepath, future))
+        self._submitted += 1
+        self._write_finished(wait=False)
+
+    def finish(self, progress=None):
+        """Waits for all PNGs, and writes them to the zipfile
+
+        :param progress: Unsized UI feedback object.
+        :type progress: lib.feedback.Progress or None
+
+        """
+        if progress:
+            progress.items = self._submitted
+            progress += self._written
+        self._progress = progress
+        self._write_finished(wait=True)
+        if progress:
+            progress.close()
+        self._progress = None
+
+    def _write_finished(self, wait, limit=None):
+        """Archives finished PNGs, in submission order"""
+        while self._queue and (limit is None or limit > 0):
+            storepath, future = self._queue[0]
+            if not (wait or future.done()):
+                break
+            self._queue.popleft()
+            with contextlib.closing(future.result()) as buf:
+                buf.seek(0)
+                helpers.zipfile_writefp(self._orazip, storepath, buf)
+            self._written += 1
+            if limit is not None:
+                limit -= 1
+            if self._progress:
+                self._progress += 1
+
+
+class OpenRasterMemberCopier (object):
+    """Reuses unchanged data from the previous save of an OpenRaster file
+
+    When a document is saved again over the file it was last saved to,
+    most layers are usually unchanged since then. Their members in the
+    old zipfile can be copied into the new one as they are, without
+    rendering, encoding, or even decompressing anything.
+
+    Savers record the state each member was written from, and where,
+    under the layer and a key naming the member's purpose. In the next
+    save, they look up the state recorded last time, and if the data
+    still matches it, they copy the old member instead of writing it
+    afresh. Pass an instance to the layer savers in the "ora_copier"
+    keyword argument, then `close()` it when the new zipfile is
+    complete. Keep it to pass as `previous` next time.
+
+    Records are only held while their layers exist, so the states
+    should not refer to the layers or their data strongly: a
+    `lib.tiledsurface._ChangeTracker`, for example, not a snapshot.
+
+    """
+
+    def __init__(self, previous=None, prev_orazip=None):
+        """Initialize, with nothing recorded
+
+        :param OpenRasterMemberCopier previous: Copier of the last save.
+        :param zipfile.ZipFile prev_orazip: The file the last save wrote.
+
+        Nothing is copied unless both are given. The copier takes
+        ownership of prev_orazip, and closes it in `close()`.
+
+        """
+        super(OpenRasterMemberCopier, self).__init__()
+        self._records = weakref.WeakKeyDictionary()
+        # {layer: {key: (storepath, state)}}
+        self._stack_xml = None
+        self._copied = set()
+        self._rewritten = False
+        self._prev_records = weakref.WeakKeyDictionary()
+        self._prev_stack_xml = None
+        self._prev_orazip = None
+        if previous is not None and prev_orazip is not None:
+            self._prev_records = previous._records
+            self._prev_stack_xml = previous._stack_xml
+            self._prev_orazip = prev_orazip
+        elif prev_orazip is not None:
+            prev_orazip.close()
+
+    @property
+    def prev_orazip(self):
+        """The zipfile written by the previous save, or None"""
+        return self._prev_orazip
+
+    def get_previous_state(self, layer, key):
+        """Gets the state a member was saved from last time
+
+        :param SurfaceBackedLayer layer: The layer saving the member.
+        :param str key: What the member is for, e.g. "png".
+        :returns: The state recorded, or None if it can't be copied.
+
+        """
+        if self._prev_orazip is None:
+            return None
+        record = self._prev_records.get(layer, {}).get(key)
+        if record is None:
+            return None
+        return record[1]
+
+    def copy(self, orazip, layer, key, storepath, state):
+        """Copies a member from the previous save, recording it again
+
+        :param zipfile.ZipFile orazip: OpenRaster zipfile being written.
+        :param SurfaceBackedLayer layer: The layer saving the member.
+        :param str key: What the member is for, as for the lookup.
+        :param unicode storepath: Name of the member in orazip.
+        :param state: The state to record for the member in this save.
+
+        Only call this after checking that the layer's data still
+        matches the state from `get_previous_state()`.
+
+        """
+        prev_storepath, prev_state = self._prev_records[layer][key]
+        info = self._prev_orazip.getinfo(prev_storepath)
+        helpers.zipfile_copy_member(self._prev_orazip, info,
+                                    orazip, storepath)
+        self._copied.add(storepath)
+        self._records.setdefault(layer, {})[key] = (storepath, state)
+
+    def record(self, layer, key, storepath, state):
+        """Records the state a member of this save was written from
+
+        :param SurfaceBackedLayer layer: The layer saving the member.
+        :param str key: What the member is for, e.g. "png".
+        :param unicode storepath: Name of the member in the zipfile.
+        :param state: Anything, for the saver to compare next time.
+
+        Call this for members which were written afresh.
+
+        """
+        self._records.setdefault(layer, {})[key] = (storepath, state)
+        self._rewritten = True
+
+    def is_copied(self, storepath):
+        """True if a member of the new zipfile was copied by this copier"""
+        return storepath in self._copied
+
+    def copy_previews(self, orazip, stack_xml, names):
+        """Copies preview images if the whole image is unchanged
+
+        :param zipfile.ZipFile orazip: OpenRaster zipfile being written.
+        :param str stack_xml: Contents of the new stack.xml.
+        :param list names: Members derived from everything else.
+        :returns: True if the previews were copied
+        :rtype: bool
+
+        The previews can only be copied if everything written so far
+        was copied, and the new stack.xml is the same as the old one.
+        Call this once the layers have been saved, or queued for saving.
+
+        """
+        self._stack_xml = stack_xml
+        if self._prev_orazip is None or self._rewritten:
+            return False
+        if stack_xml != self._prev_stack_xml:
+            return False
+        written = set(orazip.namelist())
+        written.discard("mimetype")
+        if not written.issubset(self._copied):
+            return False
+        for name in names:
+            info = self._prev_orazip.getinfo(name)
+            helpers.zipfile_copy_member(self._prev_orazip, info,
+                                        orazip, name)
+            self._copied.add(name)
+        return True
+
+    def close(self):
+        """Closes the previous save's zipfile, and forgets its records
+
+        What was copied into the new zipfile is still remembered.
+
+        """
+        if self._prev_orazip is not None:
+            self._prev_orazip.close()
+        self._prev_orazip = None
+        self._prev_records = weakref.WeakKeyDictionary()
+        self._prev_stack_xml = None
+
+
+def _encode_surface_png(surface, buf, rect, kwargs):
+    """Worker: saves a rectangle of a surface as PNG data in a buffer"""
+    t0 = time.time()
+    try:
+        surface.save_as_png(buf, *rect, **kwargs)
+    except:
+        buf.close()
+        raise
+    logger.debug("%.3fs surface encoding", time.time() - t0)
+    return buf
+
+
+class _DeferredPNG (object):
+    """Layer PNG data whose decoding is put off until it's needed
+
+    Holds the compressed PNG data, read from the zipfile when the
+    layer was loaded. This keeps the layer valid even if the file is
+    overwritten afterwards, by saving over it for example.
+
+    If the data can't be decoded, every attempt to read the layer's
+    pixels raises `lib.layer.error.DeferredLoadingFailed`, so the layer
+    is never taken to be empty, and can't be saved.
+
+    """
+
+    def __init__(self, data, src, x, y):
+        super(_DeferredPNG, self).__init__()
+        self._data = data
+        self._src = src
+        self._x = x
+        self._y = y
+        self._lock = threading.Lock()
+        self._tiledict = None
+        #: Why decoding failed, or None.
+        self.error = None
+
+    def make_surface(self, w, h):
+        """Makes a surface with placeholder tiles covering the PNG
+
+        :param int w: Width of the PNG, from its header.
+        :param int h: Height of the PNG, from its header.
+        :rtype: lib.tiledsurface.Surface
+
+        """
+        tx0 = self._x // N
+        ty0 = self._y // N
+        tx1 = (self._x + w - 1) // N
+        ty1 = (self._y + h - 1) // N
+        tiledict = {}
+        for ty in xrange(ty0, ty1 + 1):
+            for tx in xrange(tx0, tx1 + 1):
+                record = _DeferredTileRecord(self, tx, ty)
+                tiledict[(tx, ty)] = tiledsurface._Tile.new_unloaded(record)
+        surface = tiledsurface.Surface()
+        surface._load_tiledict(tiledict)
+        return surface
+
+    def load_tile(self, record):
+        """Gets the pixels for a placeholder tile (any thread)"""
+        with self._lock:
+            if record.rgba is None:
+                if self.error is not None:
+                    raise lib.layer.error.DeferredLoadingFailed(self.error)
+                if self._tiledict is None:
+                    self._tiledict = self._decode()
+                tile = self._tiledict.pop((record.tx, record.ty), None)
+                if tile is None:
+                    record.rgba = np.zeros((N, N, 4), 'uint16')
+                else:
+                    record.rgba = tile.rgba
+            return record.rgba
+
+    def _decode(self):
+        """Decodes the PNG data into a new tiledict"""
+        t0 = time.time()
+        surface = tiledsurface.Surface()
+        try:
+            _load_png(surface, StringIO(self._data), self._x, self._y)
+        except Exception as e:
+            logger.exception("Failed to decode deferred %r", self._src)
+            self.error = "Cannot decode %s: %s" % (self._src, e)
+            raise lib.layer.error.DeferredLoadingFailed(self.error)
+        finally:
+            self._data = None
+        logger.debug("%.3fs decoding deferred %r",
+                     time.time() - t0, self._src)
+        return dict(surface.tiledict)
+
+
+class _DeferredTileRecord (object):
+    """Placeholder tile's record, which decodes its layer's PNG"""
+
+    __slots__ = ("png", "tx", "ty", "rgba")
+
+    def __init__(self, png, tx, ty):
+        self.png = png
+        self.tx = tx
+        self.ty = ty
+        self.rgba = None
+
+    def load(self):
+        """Returns the tile's pixels, decoding the PNG if needed"""
+        return self.png.load_tile(self)
+
+
+def _is_hidden_in_stackxml(elem):
+    """True if a stack.xml element is marked as hidden"""
+    return elem.attrib.get("visibility", "visible").lower() == "hidden"
+
+
+def _get_orazip_png_size(orazip, src):
+    """Reads the size of a zipfile member PNG from its header
+
+    :returns: (width, height), or None if the header isn't valid
+    :rtype: tuple
+
+    """
+    datafp, info = lib.pixbuf.open_zipfile_member(orazip, src)
+    with contextlib.closing(datafp):
+        header = datafp.read(24)
+    if len(header) < 24 or header[:8] != b"\x89PNG\r\n\x1a\n":
+        return None
+    if header[12:16] != b"IHDR":
+        return None
+    return struct.unpack(">II", header[16:24])
+
+
+def _load_png(surface, fp, x, y, progress=None):
+    """Decodes a layer PNG from a file object into a surface"""
+    # Like GdkPixbuf, don't colour-manage the layer data.
+    surface.load_from_png_file(
+        fp,
+        x, y,
+        progress=progress,
+        convert_to_srgb=False,
+    )
+
+
+def _load_orazip_png(surface, orazip, src, x, y, progress=None):
+    """Decodes a zipfile member PNG into a surface"""
+    datafp, info = lib.pixbuf.open_zipfile_member(orazip, src)
+    with contextlib.closing(datafp):
+        _load_png(surface, datafp, x, y, progress=progress)
+
+
+def _decode_orazip_png(filename, src, x, y):
+    """Worker: decodes a zipfile member PNG into a new surface"""
+    surface = tiledsurface.Surface()
+    with zipfile.ZipFile(filename) as orazip:
+        _load_orazip_png(surface, orazip, src, x, y)
+    return surface
+
+
 ## Data layer classes
 
 
@@ -1057,7 +1789,9 @@ class BackgroundLayer (SurfaceBackedLayer):
 
     def save_to_openraster(self, orazip, tmpdir, path,
                            canvas_bbox, frame_bbox,
-                           progress=None, **kwargs):
+                           progress=None, png_encoder=None,
+                           ora_copier=None, tile_cache_writer=None,
+                           **kwargs):
 
         if not progress:
             progress = lib.feedback.Progress()
@@ -1069,30 +1803,31 @@ class BackgroundLayer (SurfaceBackedLayer):
             orazip, tmpdir, "background", path,
             frame_bbox, frame_bbox,
             progress=progress.open(),
+            png_encoder=png_encoder,
+            ora_copier=ora_copier,
+            tile_cache_writer=tile_cache_writer,
             **kwargs
         )
 
         # Item 2: also save as single pattern (with corrected origin)
         x0, y0 = frame_bbox[0:2]
         x, y, w, h = self.get_bbox()
+        tile_rect = (x + x0, y + y0, w, h)
 
         pngname = self._make_refname("background", path, "tile.png")
-        tmppath = os.path.join(tmpdir, pngname)
-        t0 = time.time()
-        self._surface.save_as_png(
-            tmppath,
-            x=x + x0,
-            y=y + y0,
-            w=w,
-            h=h,
-            progress=progress.open(),
-            **kwargs
-        )
-        t1 = time.time()
         storename = 'data/%s' % (pngname,)
-        logger.debug('%.3fs surface saving %s', t1 - t0, storename)
-        orazip.write(tmppath, storename)
-        os.remove(tmppath)
+        if not self._copy_unchanged_ora_png(orazip, ora_copier, "tile",
+                                            storename, tile_rect, kwargs):
+            t0 = time.time()
+            with helpers.ZipfileEntryWriter(orazip, storename) as fp:
+                self._surface.save_as_png(
+                    fp,
+                    *tile_rect,
+                    progress=progress.open(),
+                    **kwargs
+                )
+            t1 = time.time()
+            logger.debug('%.3fs surface saving %s', t1 - t0, storename)
         elem.attrib[self.ORA_BGTILE_LEGACY_ATTR] = storename
         elem.attrib[self.ORA_BGTILE_ATTR] = storename
 
@@ -1427,6 +2162,9 @@ class StrokemappedPaintingLayer (SimplePaintingLayer):
     _ORA_STROKEMAP_ATTR = "{%s}strokemap" % (lib.xml.OPENRASTER_MYPAINT_NS,)
     _ORA_STROKEMAP_LEGACY_ATTR = "mypaint_strokemap_v2"
 
+    #: Number of new strokes after which the strokemap is compacted.
+    STROKEMAP_COMPACTION_INTERVAL = 64
+
     ## Initializing & resetting
 
     def __init__(self, **kwargs):
@@ -1435,16 +2173,23 @@ class StrokemappedPaintingLayer (SimplePaintingLayer):
         #: List of strokemap.StrokeShape instances (not stroke.Stroke),
         #: ordered by depth.
         self.strokes = []
+        self._stroke_index = lib.strokemap.StrokeIndex()
+        self._strokemap_tasks = lib.idletask.Processor()
+        self._strokes_compacted = 0  # len(strokes) after last compaction
 
     def clear(self):
         """Clear both the surface and the strokemap"""
         super(StrokemappedPaintingLayer, self).clear()
+        self._stop_strokemap_compaction()
         self.strokes = []
+        self._strokes_compacted = 0
 
     def load_from_surface(self, surface):
         """Load the surface image's tiles from another surface"""
         super(StrokemappedPaintingLayer, self).load_from_surface(surface)
+        self._stop_strokemap_compaction()
         self.strokes = []
+        self._strokes_compacted = 0
 
     def load_from_openraster(self, orazip, elem, cache_dir, progress,
                              x=0, y=0, **kwargs):
@@ -1497,9 +2242,8 @@ class StrokemappedPaintingLayer (SimplePaintingLayer):
         if strokemap_name is None:
             return
         if orazip:
-            sio = StringIO(orazip.read(strokemap_name))
-            self._load_strokemap_from_file(sio, x, y)
-            sio.close()
+            with contextlib.closing(orazip.open(strokemap_name)) as sfp:
+                self._load_strokemap_from_file(sfp, x, y)
         elif oradir:
             with open(os.path.join(oradir, strokemap_name), "rb") as sfp:
                 self._load_strokemap_from_file(sfp, x, y)
@@ -1540,6 +2284,8 @@ class StrokemappedPaintingLayer (SimplePaintingLayer):
         if shape is not None:
             shape.brush_string = stroke.brush_settings
             self.strokes.append(shape)
+            self._stroke_index.add(self.strokes, shape)
+            self._queue_strokemap_compaction()
 
     ## Snapshots
 
@@ -1558,6 +2304,7 @@ class StrokemappedPaintingLayer (SimplePaintingLayer):
     def trim(self, rect):
         """Trim the layer and its strokemap"""
         super(StrokemappedPaintingLayer, self).trim(rect)
+        self._stop_strokemap_compaction()
         empty_strokes = []
         for stroke in self.strokes:
             if not stroke.trim(rect):
@@ -1565,11 +2312,56 @@ class StrokemappedPaintingLayer (SimplePaintingLayer):
         for stroke in empty_strokes:
             logger.debug("Removing emptied stroke %r", stroke)
             self.strokes.remove(stroke)
+        self._stroke_index.invalidate()
+
+    ## Strokemap compaction
+
+    def _queue_strokemap_compaction(self):
+        """Starts compacting the strokemap if enough strokes were added
+
+        Compaction runs in the background, on a copy of the stroke list.
+
+        """
+        if self._strokemap_tasks.has_work():
+            return
+        new_strokes = len(self.strokes) - self._strokes_compacted
+        if new_strokes < self.STROKEMAP_COMPACTION_INTERVAL:
+            return
+        task = lib.strokemap.StrokemapCompactionTask(
+            self.strokes,
+            self._strokemap_compacted_cb,
+        )
+        self._strokemap_tasks.add_work(task)
+
+    def _stop_strokemap_compaction(self):
+        """Abandons compaction: call before changing the shapes"""
+        self._strokemap_tasks.stop()
+
+    def _strokemap_compacted_cb(self, strokes, compacted):
+        """Installs a compacted copy of the strokemap, if still valid
+
+        Strokes may have been added in the meantime, but if the ones
+        which were compacted have changed, the result is discarded.
+
+        """
+        current = self.strokes
+        n = len(strokes)
+        unchanged = (
+            len(current) >= n
+            and all(a is b for (a, b) in zip(current, strokes))
+        )
+        if unchanged and len(compacted) < n:
+            self.strokes = compacted + current[n:]
+            self.autosave_dirty = True
+        elif not unchanged:
+            logger.debug("Strokemap changed during compaction")
+        self._strokes_compacted = len(self.strokes)
 
     ## Strokemap load and save
 
     def _load_strokemap_from_file(self, f, translate_x, translate_y):
         assert not self.strokes
+        brush_table = lib.strokemap.get_brush_table()
         brushes = []
         x = int(translate_x // N) * N
         y = int(translate_y // N) * N
@@ -1580,13 +2372,13 @@ class StrokemappedPaintingLayer (SimplePaintingLayer):
             if t == 'b':
                 length, = struct.unpack('>I', f.read(4))
                 tmp = f.read(length)
-                brushes.append(zlib.decompress(tmp))
+                brushes.append(brush_table.intern_compressed(tmp))
             elif t == 's':
                 brush_id, length = struct.unpack('>II', f.read(2 * 4))
                 stroke = lib.strokemap.StrokeShape()
                 tmp = f.read(length)
                 stroke.init_from_string(tmp, x, y)
-                stroke.brush_string = brushes[brush_id]
+                stroke.brush_entry = brushes[brush_id]
                 # Translate non-aligned strokes
                 if (dx, dy) != (0, 0):
                     stroke.translate(dx, dy)
@@ -1601,7 +2393,7 @@ class StrokemappedPaintingLayer (SimplePaintingLayer):
     def get_stroke_info_at(self, x, y):
         """Get the stroke at the given point"""
         x, y = int(x), int(y)
-        for s in reversed(self.strokes):
+        for s in self._stroke_index.get_strokes_at(self.strokes, x, y):
             if s.touches_pixel(x, y):
                 return s
 
@@ -1613,32 +2405,60 @@ class StrokemappedPaintingLayer (SimplePaintingLayer):
     ## Saving
 
     def save_to_openraster(self, orazip, tmpdir, path,
-                           canvas_bbox, frame_bbox, **kwargs):
+                           canvas_bbox, frame_bbox, ora_copier=None,
+                           **kwargs):
         """Save the strokemap too, in addition to the base implementation"""
         # Save the layer normally
 
         elem = super(StrokemappedPaintingLayer, self).save_to_openraster(
             orazip, tmpdir, path,
-            canvas_bbox, frame_bbox, **kwargs
+            canvas_bbox, frame_bbox,
+            ora_copier=ora_copier,
+            **kwargs
         )
         # Store stroke shape data too
         x, y, w, h = self.get_bbox()
-        sio = StringIO()
-        t0 = time.time()
-        _write_strokemap(sio, self.strokes, -x, -y)
-        t1 = time.time()
-        data = sio.getvalue()
-        sio.close()
         datname = self._make_refname("layer", path, "strokemap.dat")
-        logger.debug("%.3fs strokemap saving %r", t1 - t0, datname)
         storepath = "data/%s" % (datname,)
-        helpers.zipfile_writestr(orazip, storepath, data)
+        if not self._copy_unchanged_ora_strokemap(orazip, ora_copier,
+                                                  storepath, elem):
+            t0 = time.time()
+            with helpers.ZipfileEntryWriter(orazip, storepath) as fp:
+                _write_strokemap(fp, self.strokes, -x, -y)
+            t1 = time.time()
+            logger.debug("%.3fs strokemap saving %r", t1 - t0, datname)
         # Add strokemap XML attrs and return.
         # See comment above for compatibility strategy.
         elem.attrib[self._ORA_STROKEMAP_ATTR] = storepath
         elem.attrib[self._ORA_STROKEMAP_LEGACY_ATTR] = storepath
         return elem
 
+    def _copy_unchanged_ora_strokemap(self, orazip, ora_copier,
+                                      storepath, elem):
+        """Internal: reuses the strokemap from the previous save if possible
+
+        Strokes are translated and trimmed in place, but only along with
+        the surface. So the strokemap can be copied if the layer's PNG
+        was copied, and the list of strokes is the same as last time.
+        The strokes are only recorded weakly.
+
+        """
+        if ora_copier is None:
+            return False
+        strokes = tuple(weakref.ref(s) for s in self.strokes)
+        prev_strokes = ora_copier.get_previous_state(self, "strokemap")
+        unchanged = (
+            prev_strokes is not None
+            and ora_copier.is_copied(elem.attrib["src"])
+            and len(prev_strokes) == len(strokes)
+            and all(a() is b() for (a, b) in zip(prev_strokes, strokes))
+        )
+        if unchanged:
+            ora_copier.copy(orazip, self, "strokemap", storepath, strokes)
+            return True
+        ora_copier.record(self, "strokemap", storepath, strokes)
+        return False
+
     def queue_autosave(self, oradir, taskproc, manifest, bbox, **kwargs):
         """Queues the layer for auto-saving"""
         dat_basename = u"%s-strokemap.dat" % (self.autosave_uuid,)
@@ -1724,19 +2544,20 @@ def _write_strokemap(f, strokes, dx, dy):
 
 
 def _write_strokemap_stroke(f, stroke, brush2id, dx, dy):
-    s = stroke.brush_string
+    brush_entry = stroke.brush_entry
     # save brush (if not already known)
-    if s not in brush2id:
-        brush2id[s] = len(brush2id)
-        s = zlib.compress(s)
+    if brush_entry not in brush2id:
+        brush2id[brush_entry] = len(brush2id)
+        s = brush_entry.compressed
         f.write('b')
         f.write(struct.pack('>I', len(s)))
         f.write(s)
     # save stroke
-    s = stroke.save_to_string(dx, dy)
+    chunks = stroke.save_to_chunks(dx, dy)
+    size = sum(len(c) for c in chunks)
     f.write('s')
-    f.write(struct.pack('>II', brush2id[stroke.brush_string], len(s)))
-    f.write(s)
+    f.write(struct.pack('>II', brush2id[brush_entry], size))
+    f.writelines(chunks)
 
 
 class _StrokemapFileUpdateTask (object):
@@ -1820,6 +2641,8 @@ class StrokemappedPaintingLayerMove (SurfaceBackedLayerMove):
             # further layer moves. This can cause apparent hangs for no
             # reason later on. Perhaps it would be better to process them
             # fully in this hourglass-cursor phase after all?
+        self._layer._stroke_index.invalidate()
+        self._layer._stop_strokemap_compaction()
         # The tile memory is the canonical source of a painting layer,
         # so we'll need to autosave it.
         self._layer.autosave_dirty = True
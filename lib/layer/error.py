@@ -16,3 +16,16 @@ from __future__ import division, print_function
 class LoadingFailed (Exception):
     """Raised when loading to indicate that a layer cannot be loaded"""
     pass
+
+
+class DeferredLoadingFailed (IOError):
+    """Raised when a layer's data can't be decoded on demand
+
+    Layers can put off decoding their data until it's needed. Reading
+    the pixels of such a layer raises this if the data turns out to be
+    invalid, every time, so that its content is never taken to be
+    empty. Saving the layer fails with this error too, which keeps the
+    original file from being overwritten.
+
+    """
+    pass
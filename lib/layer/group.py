@@ -377,6 +377,13 @@ class LayerStack (core.LayerBase, lib.autosave.Autosaveable):
     def is_empty(self):
         return len(self._layers) == 0
 
+    def get_unloaded_tiles(self):
+        """Returns the unloaded tiles of all the layers in the stack"""
+        tiles = []
+        for layer in self._layers:
+            tiles.extend(layer.get_unloaded_tiles())
+        return tiles
+
     @property
     def effective_opacity(self):
         """The opacity used when compositing a layer: zero if invisible"""
@@ -38,6 +38,8 @@ from . import data
 from . import group
 from . import core
 import lib.feedback
+import lib.idletask
+import lib.workerpool
 
 logger = logging.getLogger(__name__)
 
@@ -140,6 +142,8 @@ class RootLayerStack (group.LayerStack):
         self.layer_content_changed += self._mark_layer_for_rethumb
         self._rethumb_layers = []
         self._rethumb_layers_timer_id = None
+        self._rethumb_processor = lib.idletask.Processor()
+        self._rethumb_loading = set()  # layers whose tiles are loading
 
     def _clear_render_cache(self, *_ignored):
         self._render_cache.clear()
@@ -404,10 +408,17 @@ class RootLayerStack (group.LayerStack):
                 layers is None
                 and overlay is None
                 and not (kwargs.get("solo") or kwargs.get("previewing"))
+                and kwargs.get("current_layer_overlay") is None
             )
             if using_cache:
+                # The base tile only matters when rendering with alpha.
+                # Opaque tiles rendered for the display can be reused
+                # for saving the merged image, and vice versa.
+                base_tile_id = None
+                if dst_has_alpha:
+                    base_tile_id = id(opaque_base_tile)
                 cache_key = (tx, ty, dst_has_alpha, mipmap_level,
-                             render_background, id(opaque_base_tile))
+                             render_background, base_tile_id)
                 dst = self._render_cache.get(cache_key)
             if dst is None:
                 dst = np.empty(tiledims, dtype='uint16')
@@ -2287,11 +2298,34 @@ class RootLayerStack (group.LayerStack):
         self._rethumb_layers_timer_id = timer_id
 
     def _rethumb_layers_timer_cb(self):
+        # The timer only debounces: updates themselves are done
+        # in time slices by the shared background scheduler.
+        self._rethumb_layers_timer_id = None
+        if not self._rethumb_processor.has_work():
+            self._rethumb_processor.add_work(self._rethumb_layers_task)
+        return False
+
+    def _rethumb_layers_task(self):
         if len(self._rethumb_layers) >= 1:
             layer0 = self._rethumb_layers.pop(-1)
             path0 = self.deepindex(layer0)
             if not path0:
                 return True
+            # Layers loaded lazily, e.g. hidden ones just after opening
+            # a file, are loaded in the background before rendering.
+            if layer0 in self._rethumb_loading:
+                return True
+            unloaded = layer0.get_unloaded_tiles()
+            if unloaded:
+                self._rethumb_loading.add(layer0)
+                pool = lib.workerpool.get_pool()
+                future = pool.submit(_load_tiles, unloaded)
+                future.add_done_callback(
+                    lambda f: GLib.idle_add(
+                        self._rethumb_tiles_loaded_cb, f, layer0,
+                    )
+                )
+                return True
             layer0.update_thumbnail()
             self.layer_thumbnail_updated(path0, layer0)
             # Queue parent layers too
@@ -2304,8 +2338,18 @@ class RootLayerStack (group.LayerStack):
                 path = path[:-1]
             self._rethumb_layers.extend(reversed(parents))
             return True
-        # Stop the timer when there is nothing more to be done.
-        self._rethumb_layers_timer_id = None
+        # Stop when there is nothing more to be done.
+        return False
+
+    def _rethumb_tiles_loaded_cb(self, future, layer):
+        """Rethumbs a layer once its tiles are loaded (GUI thread)"""
+        self._rethumb_loading.discard(layer)
+        try:
+            future.result()
+        except Exception:
+            logger.exception("Cannot load %r to update its thumbnail", layer)
+            return False
+        self._mark_layer_for_rethumb(self, layer)
         return False
 
     @event
@@ -2361,6 +2405,15 @@ def path_startswith(path, prefix):
     return True
 
 
+## Helper functions
+
+
+def _load_tiles(tiles):
+    """Worker: loads the pixels of unloaded tiles"""
+    for tile in tiles:
+        tile.rgba
+
+
 ## Module testing
 
 
@@ -27,6 +27,7 @@ typedef struct { int x, y, w, h; } Rect;
 %include "colorchanger_wash.hpp"
 %include "colorchanger_crossed_bowl.hpp"
 %include "fastpng.hpp"
+%include "fastjpeg.hpp"
 %include "fill.hpp"
 %include "brushsettings.hpp"
 
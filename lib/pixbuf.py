@@ -45,7 +45,7 @@ def save(pixbuf, filename, type='png', **kwargs):
     """Save pixbuf to a named file (compatibility wrapper)
 
     :param GdkPixbuf.Pixbuf pixbuf: the pixbuf to save
-    :param unicode filename: file path to save as
+    :param unicode filename: file path to save as, or a writable file
     :param str type: type to save as: 'jpeg'/'png'/...
     :param \*\*kwargs: passed through to GdkPixbuf
     :rtype: bool
@@ -60,24 +60,31 @@ def save(pixbuf, filename, type='png', **kwargs):
     >>> shutil.rmtree(d, ignore_errors=True)
 
     """
+    if hasattr(filename, "write"):
+        return _save_to_file(pixbuf, filename, type, **kwargs)
     with open(filename, 'wb') as fp:
-        try:
-            save_to_callbackv = pixbuf.save_to_callbackv
-        except AttributeError:
-            # save_to_callbackv disappeared in GdkPixbuf 2.31.2
-            # and returned as of GdkPixbuf 2.31.5
-            # https://bugzilla.gnome.org/show_bug.cgi?id=670372#c12
-            save_to_callbackv = pixbuf.save_to_callback
-        # Keyword args are not compatible with 2.26 (Ubuntu 12.04,
-        # a.k.a. precise, a.k.a. "what Travis-CI runs")
-        result = save_to_callbackv(
-            lambda buf, size, data: fp.write(buf) or True,  # save_func
-            fp,      # user_data
-            type,      # type
-            kwargs.keys(),   # option_keys
-            kwargs.values(),  # option_values
-        )
-        return result
+        return _save_to_file(pixbuf, fp, type, **kwargs)
+
+
+def _save_to_file(pixbuf, fp, type, **kwargs):
+    """Save pixbuf to an open file object"""
+    try:
+        save_to_callbackv = pixbuf.save_to_callbackv
+    except AttributeError:
+        # save_to_callbackv disappeared in GdkPixbuf 2.31.2
+        # and returned as of GdkPixbuf 2.31.5
+        # https://bugzilla.gnome.org/show_bug.cgi?id=670372#c12
+        save_to_callbackv = pixbuf.save_to_callback
+    # Keyword args are not compatible with 2.26 (Ubuntu 12.04,
+    # a.k.a. precise, a.k.a. "what Travis-CI runs")
+    result = save_to_callbackv(
+        lambda buf, size, data: fp.write(buf) or True,  # save_func
+        fp,      # user_data
+        type,      # type
+        kwargs.keys(),   # option_keys
+        kwargs.values(),  # option_values
+    )
+    return result
 
 
 def load_from_file(filename, progress=None):
@@ -141,6 +148,30 @@ def load_from_stream(fp, progress=None):
     return loader.get_pixbuf()
 
 
+def open_zipfile_member(datazip, filename):
+    """Opens a zipfile entry for reading, tolerating bad filenames
+
+    :param zipfile.ZipFile datazip: ZipFile object opened for extracting
+    :param unicode filename: entry (file name) in the zipfile
+    :rtype: tuple
+    :returns: the opened entry, and its zipfile.ZipInfo
+
+    """
+    try:
+        datafp = datazip.open(filename, mode='r')
+        info = datazip.getinfo(filename)
+    except KeyError:
+        # Support for bad zip files (saved by old versions of the
+        # GIMP ORA plugin)
+        filename_enc = filename.encode('utf-8')
+        datafp = datazip.open(filename_enc, mode='r')
+        logger.warning('Bad ZIP file. There is an utf-8 encoded '
+                       'filename that does not have the utf-8 '
+                       'flag set: %r', filename)
+        info = datazip.getinfo(filename_enc)
+    return (datafp, info)
+
+
 def load_from_zipfile(datazip, filename, progress=None):
     """Extract and return a pixbuf from a zipfile entry
 
@@ -163,19 +194,7 @@ def load_from_zipfile(datazip, filename, progress=None):
     if progress.items is not None:
         raise ValueError("progress argument must be unsized")
 
-    try:
-        datafp = datazip.open(filename, mode='r')
-        info = datazip.getinfo(filename)
-    except KeyError:
-        # Support for bad zip files (saved by old versions of the
-        # GIMP ORA plugin)
-        filename_enc = filename.encode('utf-8')
-        datafp = datazip.open(filename_enc, mode='r')
-        logger.warning('Bad ZIP file. There is an utf-8 encoded '
-                       'filename that does not have the utf-8 '
-                       'flag set: %r', filename)
-        info = datazip.getinfo(filename_enc)
-
+    datafp, info = open_zipfile_member(datazip, filename)
     progress.items = info.file_size
     pixbuf = load_from_stream(datafp, progress=progress)
     datafp.close()
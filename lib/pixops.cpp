@@ -549,6 +549,10 @@ void tile_perceptual_change_strokemap(PyObject * a_obj, PyObject * b_obj, PyObje
   uint16_t * b_p  = (uint16_t*)PyArray_DATA(b);
   uint8_t * res_p = (uint8_t*)PyArray_DATA(res);
 
+  // Only raw pixel memory is used below, so strokes can be diffed
+  // in several worker threads at once.
+  Py_BEGIN_ALLOW_THREADS
+
   for (int y=0; y<MYPAINT_TILE_SIZE; y++) {
     for (int x=0; x<MYPAINT_TILE_SIZE; x++) {
 
@@ -593,6 +597,66 @@ void tile_perceptual_change_strokemap(PyObject * a_obj, PyObject * b_obj, PyObje
       res_p += 1;
     }
   }
+
+  Py_END_ALLOW_THREADS
+}
+
+
+bool tile_strokemap_test_bit(PyObject * bits_obj, int x, int y) {
+
+  PyArrayObject *bits = (PyArrayObject *)bits_obj;
+
+#ifdef HEAVY_DEBUG
+  assert(PyArray_TYPE(bits) == NPY_UINT8);
+  assert(PyArray_ISCARRAY_RO(bits));
+  assert(PyArray_SIZE(bits) == MYPAINT_TILE_SIZE*MYPAINT_TILE_SIZE/8);
+#endif
+
+  if (x < 0 || y < 0 || x >= MYPAINT_TILE_SIZE || y >= MYPAINT_TILE_SIZE) {
+    return false;
+  }
+  const uint8_t * bits_p = (const uint8_t*)PyArray_DATA(bits);
+  const int i = y*MYPAINT_TILE_SIZE + x;
+  return (bits_p[i/8] >> (7 - i%8)) & 1;
+}
+
+
+void tile_strokemap_unpack_to_rgba(PyObject * bits_obj, PyObject * dst_obj,
+                                   int alpha) {
+
+  PyArrayObject *bits = (PyArrayObject *)bits_obj;
+  PyArrayObject *dst = (PyArrayObject *)dst_obj;
+
+#ifdef HEAVY_DEBUG
+  assert(PyArray_TYPE(bits) == NPY_UINT8);
+  assert(PyArray_TYPE(dst) == NPY_UINT16);
+  assert(PyArray_ISCARRAY_RO(bits));
+  assert(PyArray_ISCARRAY(dst));
+  assert(PyArray_SIZE(bits) == MYPAINT_TILE_SIZE*MYPAINT_TILE_SIZE/8);
+#endif
+
+  const uint8_t * bits_p = (const uint8_t*)PyArray_DATA(bits);
+  uint16_t * dst_p = (uint16_t*)PyArray_DATA(dst);
+  const uint16_t a = alpha;
+  const uint16_t c = alpha/2;
+
+  for (int i=0; i<MYPAINT_TILE_SIZE*MYPAINT_TILE_SIZE/8; i++) {
+    const uint8_t byte = bits_p[i];
+    for (int b=7; b>=0; b--) {
+      if ((byte >> b) & 1) {
+        dst_p[0] = c;
+        dst_p[1] = c;
+        dst_p[2] = c;
+        dst_p[3] = a;
+      } else {
+        dst_p[0] = 0;
+        dst_p[1] = 0;
+        dst_p[2] = 0;
+        dst_p[3] = 0;
+      }
+      dst_p += 4;
+    }
+  }
 }
 
 
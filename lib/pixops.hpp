@@ -84,10 +84,27 @@ void tile_flat2rgba(PyObject * dst_obj, PyObject * bg_obj);
 //
 // If the layer alpha was (near) zero, we record the stroke even if it is
 // barely visible. This gives a bigger target to point-and-select.
+//
+// The GIL is released while the diff is calculated.
 
 void tile_perceptual_change_strokemap(PyObject *a_obj, PyObject *b_obj, PyObject *res_obj);
 
 
+// Tests one pixel of a bit-packed strokemap tile. The bitmap is a uint8
+// array of MYPAINT_TILE_SIZE**2/8 bytes in row-major order, most
+// significant bit first, as made by numpy.packbits(). Used in strokemap.py
+
+bool tile_strokemap_test_bit(PyObject *bits_obj, int x, int y);
+
+
+// Unpacks a bit-packed strokemap tile to an RGBA tile for display.
+// Set pixels become neutral gray with the given alpha, and clear pixels
+// become fully transparent.
+
+void tile_strokemap_unpack_to_rgba(PyObject *bits_obj, PyObject *dst_obj,
+                                   int alpha);
+
+
 // Tile blending & compositing modes
 
 enum CombineMode {
@@ -44,6 +44,99 @@ public:
     }
   }
 
+  // Bulk upload of setting values, from numpy arrays.
+  //
+  // ids: int32[n] setting ids.
+  // base_values: float32[n] base values, one per setting id.
+  // counts: int32[n * MYPAINT_BRUSH_INPUTS_COUNT] number of mapping
+  //   points for each input of each setting, in input order.
+  // points: float32[2 * sum(counts)] the mapping points, as x, y pairs,
+  //   in the same order as the counts.
+  //
+  // The arrays are validated before anything is changed. Raises
+  // TypeError or ValueError for malformed input.
+  PyObject * set_settings_from_arrays (PyObject * ids_obj,
+                                       PyObject * base_values_obj,
+                                       PyObject * counts_obj,
+                                       PyObject * points_obj)
+  {
+    PyArrayObject* ids = (PyArrayObject*)ids_obj;
+    PyArrayObject* base_values = (PyArrayObject*)base_values_obj;
+    PyArrayObject* counts = (PyArrayObject*)counts_obj;
+    PyArrayObject* points = (PyArrayObject*)points_obj;
+    const char *err_text = NULL;
+    PyObject *err_type = PyExc_TypeError;
+    npy_intp n = 0;
+    npy_intp npoints = 0;
+    const npy_int32 * ids_p = NULL;
+    const npy_float32 * base_values_p = NULL;
+    const npy_int32 * counts_p = NULL;
+    const npy_float32 * points_p = NULL;
+    int p = 0;
+
+    if (! (is_c_vector(ids_obj, NPY_INT32)
+           && is_c_vector(counts_obj, NPY_INT32))) {
+      err_text = "ids and counts must be contiguous 1-D int32 arrays";
+      goto errexit;
+    }
+    if (! (is_c_vector(base_values_obj, NPY_FLOAT32)
+           && is_c_vector(points_obj, NPY_FLOAT32))) {
+      err_text = "base_values and points must be contiguous "
+                 "1-D float32 arrays";
+      goto errexit;
+    }
+
+    err_type = PyExc_ValueError;
+    n = PyArray_DIM(ids, 0);
+    if (PyArray_DIM(base_values, 0) != n) {
+      err_text = "base_values must have one entry per setting id";
+      goto errexit;
+    }
+    if (PyArray_DIM(counts, 0) != n * MYPAINT_BRUSH_INPUTS_COUNT) {
+      err_text = "counts must have one entry per input per setting id";
+      goto errexit;
+    }
+    ids_p = (npy_int32*)PyArray_DATA(ids);
+    base_values_p = (npy_float32*)PyArray_DATA(base_values);
+    counts_p = (npy_int32*)PyArray_DATA(counts);
+    points_p = (npy_float32*)PyArray_DATA(points);
+    for (npy_intp i=0; i<n; i++) {
+      if (ids_p[i] < 0 || ids_p[i] >= MYPAINT_BRUSH_SETTINGS_COUNT) {
+        err_text = "setting id out of range";
+        goto errexit;
+      }
+    }
+    for (npy_intp i=0; i<n*MYPAINT_BRUSH_INPUTS_COUNT; i++) {
+      if (counts_p[i] < 0) {
+        err_text = "mapping point counts must not be negative";
+        goto errexit;
+      }
+      npoints += counts_p[i];
+    }
+    if (PyArray_DIM(points, 0) != 2 * npoints) {
+      err_text = "points must hold an x, y pair for each counted point";
+      goto errexit;
+    }
+
+    for (npy_intp i=0; i<n; i++) {
+      const int id = ids_p[i];
+      set_base_value(id, base_values_p[i]);
+      for (int input=0; input<MYPAINT_BRUSH_INPUTS_COUNT; input++) {
+        const int count = counts_p[i*MYPAINT_BRUSH_INPUTS_COUNT + input];
+        set_mapping_n(id, input, count);
+        for (int j=0; j<count; j++) {
+          set_mapping_point(id, input, j, points_p[2*p], points_p[2*p+1]);
+          p++;
+        }
+      }
+    }
+    Py_RETURN_NONE;
+
+  errexit:
+    PyErr_SetString(err_type, err_text);
+    return NULL;
+  }
+
   // Same as Brush::stroke_to() but with minimal exception handling:
   // don't indicate that a split is pending should an exception happen
   // in the surface code (e.g. out-of-memory)
@@ -56,4 +149,16 @@ public:
     return res;
   }
 
+private:
+  // True if obj is a C-contiguous, one-dimensional numpy array of type.
+  static bool is_c_vector (PyObject * obj, int type)
+  {
+    if (! obj || ! PyArray_Check(obj)) {
+      return false;
+    }
+    PyArrayObject* arr = (PyArrayObject*)obj;
+    return (PyArray_ISCARRAY(arr) && PyArray_NDIM(arr) == 1
+            && PyArray_TYPE(arr) == type);
+  }
+
 };
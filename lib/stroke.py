@@ -11,6 +11,7 @@ from __future__ import division, print_function
 import numpy as np
 
 import brush
+import strokemap
 
 
 class Stroke (object):
@@ -37,7 +38,7 @@ class Stroke (object):
         assert not self.finished
 
         bi = brush.brushinfo
-        self.brush_settings = bi.save_to_string()
+        self.brush_settings = _intern(bi.save_to_string())
         self.brush_name = bi.get_string_property("parent_brush_name")
 
         states = brush.get_states_as_array()
@@ -104,9 +105,14 @@ class Stroke (object):
         clone = Stroke()
         clone.__dict__.update(self.__dict__)
         # Except for the brush-specific stuff
-        clone.brush_settings = brushinfo.save_to_string()
+        clone.brush_settings = _intern(brushinfo.save_to_string())
         clone.brush_name = brushinfo.get_string_property("parent_brush_name")
         # note: we keep self.brush_state intact, even if the new brush
         # has different meanings for the states. This should cause
         # fewer glitches than resetting the initial state to zero.
         return clone
+
+
+def _intern(brush_settings):
+    """Returns the shared copy of a brush settings string"""
+    return strokemap.get_brush_table().intern(brush_settings).string
@@ -14,18 +14,26 @@ import time
 import struct
 import zlib
 import math
+import collections
+import threading
+import weakref
 from logging import getLogger
 logger = getLogger(__name__)
 
 import numpy as np
+from gi.repository import GLib
 
 import mypaintlib
 
 import tiledsurface
 import idletask
+import lib.workerpool
 
 TILE_SIZE = N = mypaintlib.TILE_SIZE
 
+# Header of each tile in the "v2" strokemap format: tx, ty, zdata size.
+_TILE_HEADER = struct.Struct('>iiI')
+
 
 ## Class defs
 
@@ -33,7 +41,7 @@ class StrokeShape (object):
     """The shape of a single brushstroke.
 
     This class stores the shape of a stroke in as a 1-bit bitmap. The
-    information is stored in compressed memory blocks of the size of a
+    information is stored in bit-packed memory blocks of the size of a
     tile (for fast lookup).
 
     """
@@ -42,45 +50,76 @@ class StrokeShape (object):
         object.__init__(self)
         self.tasks = idletask.Processor()
         self.strokemap = {}
-        self.brush_string = None
+        #: Shared BrushString entry for the brush settings, or None.
+        self.brush_entry = None
+        self._tile_indices = set()
+
+    @property
+    def brush_string(self):
+        """The settings of the brush which painted the stroke (str)
+
+        Shapes store only a shared entry from the `BrushStringTable`
+        returned by `get_brush_table()`, which holds one copy of each
+        distinct brush string in use.
+
+        """
+        if self.brush_entry is None:
+            return None
+        return self.brush_entry.string
+
+    @brush_string.setter
+    def brush_string(self, brush_string):
+        if brush_string is None:
+            self.brush_entry = None
+        else:
+            self.brush_entry = get_brush_table().intern(brush_string)
 
     @classmethod
     def new_from_snapshots(cls, before, after):
         """Build a new StrokeShape from before+after pair of snapshots.
 
         :param before: snapshot of the layer before the stroke
-        :type before: lib.tiledsurface._TiledSurfaceSnapshot
+        :type before: lib.tiledsurface._SurfaceSnapshot
         :param after: snapshot of the layer after the stroke
-        :type after: lib.tiledsurface._TiledSurfaceSnapshot
+        :type after: lib.tiledsurface._SurfaceSnapshot
         :returns: A new StrokeShape, or None.
 
         If the snapshots haven't changed, None is returned. In this
-        case, no StrokeShape should be recorded.
+        case, no StrokeShape should be recorded. Only the tiles written
+        between the two snapshots are examined, so the cost depends on
+        the size of the stroke, not the size of the layer.
 
         """
-        before_dict = before.tiledict
-        after_dict = after.tiledict
-        before_tiles = set(before_dict.iteritems())
-        after_tiles = set(after_dict.iteritems())
-        changed_idxs = set(
-            pos for pos, data
-            in before_tiles.symmetric_difference(after_tiles)
-        )
-        if not changed_idxs:
+        changes = before.get_changed_tiles(after)
+        if not changes:
             return None
+        before_tiles = {}
+        after_tiles = {}
+        for pos, (before_tile, after_tile) in changes.iteritems():
+            if before_tile is not None:
+                before_tiles[pos] = before_tile
+            if after_tile is not None:
+                after_tiles[pos] = after_tile
         shape = cls()
         assert not shape.strokemap
+        shape._tile_indices.update(changes)
         shape.tasks.add_work(_TileDiffUpdateTask(
-            before.tiledict,
-            after.tiledict,
-            changed_idxs,
+            before_tiles,
+            after_tiles,
+            set(changes),
             shape.strokemap,
+            processor=shape.tasks,
         ))
         return shape
 
     def init_from_string(self, data, translate_x, translate_y):
         """Initialize from a saved compressed string.
 
+        :param data: Saved data, as a str or a buffer like a memoryview.
+
+        The data is parsed in place, so each tile's bitmap is copied
+        out of it just once.
+
         See lib.layer.data.PaintingLayer.load_from_openraster().
         Format: "v2" strokemap format.
 
@@ -88,36 +127,66 @@ class StrokeShape (object):
         assert not self.strokemap
         assert translate_x % N == 0
         assert translate_y % N == 0
-        translate_x /= N
-        translate_y /= N
-        while data:
-            tx, ty, size = struct.unpack('>iiI', data[:3*4])
-            compressed_bitmap = data[3*4:size+3*4]
+        translate_x //= N
+        translate_y //= N
+        offset = 0
+        while offset < len(data):
+            tx, ty, size = _TILE_HEADER.unpack_from(data, offset)
+            offset += _TILE_HEADER.size
+            compressed_bitmap = data[offset:offset+size]
+            if isinstance(compressed_bitmap, memoryview):
+                compressed_bitmap = compressed_bitmap.tobytes()
+            offset += size
             tile = _Tile.new_from_compressed_bitmap(compressed_bitmap)
             self.strokemap[tx + translate_x, ty + translate_y] = tile
-            data = data[size+3*4:]
+        self._tile_indices.update(self.strokemap)
 
-    def save_to_string(self, translate_x, translate_y):
-        """Return a compressed string representing the stroke shape.
+    def save_to_chunks(self, translate_x, translate_y):
+        """Return a list of strings representing the stroke shape.
 
-        This can be used with init_from_sting on subsequent file loads.
+        Joined together, the strings make up the same data as
+        save_to_string() returns. Writing them one after the other
+        avoids building a large string for big shapes.
 
-        See lib.layer.data.PaintingLayer.save_to_openraster().
         Format: "v2" strokemap format.
 
         """
         assert translate_x % N == 0
         assert translate_y % N == 0
-        translate_x /= N
-        translate_y /= N
+        translate_x //= N
+        translate_y //= N
         self.tasks.finish_all()
-        data = ''
+        chunks = []
         for (tx, ty), tile in self.strokemap.iteritems():
             compressed_bitmap = tile.to_string()
             tx, ty = tx + translate_x, ty + translate_y
-            data += struct.pack('>iiI', tx, ty, len(compressed_bitmap))
-            data += compressed_bitmap
-        return data
+            chunks.append(_TILE_HEADER.pack(tx, ty, len(compressed_bitmap)))
+            chunks.append(compressed_bitmap)
+        return chunks
+
+    def save_to_string(self, translate_x, translate_y):
+        """Return a compressed string representing the stroke shape.
+
+        This can be used with init_from_sting on subsequent file loads.
+
+        See lib.layer.data.PaintingLayer.save_to_openraster().
+        Format: "v2" strokemap format.
+
+        """
+        return "".join(self.save_to_chunks(translate_x, translate_y))
+
+    def get_tile_indices(self):
+        """Returns the positions of the tiles the shape may cover
+
+        :returns: (tx, ty) tile indices
+        :rtype: set
+
+        This is a superset of the positions in the strokemap, and it is
+        known without completing any of the shape's pending tasks.
+        The returned set must not be modified.
+
+        """
+        return self._tile_indices
 
     def _complete_tile_tasks(self, pred):
         """Complete all queued work on a subset of tiles.
@@ -160,8 +229,7 @@ class StrokeShape (object):
         self._complete_tile_tasks(pred)
         tile = self.strokemap.get(pixel_ti)
         if tile:
-            array = tile.to_array()
-            return bool(array[y % N, x % N])
+            return bool(tile.get_pixel(x % N, y % N))
         return False
 
     def render_to_surface(self, surf, bbox=None, center=None):
@@ -190,7 +258,6 @@ class StrokeShape (object):
             if not pred((tx, ty)):
                 continue
             diff_tile = self.strokemap[(tx, ty)]
-            diff_arr = diff_tile.to_array()
             with surf.tile_request(tx, ty, readonly=False) as surf_arr:
                 diff_tile.write_to_surface_tile_array(surf_arr)
 
@@ -200,6 +267,16 @@ class StrokeShape (object):
         tmp = {}
         self.tasks.add_work(_TileTranslateTask(self.strokemap, tmp, dx, dy))
         self.tasks.add_work(_TileRecompressTask(tmp, self.strokemap))
+        slices_x = tiledsurface.calc_translation_slices(int(dx))
+        slices_y = tiledsurface.calc_translation_slices(int(dy))
+        tdxs = [targ[0] for (src, targ) in slices_x]
+        tdys = [targ[0] for (src, targ) in slices_y]
+        self._tile_indices = set(
+            (tx + tdx, ty + tdy)
+            for (tx, ty) in self._tile_indices
+            for tdx in tdxs
+            for tdy in tdys
+        )
 
     def trim(self, rect):
         """Trim the shape to a rectangle, discarding data outside it
@@ -217,61 +294,434 @@ class StrokeShape (object):
         for tx, ty in list(self.strokemap.keys()):
             if tx*N+N < x or ty*N+N < y or tx*N > x+w or ty*N > y+h:
                 self.strokemap.pop((tx, ty))
+        self._tile_indices = set(self.strokemap)
         return bool(self.strokemap)
 
 
+class BrushStringTable (object):
+    """Interned brush setting strings, shared between stroke shapes
+
+    Every stroke shape refers to the settings of the brush which
+    painted it. There are normally only a few distinct brushes in a
+    document, but thousands of strokes, so shapes share one entry per
+    distinct brush string instead of holding their own copies.
+
+    >>> table = BrushStringTable()
+    >>> a = table.intern("settings A")
+    >>> table.intern("settings " + "A") is a
+    True
+    >>> a.string
+    'settings A'
+
+    Brush strings loaded from strokemap files can be interned in their
+    compressed form, which is kept for saving them again. They map to
+    the same entry as the uncompressed string.
+
+    >>> table.intern_compressed(zlib.compress("settings A")) is a
+    True
+    >>> b = table.intern_compressed(zlib.compress("settings B", 1))
+    >>> b.string
+    'settings B'
+    >>> zlib.decompress(a.compressed)
+    'settings A'
+
+    The table only refers to its entries weakly, so they're dropped
+    once no shapes use them any more.
+
+    >>> del a, b
+    >>> len(table)
+    0
+
+    """
+
+    def __init__(self):
+        super(BrushStringTable, self).__init__()
+        self._lock = threading.Lock()
+        self._entries = weakref.WeakValueDictionary()  # {str: entry}
+        self._compressed_entries = weakref.WeakValueDictionary()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def intern(self, brush_string):
+        """Returns the entry for a brush string, adding it if needed
+
+        :rtype: BrushString
+
+        """
+        with self._lock:
+            entry = self._entries.get(brush_string)
+            if entry is None:
+                entry = BrushString(brush_string)
+                self._entries[brush_string] = entry
+            return entry
+
+    def intern_compressed(self, zdata):
+        """Returns the entry for a zlib-compressed brush string
+
+        :rtype: BrushString
+
+        """
+        with self._lock:
+            entry = self._compressed_entries.get(zdata)
+            if entry is not None:
+                return entry
+        entry = self.intern(zlib.decompress(zdata))
+        with self._lock:
+            entry.set_compressed(zdata)
+            self._compressed_entries[zdata] = entry
+        return entry
+
+
+class BrushString (object):
+    """A brush setting string in a BrushStringTable
+
+    Entries are compared by identity. Use `BrushStringTable.intern()`
+    to get them, rather than constructing them directly.
+
+    """
+
+    __slots__ = ("string", "_compressed", "__weakref__")
+
+    def __init__(self, brush_string):
+        super(BrushString, self).__init__()
+        #: The brush setting string (str)
+        self.string = brush_string
+        self._compressed = None
+
+    @property
+    def compressed(self):
+        """The brush setting string, zlib-compressed (str)"""
+        if self._compressed is None:
+            self._compressed = zlib.compress(self.string)
+        return self._compressed
+
+    def set_compressed(self, zdata):
+        """Reuse an existing compressed form of the string, if unset"""
+        if self._compressed is None:
+            self._compressed = zdata
+
+
+_BRUSH_TABLE = BrushStringTable()
+
+
+def get_brush_table():
+    """Gets the shared table of brush strings
+
+    :rtype: BrushStringTable
+
+    """
+    return _BRUSH_TABLE
+
+
+class StrokeIndex (object):
+    """Inverted index of a stroke stack, from tile positions to shapes
+
+    Picking a stroke by position only needs to test the shapes which
+    may cover the tile at that position. This index finds them without
+    decompressing any tile data, or completing any pending shape tasks.
+
+    >>> strokes = []
+    >>> index = StrokeIndex()
+    >>> for tile_indices in [[(0, 0), (1, 0)], [(1, 0)], [(2, 2)]]:
+    ...     shape = StrokeShape()
+    ...     shape._tile_indices.update(tile_indices)
+    ...     strokes.append(shape)
+    ...     index.add(strokes, shape)
+    >>> [strokes.index(s) for s in index.get_strokes_at(strokes, N, 0)]
+    [1, 0]
+    >>> index.get_strokes_at(strokes, -1, -1)
+    []
+
+    Shapes appended with `add()` are indexed incrementally.
+    The index is rebuilt when it's next queried if the list of strokes
+    was replaced or changed length in the meantime. Other changes, such
+    as translating or trimming the shapes, need an `invalidate()`.
+
+    >>> del strokes[0]
+    >>> [strokes.index(s) for s in index.get_strokes_at(strokes, N, 0)]
+    [0]
+
+    """
+
+    def __init__(self):
+        """Initialize, as an empty index needing to be built"""
+        super(StrokeIndex, self).__init__()
+        self._tiles = {}  # {(tx, ty): [StrokeShape]}, in painting order
+        self._strokes = None  # the indexed list, or None if invalid
+        self._count = 0
+
+    def invalidate(self):
+        """Marks the index for rebuilding when it's next used"""
+        self._strokes = None
+
+    def add(self, strokes, shape):
+        """Indexes a shape just appended to a list of strokes
+
+        :param list strokes: Stroke stack, with `shape` at its end.
+        :param StrokeShape shape: The new topmost shape.
+
+        """
+        if self._strokes is not strokes:
+            return
+        if self._count != len(strokes) - 1:
+            self._strokes = None
+            return
+        self._add_shape(shape)
+        self._count += 1
+
+    def get_strokes_at(self, strokes, x, y):
+        """Returns the shapes which may cover a pixel, topmost first
+
+        :param list strokes: Stroke stack, in painting order.
+        :param int x: Pixel X position.
+        :param int y: Pixel Y position.
+        :returns: Candidate shapes, which should be tested further
+        :rtype: list
+
+        """
+        if self._strokes is not strokes or self._count != len(strokes):
+            self._rebuild(strokes)
+        ti = (int(x) // N, int(y) // N)
+        return list(reversed(self._tiles.get(ti, ())))
+
+    def _rebuild(self, strokes):
+        """Rebuilds the index from scratch"""
+        self._tiles = {}
+        for shape in strokes:
+            self._add_shape(shape)
+        self._strokes = strokes
+        self._count = len(strokes)
+
+    def _add_shape(self, shape):
+        """Indexes a shape as the topmost one"""
+        for ti in shape.get_tile_indices():
+            self._tiles.setdefault(ti, []).append(shape)
+
+
+class StrokemapCompactionTask (object):
+    """Idle task: compacts a stack of stroke shapes, a little per call
+
+    Shapes whose set pixels are all covered by shapes above them can
+    never be picked, so they are dropped. Neighbouring shapes with the
+    same brush_string are merged into one, since it doesn't matter
+    which of them is picked. Shapes which still have pending work
+    are kept as they are.
+
+    The shapes themselves are never modified, so undo snapshots which
+    refer to them remain valid. The result is a new list, which should
+    replace the original only if that hasn't changed in the meantime.
+
+    >>> full = np.ones((N, N), 'uint8')
+    >>> top = full.copy()
+    >>> top[N//2:] = 0
+    >>> bottom = full - top
+    >>> def make_shape(brush_string, ti, array):
+    ...     shape = StrokeShape()
+    ...     shape.brush_string = brush_string
+    ...     shape.strokemap[ti] = _Tile.new_from_array(array)
+    ...     shape._tile_indices.add(ti)
+    ...     return shape
+    >>> strokes = [
+    ...     make_shape("a", (0, 0), full),
+    ...     make_shape("b", (1, 0), full),
+    ...     make_shape("b", (0, 0), bottom),
+    ...     make_shape("c", (0, 0), top),
+    ... ]
+    >>> task = StrokemapCompactionTask(strokes)
+    >>> while task():
+    ...     pass
+    >>> [s.brush_string for s in task.result]
+    ['b', 'c']
+    >>> sorted(task.result[0].strokemap)
+    [(0, 0), (1, 0)]
+    >>> task.result[1] is strokes[3]
+    True
+
+    """
+
+    #: Number of tiles examined or merged per call.
+    TILES_PER_CALL = 256
+
+    def __init__(self, strokes, callback=None):
+        """Initialize, ready to compact a copy of a list of shapes
+
+        :param list strokes: StrokeShapes, in painting order.
+        :param callable callback: Called as callback(strokes, result)
+          when compaction is complete.
+
+        """
+        super(StrokemapCompactionTask, self).__init__()
+        self._strokes = list(strokes)
+        self._callback = callback
+        self._steps = self._compact()
+        #: The compacted list of shapes, once finished.
+        self.result = None
+
+    def __repr__(self):
+        return "<{name} strokes={n}>".format(
+            name = self.__class__.__name__,
+            n = len(self._strokes),
+        )
+
+    def __call__(self):
+        """Compact a bounded amount of the strokemap."""
+        for i in xrange(self.TILES_PER_CALL):
+            try:
+                next(self._steps)
+            except StopIteration:
+                if self._callback is not None:
+                    self._callback(self._strokes, self.result)
+                return False
+        return True
+
+    def _compact(self):
+        """Generator: yields after each tile examined or merged."""
+        covered = {}  # {xy: _Tile}
+        kept = []  # top first
+        group = []  # same-brush neighbours being merged, top first
+        group_map = {}
+        for shape in reversed(self._strokes):
+            if shape.tasks.has_work():
+                kept.extend(self._merge_group(group, group_map))
+                group, group_map = [], {}
+                kept.append(shape)
+                continue
+            tiles = shape.strokemap.items()
+            occluded = True
+            for ti, tile in tiles:
+                yield
+                mask = covered.get(ti)
+                if mask is None or not tile.is_subset_of(mask):
+                    occluded = False
+                    break
+            if occluded:
+                continue
+            if group and group[0].brush_entry is not shape.brush_entry:
+                kept.extend(self._merge_group(group, group_map))
+                group, group_map = [], {}
+            group.append(shape)
+            for ti, tile in tiles:
+                yield
+                covered[ti] = tile.union(covered.get(ti))
+                group_map[ti] = tile.union(group_map.get(ti))
+        kept.extend(self._merge_group(group, group_map))
+        kept.reverse()
+        self.result = kept
+        logger.debug(
+            "Compacted strokemap from %d to %d shapes",
+            len(self._strokes), len(kept),
+        )
+
+    @staticmethod
+    def _merge_group(group, group_map):
+        """Returns a list with a group of shapes merged into one."""
+        if len(group) <= 1:
+            return group
+        shape = StrokeShape()
+        shape.brush_entry = group[0].brush_entry
+        shape.strokemap.update(group_map)
+        shape._tile_indices.update(group_map)
+        return [shape]
+
+
 class _TileDiffUpdateTask:
     """Idle task: update strokemap with tile & pixel diffs of snapshots.
 
-    This task is used during initialization of the StrokeShape.
+    This task is used during initialization of the StrokeShape. The
+    diffs are calculated in chunks by the shared worker pool, and this
+    task stores their results in the main thread as they arrive. It
+    never waits for the workers when called from the GUI's idle time.
+    Instead, it pauses its processor until the pool reports that the
+    next job has finished.
 
     """
 
-    def __init__(self, before, after, changed_idxs, targ):
+    #: Number of tiles diffed by each worker job.
+    CHUNK_SIZE = 16
+
+    def __init__(self, before, after, changed_idxs, targ, pool=None,
+                 processor=None):
         """Initialize, ready to update a target StrokeShape with diffs
 
-        :param dict before: Complete pre-stroke tiledict (RO, {xy:Tile})
-        :param dict after: Complete post-stroke tiledict (RO, {xy:Tile})
-        :param set changed_idxs: RW set of (x,y) tile indexes to process
-        :param dict targ: Target strokemap (WO, {xy: bytes})
+        :param dict before: Pre-stroke changed tiles (RO, {xy:Tile})
+        :param dict after: Post-stroke changed tiles (RO, {xy:Tile})
+        :param iterable changed_idxs: (x,y) tile indexes to process
+        :param dict targ: Target strokemap (WO, {xy: _Tile})
+        :param lib.workerpool.WorkerPool pool: Pool (default: shared)
+        :param idletask.Processor processor: Processor running the task
+
+        The tiles must be shared by snapshots, so that they can be read
+        safely by the workers while painting continues. If no processor
+        is given, the task just polls the workers when it's called.
 
         """
-        self._before_dict = before
-        self._after_dict = after
+        if pool is None:
+            pool = lib.workerpool.get_pool()
         self._targ_dict = targ
-        self._remaining = changed_idxs
+        self._processor = processor
+        self._jobs = collections.deque()  # [(set(xy), Future)]
+        transparent = tiledsurface.transparent_tile
+        changed_idxs = list(changed_idxs)
+        for i in xrange(0, len(changed_idxs), self.CHUNK_SIZE):
+            items = []
+            for ti in changed_idxs[i:i+self.CHUNK_SIZE]:
+                data_before = before.get(ti, transparent).rgba
+                data_after = after.get(ti, transparent).rgba
+                items.append((ti, data_before, data_after))
+            future = pool.submit(_diff_tiles, items)
+            self._jobs.append((set(item[0] for item in items), future))
 
     def __repr__(self):
         return "<{name} remaining={remaining}>".format(
             name = self.__class__.__name__,
-            remaining = len(self._remaining),
+            remaining = sum(len(idxs) for (idxs, f) in self._jobs),
         )
 
     def __call__(self):
-        """Diff and update one queued tile."""
-        try:
-            ti = self._remaining.pop()
-        except KeyError:
+        """Store finished diffs, pausing while the next one is pending."""
+        while self._jobs and self._jobs[0][1].done():
+            idxs, future = self._jobs.popleft()
+            self._store(future)
+        if not self._jobs:
             return False
-        self._update_tile(ti)
-        return bool(self._remaining)
+        if self._processor is not None:
+            self._processor.pause()
+            self._jobs[0][1].add_done_callback(self._job_done)
+        return True
+
+    def wait(self):
+        """Wait for the next diff job (used when finishing all tasks)."""
+        if self._jobs:
+            self._jobs[0][1].wait()
+
+    def _job_done(self, future):
+        """Worker thread: a job finished, so resume in the main thread."""
+        GLib.idle_add(self._resume_cb)
+
+    def _resume_cb(self):
+        self._processor.resume()
+        return False
 
     def process_tile_subset(self, pred):
-        """Diff and update a subset of queued tiles now."""
-        processed = set()
-        for ti in self._remaining:
-            if not pred(ti):
-                continue
-            self._update_tile(ti)
-            processed.add(ti)
-        self._remaining -= processed
+        """Wait for and store the diffs of a subset of tiles now."""
+        remaining = collections.deque()
+        for idxs, future in self._jobs:
+            if any(pred(ti) for ti in idxs):
+                self._store(future)
+            else:
+                remaining.append((idxs, future))
+        self._jobs = remaining
 
-    def _update_tile(self, ti):
-        """Diff and update the tile at a specified position."""
-        transparent = tiledsurface.transparent_tile
-        data_before = self._before_dict.get(ti, transparent).rgba
-        data_after = self._after_dict.get(ti, transparent).rgba
-        self._targ_dict[ti] = _Tile.new_from_diff(data_before, data_after)
+    def _store(self, future):
+        """Store the diffed tiles from a finished job."""
+        for ti, tile in future.result():
+            self._targ_dict[ti] = tile
+
+
+def _diff_tiles(items):
+    """Worker job: diffs a list of (xy, before_rgba, after_rgba) items"""
+    return [(ti, _Tile.new_from_diff(b, a)) for (ti, b, a) in items]
 
 
 class _TileTranslateTask:
@@ -388,7 +838,20 @@ class _TileRecompressTask:
 class _Tile:
     """One strokemap tile containing perceptual stroke differences.
 
-    Stored in memory in a compressed and efficient form.
+    Stored in memory as a bitmap with one bit per pixel, packed in
+    row-major order with the most significant bit first, as made by
+    `np.packbits()`. Tiles which are all set or all clear are stored as
+    just a fill flag.
+
+    >>> array = np.zeros((N, N), 'uint8')
+    >>> _Tile.new_from_array(array)
+    <_Tile fill=False nbytes=0>
+    >>> array[3, 5] = 1
+    >>> t = _Tile.new_from_array(array)
+    >>> t.get_pixel(5, 3), t.get_pixel(3, 5)
+    (True, False)
+    >>> (t.to_array() == array).all()
+    True
 
     """
 
@@ -396,8 +859,8 @@ class _Tile:
 
     def __init__(self):
         """Initialize, as a tile filled with all ones."""
-        self._zdata = None
-        self._all = True
+        self._bits = None
+        self._fill = True
 
     @classmethod
     def new_from_diff(cls, before, after):
@@ -415,57 +878,97 @@ class _Tile:
         """Initialize from a single uncompressed diff array."""
         tile = cls()
         if array.all():
-            tile._all = True
-            tile._zdata = None
+            tile._fill = True
+        elif not array.any():
+            tile._fill = False
         else:
-            tile._all = False
-            tile._zdata = zlib.compress(array.tostring())
+            tile._fill = None
+            tile._bits = np.packbits(array)
+            tile._bits.flags.writeable = False
         return tile
 
     @classmethod
     def new_from_compressed_bitmap(cls, zdata):
         """Initialize from raw compressed zlib bitmap data."""
-        tile = cls()
         if zdata == cls._ZDATA_ONES:
             # ASSUMPTION: this representation of these bytes never changes.
-            tile._all = True
-            tile._zdata = None
+            return cls()
+        array = np.fromstring(zlib.decompress(zdata), dtype='uint8')
+        array.shape = (N, N)
+        return cls.new_from_array(array)
+
+    @classmethod
+    def _new_from_bits(cls, bits):
+        """Initialize from a packed bitmap array."""
+        tile = cls()
+        if (bits == 0xff).all():
+            tile._fill = True
+        elif not bits.any():
+            tile._fill = False
         else:
-            tile._all = False
-            tile._zdata = zdata
+            tile._fill = None
+            tile._bits = bits
+            tile._bits.flags.writeable = False
         return tile
 
+    def is_subset_of(self, other):
+        """Returns whether all pixels set here are also set in other."""
+        if self._fill is False or other._fill is True:
+            return True
+        elif self._fill is True or other._fill is False:
+            return False
+        uncovered = np.bitwise_and(self._bits, np.invert(other._bits))
+        return not uncovered.any()
+
+    def union(self, other):
+        """Returns a tile with the pixels set here or in other.
+
+        Tiles are never modified once made, so the result may be one of
+        the two tiles.
+
+        """
+        if other is None or self._fill is True or other._fill is False:
+            return self
+        elif other._fill is True or self._fill is False:
+            return other
+        return _Tile._new_from_bits(np.bitwise_or(self._bits, other._bits))
+
+    def get_pixel(self, x, y):
+        """Returns whether a pixel within the tile is set."""
+        if self._fill is not None:
+            return self._fill
+        return mypaintlib.tile_strokemap_test_bit(self._bits, x, y)
+
     def to_array(self):
         """Convert to an uncompressed array of ones and zeros."""
-        if self._all:
-            array = np.ones((N, N), 'uint8')
-        else:
-            array = np.fromstring(
-                zlib.decompress(self._zdata),
-                dtype='uint8',
-            )
-            array.shape = (N, N)
-        # Can this result always be treated as read-only?
+        if self._fill is True:
+            return np.ones((N, N), 'uint8')
+        elif self._fill is False:
+            return np.zeros((N, N), 'uint8')
+        array = np.unpackbits(self._bits)
+        array.shape = (N, N)
         return array
 
     def to_string(self):
         """Convert to a string which is storable in "v2" strokemaps."""
-        if self._all:
+        if self._fill is True:
             return self._ZDATA_ONES
         else:
-            return self._zdata
+            return zlib.compress(self.to_array().tostring())
 
     def write_to_surface_tile_array(self, rgba, _c=(1<<15)/4, _a=(1<<15)/2):
         """Write to a surface's RGBA tile."""
         # neutral gray, 50% opaque
-        if self._all:
+        if self._fill is True:
             rgba[:] = (_c, _c, _c, _a)
+        elif self._fill is False:
+            rgba[:] = 0
         else:
-            array = self.to_array()
-            rgba[:, :, 3] = array.astype('uint16') * _a
-            rgba[:, :, 0] = rgba[:, :, 3] // 2
-            rgba[:, :, 1] = rgba[:, :, 3] // 2
-            rgba[:, :, 2] = rgba[:, :, 3] // 2
+            mypaintlib.tile_strokemap_unpack_to_rgba(
+                self._bits,
+                rgba,
+                int(_a),
+            )
 
     def __str__(self):
         return self.to_string()
@@ -475,16 +978,16 @@ class _Tile:
 
         >>> t = _Tile()
         >>> repr(t)
-        '<_Tile all=True zbytes=0>'
+        '<_Tile fill=True nbytes=0>'
 
         """
-        zb = 0
-        if not self._all:
-            zb = len(self._zdata)
-        return "<{name} all={all} zbytes={zbytes}>".format(
-            all = self._all,
+        nbytes = 0
+        if self._bits is not None:
+            nbytes = self._bits.nbytes
+        return "<{name} fill={fill} nbytes={nbytes}>".format(
+            fill = self._fill,
             name = self.__class__.__name__,
-            zbytes = zb,
+            nbytes = nbytes,
         )
 
 
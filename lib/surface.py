@@ -33,6 +33,26 @@ N = mypaintlib.TILE_SIZE
 # throttle excesssive calls to the save/render progress monitor objects
 TILES_PER_CALLBACK = 256
 
+# PNG row filter flags, as in png.h, and zlib strategies, as in zlib.h.
+_PNG_FILTER_SUB = 0x10
+_PNG_ALL_FILTERS = 0xf8
+_Z_FILTERED = 1
+_Z_RLE = 3
+
+#: Named PNG compression profiles, for the "png_compression" keyword
+#: argument of the PNG savers. Each is a (zlib_level, zlib_strategy,
+#: png_filters) tuple for mypaintlib.ProgressivePNGWriter.
+#: "fast" is for autosaves, and "small" for when size matters more
+#: than time. See tests/unported/performance.py for benchmarks.
+PNG_COMPRESSION_PROFILES = {
+    "fast": (1, _Z_RLE, _PNG_FILTER_SUB),
+    "balanced": (2, _Z_FILTERED, _PNG_FILTER_SUB),
+    "small": (9, _Z_FILTERED, _PNG_ALL_FILTERS),
+}
+
+#: Profile used when the "png_compression" keyword argument is absent.
+DEFAULT_PNG_COMPRESSION = "balanced"
+
 
 class Bounded (object):
     """Interface for objects with an inherent size"""
@@ -252,17 +272,137 @@ def scanline_strips_iter(surface, rect, alpha=False,
         yield res
 
 
+class ScanlineStripDownscaler (object):
+    """Downscales scanline strips into a small image as they stream past
+
+    This averages boxes of pixels, so it can make a thumbnail from the
+    same strips that are being written to a full-size PNG, without
+    rendering anything twice or holding the full-size image in memory.
+    The output size fits inside a square, like a thumbnail scaled with
+    `lib.helpers.scale_proportionally()`.
+
+    >>> scaler = ScanlineStripDownscaler(6, 4, max_size=3)
+    >>> scaler.size
+    (3, 2)
+    >>> strip = np.zeros((3, 6, 4), 'uint8')
+    >>> strip[:, :2, :3] = 200
+    >>> scaler.write(strip)
+    >>> scaler.write(np.full((1, 6, 4), 100, 'uint8'))
+    >>> scaler.get_array()[..., 0].tolist()
+    [[200, 0, 0], [150, 50, 50]]
+
+    """
+
+    def __init__(self, w, h, max_size=256):
+        """Initialize for a given input size
+
+        :param int w: Width of the strips to be written.
+        :param int h: Total height of all the strips to be written.
+        :param int max_size: Maximum width and height of the output.
+
+        """
+        super(ScanlineStripDownscaler, self).__init__()
+        assert w > 0 and h > 0
+        scale = min(max_size / w, max_size / h)
+        if scale < 1:
+            out_w = max(1, int(w * scale))
+            out_h = max(1, int(h * scale))
+        else:
+            out_w, out_h = w, h
+        self.size = (out_w, out_h)
+        self._w = w
+        self._h = h
+        # Input column or row where each output pixel's box starts
+        self._col_starts = (np.arange(out_w) * w) // out_w
+        self._row_starts = (np.arange(out_h) * h) // out_h
+        self._sums = np.zeros((out_h, out_w, 3), 'uint64')
+        self._row = 0
+
+    def write(self, strip):
+        """Adds the next scanline strip, in 8-bit RGB(A) or RGBU
+
+        :param numpy.ndarray strip: Next rows of pixels, all full width.
+
+        """
+        rows = np.arange(self._row, self._row + strip.shape[0])
+        self._row += strip.shape[0]
+        assert self._row <= self._h
+        out_rows = np.searchsorted(self._row_starts, rows, "right") - 1
+        col_sums = np.add.reduceat(
+            strip[..., :3], self._col_starts,
+            axis=1, dtype='uint64',
+        )
+        starts = np.flatnonzero(np.diff(out_rows)) + 1
+        starts = np.concatenate(([0], starts))
+        row_sums = np.add.reduceat(col_sums, starts, axis=0)
+        self._sums[out_rows[starts]] += row_sums
+
+    def get_array(self):
+        """Gets the downscaled image, once all strips are written
+
+        :returns: Array of 8-bit RGB pixels, of shape (h, w, 3).
+        :rtype: numpy.ndarray
+
+        """
+        col_counts = np.diff(np.append(self._col_starts, self._w))
+        row_counts = np.diff(np.append(self._row_starts, self._h))
+        counts = np.outer(row_counts, col_counts)[..., np.newaxis]
+        counts = counts.astype('uint64')
+        return ((self._sums + counts // 2) // counts).astype('uint8')
+
+
+def get_png_compression_args(profile):
+    """Gets the PNG writer args for a named compression profile
+
+    :param str profile: A key of PNG_COMPRESSION_PROFILES, or None.
+    :returns: (zlib_level, zlib_strategy, png_filters)
+    :rtype: tuple
+    :raises ValueError: The profile name is not known.
+
+    >>> get_png_compression_args("balanced")
+    (2, 1, 16)
+    >>> get_png_compression_args(None) == get_png_compression_args(
+    ...     DEFAULT_PNG_COMPRESSION,
+    ... )
+    True
+    >>> get_png_compression_args("tiny")
+    Traceback (most recent call last):
+    ...
+    ValueError: Unknown PNG compression profile 'tiny'
+
+    """
+    if profile is None:
+        profile = DEFAULT_PNG_COMPRESSION
+    try:
+        return PNG_COMPRESSION_PROFILES[profile]
+    except KeyError:
+        raise ValueError("Unknown PNG compression profile %r" % (profile,))
+
+
+@contextlib.contextmanager
+def _open_for_writing(filename, file_obj=None):
+    """Opens a file for writing, or passes through an open one unclosed"""
+    if file_obj is not None:
+        yield file_obj
+    else:
+        with open(filename, "wb") as fp:
+            yield fp
+
+
 def save_as_png(surface, filename, *rect, **kwargs):
     """Saves a tile-blittable surface to a file in PNG format
 
     :param TileBlittable surface: Surface to save
-    :param unicode filename: The file to write
+    :param unicode filename: The file to write, or a writable file object
     :param tuple \*rect: Rectangle (x, y, w, h) to save
     :param bool alpha: If true, write a PNG with alpha
     :param progress: Updates a UI every scanline strip.
     :type progress: lib.feedback.Progress or None
     :param bool single_tile_pattern: True if surface is a one tile only.
     :param bool save_srgb_chunks: Set to False to not save sRGB flags.
+    :param str png_compression: Name of a PNG compression profile.
+    :param strip_consumer: Also gets each scanline strip written.
+    :type strip_consumer: ScanlineStripDownscaler or None
     :param tuple \*\*kwargs: Passed to blit_tile_into (minus the above)
 
     The `alpha` parameter is passed to the surface's `blit_tile_into()`
@@ -273,6 +413,12 @@ def save_as_png(surface, filename, *rect, **kwargs):
     If `save_srgb_chunks` is set to False, sRGB (and associated fallback
     cHRM and gAMA) will not be saved. MyPaint's default behaviour is
     currently to save these chunks.
+    The `png_compression` profile trades speed for file size: see
+    `PNG_COMPRESSION_PROFILES`.
+    The `strip_consumer` can be any object with a ``write()`` method
+    taking a scanline strip, for making other images in the same pass.
+    File objects passed in place of a filename are written to, but are
+    not closed.
 
     Raises `lib.errors.FileHandlingError` with a descriptive string if
     something went wrong.
@@ -283,6 +429,10 @@ def save_as_png(surface, filename, *rect, **kwargs):
     progress = kwargs.pop('progress', None)
     single_tile_pattern = kwargs.pop("single_tile_pattern", False)
     save_srgb_chunks = kwargs.pop("save_srgb_chunks", True)
+    compression_args = get_png_compression_args(
+        kwargs.pop("png_compression", None),
+    )
+    strip_consumer = kwargs.pop("strip_consumer", None)
 
     # Sizes. Save at least one tile to allow empty docs to be written
     if not rect:
@@ -297,20 +447,28 @@ def save_as_png(surface, filename, *rect, **kwargs):
     num_strips = int((1 + ((y + h) // N)) - (y // N))
     progress.items = num_strips
 
+    # File objects are written to as they are, and named for messages
+    file_obj = None
+    if hasattr(filename, "write"):
+        file_obj = filename
+        filename = getattr(file_obj, "name", None) or u"<stream>"
+
     try:
         logger.debug(
-            "Writing %r (%dx%d) alpha=%r srgb=%r",
+            "Writing %r (%dx%d) alpha=%r srgb=%r compression=%r",
             filename,
             w, h,
             alpha,
             save_srgb_chunks,
+            compression_args,
         )
-        with open(filename, "wb") as writer_fp:
+        with _open_for_writing(filename, file_obj) as writer_fp:
             pngsave = mypaintlib.ProgressivePNGWriter(
                 writer_fp,
                 w, h,
                 alpha,
                 save_srgb_chunks,
+                *compression_args
             )
             scanline_strips = scanline_strips_iter(
                 surface, rect,
@@ -320,6 +478,8 @@ def save_as_png(surface, filename, *rect, **kwargs):
             )
             for scanline_strip in scanline_strips:
                 pngsave.write(scanline_strip)
+                if strip_consumer is not None:
+                    strip_consumer.write(scanline_strip)
                 if not progress:
                     continue
                 try:
@@ -353,3 +513,82 @@ def save_as_png(surface, filename, *rect, **kwargs):
         # Other possible exceptions include TypeError, ValueError, but
         # those indicate incorrect coding usually; just raise them
         # normally.
+
+
+def save_as_jpeg(surface, filename, *rect, **kwargs):
+    """Saves a tile-blittable surface to a file in JPEG format
+
+    :param TileBlittable surface: Surface to save
+    :param unicode filename: The file to write, or a writable file object
+    :param tuple \*rect: Rectangle (x, y, w, h) to save
+    :param int quality: JPEG quality, 0 to 100.
+    :param progress: Updates a UI every scanline strip.
+    :type progress: lib.feedback.Progress or None
+    :param tuple \*\*kwargs: Passed to blit_tile_into (minus the above)
+
+    This works like `save_as_png()`, but writes an opaque baseline JPEG
+    with `mypaintlib.ProgressiveJPEGWriter`. Only one strip of tiles is
+    rendered at a time, so big images don't need a whole-image buffer.
+
+    Raises `lib.errors.FileHandlingError` with a descriptive string if
+    something went wrong.
+
+    """
+    quality = kwargs.pop("quality", 90)
+    progress = kwargs.pop("progress", None)
+    kwargs.pop("alpha", None)
+
+    if not rect:
+        rect = surface.get_bbox()
+    x, y, w, h = rect
+    if w == 0 or h == 0:
+        x, y, w, h = (0, 0, 1, 1)
+        rect = (x, y, w, h)
+
+    if not progress:
+        progress = lib.feedback.Progress()
+    num_strips = int((1 + ((y + h) // N)) - (y // N))
+    progress.items = num_strips
+
+    file_obj = None
+    if hasattr(filename, "write"):
+        file_obj = filename
+        filename = getattr(file_obj, "name", None) or u"<stream>"
+
+    try:
+        logger.debug("Writing %r (%dx%d) quality=%r",
+                     filename, w, h, quality)
+        with _open_for_writing(filename, file_obj) as writer_fp:
+            jpegsave = mypaintlib.ProgressiveJPEGWriter(
+                writer_fp,
+                w, h,
+                int(quality),
+            )
+            scanline_strips = scanline_strips_iter(
+                surface, rect,
+                alpha=False,
+                **kwargs
+            )
+            for scanline_strip in scanline_strips:
+                jpegsave.write(scanline_strip)
+                if progress:
+                    progress += 1
+            jpegsave.close()
+        logger.debug("Finished writing %r", filename)
+        progress.close()
+    except (IOError, OSError, RuntimeError) as err:
+        logger.exception(
+            "Caught %r from C++ jpeg-writer code, re-raising as a "
+            "FileHandlingError",
+            err,
+        )
+        raise FileHandlingError(C_(
+            "low-level JPEG writer failure report (dialog)",
+            u"Failed to write “{basename}”.\n\n"
+            u"Reason: {err}\n"
+            u"Target folder: “{dirname}”."
+        ).format(
+            err = err,
+            basename = os.path.basename(filename),
+            dirname = os.path.dirname(filename),
+        ))
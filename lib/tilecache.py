@@ -0,0 +1,584 @@
+# This file is part of MyPaint.
+# Copyright (C) 2017 by the MyPaint Development Team.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+"""Native tile caches of OpenRaster files, for reopening them quickly."""
+
+
+## Imports
+
+from __future__ import division, print_function
+
+import os
+import sys
+import zlib
+import json
+import mmap
+import struct
+import hashlib
+import tempfile
+import logging
+import threading
+import weakref
+
+import numpy as np
+
+import lib.fileutils
+import lib.workerpool
+import lib.tiledsurface as tiledsurface
+from lib.tiledsurface import N
+
+logger = logging.getLogger(__name__)
+
+
+## Constants
+
+#: File name suffix of tile cache files.
+SUFFIX = u".tilecache"
+
+#: Start of every tile cache file, and of its trailer too.
+MAGIC = b"MyPaint tile cache 1\n"
+
+#: zlib compression level: speed matters more than size here.
+COMPRESSION_LEVEL = 1
+
+#: Maximum number of cache files to keep in a cache dir.
+MAX_FILES = 10
+
+#: Fraction of a cache file which may be unused before it's rewritten.
+MAX_GARBAGE = 0.5
+
+# Trailer: index offset and length, then the magic again.
+_TRAILER = struct.Struct("<QQ")
+
+# Held while writing any cache file, so appends never race replaces.
+_WRITE_LOCK = threading.Lock()
+
+
+## Class defs
+
+
+class TileCache (object):
+    """Memory-mapped tile cache of the layers of an OpenRaster file
+
+    Decoding every layer PNG of a big OpenRaster file takes a while. A
+    tile cache holds the same layer data as 15-bit premultiplied tiles,
+    compressed individually, and indexed by the same (src, x, y) keys
+    as `lib.layer.OpenRasterPNGDecoder` uses. A cache file is only
+    valid while the OpenRaster file's size and mtime match the ones it
+    was written for.
+
+    Opening a cache reads just its index. Surfaces made from it have
+    placeholder tiles which decompress their pixels on first access,
+    in the same way as tiles moved out of memory by `lib.tilespill`.
+
+    >>> import shutil
+    >>> tmpdir = tempfile.mkdtemp()
+    >>> ora_path = os.path.join(tmpdir, "test.ora")
+    >>> with open(ora_path, "wb") as fp:
+    ...     fp.write("not really an ora file")
+    >>> surf = tiledsurface.Surface()
+    >>> with surf.tile_request(1, 2, readonly=False) as t:
+    ...     t[...] = 1 << 15
+    >>> writer = TileCacheWriter()
+    >>> writer.add(u"data/layer-00.png", 64, 128, surf.save_snapshot())
+    >>> writer.write(tmpdir, ora_path)
+    True
+    >>> cache = TileCache.open(tmpdir, ora_path)
+    >>> cache.has_surface(u"data/layer-00.png", 64, 128)
+    True
+    >>> loaded = cache.get_surface(u"data/layer-00.png", 64, 128)
+    >>> loaded.tiledict.keys()
+    [(1, 2)]
+    >>> "rgba" in loaded.tiledict[(1, 2)].__dict__
+    False
+    >>> int(loaded.tiledict[(1, 2)].rgba[0, 0, 3])
+    32768
+
+    Cache files are ignored once the OpenRaster file changes.
+
+    >>> with open(ora_path, "ab") as fp:
+    ...     fp.write(" at all")
+    >>> TileCache.open(tmpdir, ora_path) is None
+    True
+    >>> shutil.rmtree(tmpdir)
+
+    """
+
+    def __init__(self, path, mm, layers, file_id=None):
+        """Initialize from an open cache file (use `open()`)"""
+        super(TileCache, self).__init__()
+        self.path = path
+        self._mmap = mm
+        self._layers = layers  # {(src, x, y): [[tx, ty, offset, len]]}
+        self._file_id = file_id  # (st_dev, st_ino)
+
+    @classmethod
+    def open(cls, cache_dir, ora_path):
+        """Opens the tile cache for an OpenRaster file, if it's valid
+
+        :param unicode cache_dir: Directory holding tile caches.
+        :param unicode ora_path: The OpenRaster file.
+        :returns: The cache, or None if there isn't a valid one.
+        :rtype: TileCache
+
+        """
+        path = get_cache_path(cache_dir, ora_path)
+        signature = _get_file_signature(ora_path)
+        if signature is None or not os.path.isfile(path):
+            return None
+        try:
+            with open(path, "rb") as fp:
+                st = os.fstat(fp.fileno())
+                mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            index = _read_index(mm)
+        except (EnvironmentError, ValueError, zlib.error, struct.error):
+            logger.exception("Ignoring unreadable tile cache %r", path)
+            return None
+        if index.get("source") != list(signature):
+            logger.debug("Tile cache %r is out of date", path)
+            mm.close()
+            return None
+        layers = {}
+        for src, x, y, tiles in index.get("layers", []):
+            layers[(src, x, y)] = tiles
+        logger.info("Opened tile cache %r for %r", path, ora_path)
+        return cls(path, mm, layers, (st.st_dev, st.st_ino))
+
+    def has_surface(self, src, x, y):
+        """True if the cache holds the data for a layer PNG
+
+        :param unicode src: Zipfile member name of the layer's PNG.
+        :param int x: X offset of the layer, as for take_surface().
+        :param int y: Y offset of the layer, as for take_surface().
+
+        """
+        return (src, x, y) in self._layers
+
+    def get_surface(self, src, x, y):
+        """Makes a new surface with a layer's tiles, loaded lazily
+
+        :param unicode src: Zipfile member name of the layer's PNG.
+        :param int x: X offset of the layer.
+        :param int y: Y offset of the layer.
+        :returns: A new surface, or None if the layer isn't cached
+        :rtype: lib.tiledsurface.Surface
+
+        """
+        tiles = self._layers.get((src, x, y))
+        if tiles is None:
+            return None
+        surface = tiledsurface.Surface()
+        tiledict = {}
+        for tx, ty, offset, length in tiles:
+            record = _CacheRecord(self, offset, length)
+            tiledict[(tx, ty)] = tiledsurface._Tile.new_unloaded(record)
+        surface._load_tiledict(tiledict)
+        return surface
+
+    def _read(self, offset, length):
+        """Gets compressed data from the file (any thread)"""
+        return self._mmap[offset:offset+length]
+
+    def _get_file_state(self, path):
+        """Internal: describes the cache file, for appending to it
+
+        :returns: ((st_dev, st_ino), size, {tile: (offset, length)}),
+            or None if the cache isn't at the path.
+
+        """
+        if path != self.path or self._file_id is None:
+            return None
+        return (self._file_id, len(self._mmap), {})
+
+
+class _CacheRecord (object):
+    """Where the pixels of a cached tile are, and how to load them"""
+
+    __slots__ = ("cache", "offset", "length")
+
+    def __init__(self, cache, offset, length):
+        self.cache = cache
+        self.offset = offset
+        self.length = length
+
+    def load(self):
+        """Returns a new array with the tile's pixels"""
+        data = zlib.decompress(self.cache._read(self.offset, self.length))
+        rgba = np.frombuffer(data, dtype='uint16')
+        return rgba.reshape((N, N, 4)).copy()
+
+
+class TileCacheWriter (object):
+    """Collects layer surfaces, and writes them to a tile cache
+
+    Writers are filled in by the OpenRaster loader and savers, keyed in
+    the same way as the tile cache. Add snapshots: they stay valid
+    while the document is being edited, and the tiles they share
+    aren't written to in place.
+
+    Saving a document again usually changes only a few of its layers.
+    A writer given the cache or writer behind the current cache file
+    as `previous` appends just the tiles which aren't in that file
+    yet, followed by a new index. Shared tiles never change, so tiles
+    are matched by identity. The file is only rewritten in full when
+    more than `MAX_GARBAGE` of it would be left unused.
+
+    >>> import shutil
+    >>> tmpdir = tempfile.mkdtemp()
+    >>> ora_path = os.path.join(tmpdir, "test.ora")
+    >>> surf = tiledsurface.Surface()
+    >>> for tx in xrange(4):
+    ...     with surf.tile_request(tx, 0, readonly=False) as t:
+    ...         t[...] = np.random.randint(1 << 15, size=t.shape)
+    >>> def save(previous):
+    ...     with open(ora_path, "ab") as fp:
+    ...         fp.write("saved")
+    ...     writer = TileCacheWriter(previous)
+    ...     writer.add(u"data/layer-00.png", 0, 0, surf.save_snapshot())
+    ...     writer.write(tmpdir, ora_path)
+    ...     return writer
+    >>> writer = save(None)
+    >>> cache_path = get_cache_path(tmpdir, ora_path)
+    >>> size1 = os.path.getsize(cache_path)
+    >>> with surf.tile_request(0, 0, readonly=False) as t:
+    ...     t[...] = 1 << 14
+    >>> writer = save(writer)
+    >>> size2 = os.path.getsize(cache_path)
+    >>> size1 < size2 < 2 * size1
+    True
+    >>> cache = TileCache.open(tmpdir, ora_path)
+    >>> loaded = cache.get_surface(u"data/layer-00.png", 0, 0)
+    >>> def same(tx):
+    ...     rgba = loaded.tiledict[(tx, 0)].rgba
+    ...     return (rgba == surf.tiledict[(tx, 0)].rgba).all()
+    >>> all(same(tx) for tx in xrange(4))
+    True
+    >>> shutil.rmtree(tmpdir)
+
+    """
+
+    def __init__(self, previous=None):
+        """Initialize, with nothing added
+
+        :param previous: What wrote or read the current cache file.
+        :type previous: TileCacheWriter or TileCache or None
+
+        """
+        super(TileCacheWriter, self).__init__()
+        self._surfaces = {}  # {(src, x, y): (tiledict, dtx, dty)}
+        self._valid = True
+        self._previous = previous
+        self._lock = threading.Lock()
+        self._file_state = None  # like _get_file_state(), once written
+
+    def add(self, src, x, y, sshot, dx=0, dy=0):
+        """Adds a surface snapshot for a layer PNG
+
+        :param unicode src: Zipfile member name of the layer's PNG.
+        :param int x: X offset of the layer when loaded.
+        :param int y: Y offset of the layer when loaded.
+        :param sshot: Snapshot of the surface the PNG was made from.
+        :param int dx: Model X offset from the surface to the loaded one.
+        :param int dy: Model Y offset from the surface to the loaded one.
+
+        The offsets must be whole numbers of tiles, or nothing will be
+        written. Reloaded layers are offset by the frame's origin.
+
+        """
+        if dx % N or dy % N:
+            self._valid = False
+            return
+        # Copy the tile dict now: the worker mustn't read the live map.
+        tiledict = dict(sshot.tiledict)
+        self._surfaces[(src, x, y)] = (tiledict, dx // N, dy // N)
+
+    def write(self, cache_dir, ora_path, signature=None):
+        """Writes the collected surfaces to the cache for a file
+
+        :param unicode cache_dir: Directory holding tile caches.
+        :param unicode ora_path: The OpenRaster file, as saved.
+        :param tuple signature: The file's signature, if known already.
+        :returns: True if a cache file was written
+        :rtype: bool
+
+        """
+        if signature is None:
+            signature = _get_file_signature(ora_path)
+        surfaces = self._surfaces
+        previous = self._previous
+        # Only the written file's layout is needed after this.
+        self._surfaces = {}
+        self._previous = None
+        if not (self._valid and surfaces and signature):
+            return False
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        path = get_cache_path(cache_dir, ora_path)
+        with _WRITE_LOCK:
+            if _get_file_signature(ora_path) != signature:
+                logger.debug("%r changed: not caching it", ora_path)
+                return False
+            prev_state = None
+            if previous is not None:
+                prev_state = previous._get_file_state(path)
+            if prev_state is not None:
+                file_state = self._append_file(path, surfaces, signature,
+                                               prev_state)
+                if file_state is not None:
+                    logger.info("Updated tile cache %r for %r",
+                                path, ora_path)
+                    with self._lock:
+                        self._file_state = file_state
+                    return True
+            fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=cache_dir)
+            try:
+                with os.fdopen(fd, "wb") as fp:
+                    offsets = self._write_file(fp, surfaces, signature)
+                    fp.flush()
+                    st = os.fstat(fp.fileno())
+                lib.fileutils.replace(tmp_path, path)
+            except:
+                if os.path.exists(tmp_path):
+                    os.unlink(tmp_path)
+                raise
+            with self._lock:
+                self._file_state = (path, (st.st_dev, st.st_ino),
+                                    st.st_size, offsets)
+        logger.info("Wrote tile cache %r for %r", path, ora_path)
+        _prune(cache_dir, keep=path)
+        return True
+
+    def _get_file_state(self, path):
+        """Internal: describes the cache file written, for appending
+
+        :returns: ((st_dev, st_ino), size, {tile: (offset, length)}),
+            or None if nothing was written to the path.
+
+        """
+        with self._lock:
+            if self._file_state is None:
+                return None
+            written_path, file_id, size, offsets = self._file_state
+        if written_path != path:
+            return None
+        return (file_id, size, offsets)
+
+    def write_in_background(self, cache_dir, ora_path):
+        """Writes the cache from the shared worker pool
+
+        :returns: A future for the result of `write()`.
+        :rtype: lib.workerpool.Future
+
+        Failures are logged, and don't matter beyond that. The file's
+        signature is taken now, so that the cache is never valid for
+        a file that's rewritten before the worker gets to it.
+
+        """
+        signature = _get_file_signature(ora_path)
+        pool = lib.workerpool.get_pool()
+        return pool.submit(
+            self._write_logging_errors,
+            cache_dir, ora_path, signature,
+        )
+
+    def _write_logging_errors(self, cache_dir, ora_path, signature):
+        """Worker: writes the cache, logging any failure"""
+        try:
+            return self.write(cache_dir, ora_path, signature)
+        except Exception:
+            logger.exception("Failed to write tile cache for %r", ora_path)
+            return False
+
+    def _write_file(self, fp, surfaces, signature):
+        """Writes a new cache file's data, index, and trailer
+
+        :returns: {tile: (offset, length)} for the tiles written.
+
+        """
+        fp.write(MAGIC)
+        return self._write_data(fp, len(MAGIC), surfaces, signature, {})
+
+    def _append_file(self, path, surfaces, signature, prev_state):
+        """Appends new tiles and an index to an existing cache file
+
+        :returns: Like _get_file_state(), or None if a full rewrite
+            is needed instead.
+
+        """
+        file_id, size, prev_offsets = prev_state
+        reused = {}
+        reused_bytes = 0
+        for tiledict, dtx, dty in surfaces.itervalues():
+            for tile in tiledict.itervalues():
+                extent = _find_tile_data(tile, file_id, prev_offsets)
+                if extent is not None and tile not in reused:
+                    reused[tile] = extent
+                    reused_bytes += extent[1]
+        if size - reused_bytes > size * MAX_GARBAGE:
+            return None
+        try:
+            fp = open(path, "r+b")
+        except EnvironmentError:
+            return None
+        with fp:
+            st = os.fstat(fp.fileno())
+            if (st.st_dev, st.st_ino) != file_id or st.st_size != size:
+                return None
+            fp.seek(size)
+            offsets = self._write_data(fp, size, surfaces,
+                                       signature, reused)
+            size = fp.tell()
+        return (path, file_id, size, offsets)
+
+    def _write_data(self, fp, offset, surfaces, signature, reused):
+        """Writes tile data, index, and trailer at an offset
+
+        :param dict reused: {tile: (offset, length)} already in the file
+
+        """
+        offsets = weakref.WeakKeyDictionary(reused)
+        layers = []
+        for (src, x, y), (tiledict, dtx, dty) in surfaces.iteritems():
+            tiles = []
+            for (tx, ty), tile in tiledict.iteritems():
+                extent = offsets.get(tile)
+                if extent is None:
+                    data = _get_compressed_tile_data(tile)
+                    if data is None:
+                        continue
+                    fp.write(data)
+                    extent = (offset, len(data))
+                    offsets[tile] = extent
+                    offset += len(data)
+                tiles.append([tx + dtx, ty + dty, extent[0], extent[1]])
+            layers.append([src, x, y, tiles])
+        index = {
+            "source": list(signature),
+            "layers": layers,
+        }
+        index_data = zlib.compress(json.dumps(index))
+        fp.write(index_data)
+        fp.write(_TRAILER.pack(offset, len(index_data)))
+        fp.write(MAGIC)
+        return offsets
+
+
+## Helper functions
+
+
+def get_cache_path(cache_dir, ora_path):
+    """Gets the path of the tile cache for an OpenRaster file
+
+    :param unicode cache_dir: Directory holding tile caches.
+    :param unicode ora_path: The OpenRaster file.
+    :rtype: unicode
+
+    """
+    real_path = os.path.realpath(ora_path)
+    if isinstance(real_path, unicode):
+        real_path = real_path.encode(sys.getfilesystemencoding())
+    digest = hashlib.sha1(real_path).hexdigest()
+    return os.path.join(cache_dir, unicode(digest) + SUFFIX)
+
+
+def _get_file_signature(path):
+    """Gets (size, mtime) for a file, or None if it doesn't exist"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_size, st.st_mtime)
+
+
+def _get_compressed_tile_data(tile):
+    """Gets a tile's compressed pixels, or None if it's empty
+
+    Tiles whose pixels are elsewhere are not loaded into memory.
+    Compressed data from other tile caches is reused as it is.
+
+    """
+    tile_dict = tile.__dict__
+    rgba = tile_dict.get("rgba")
+    if rgba is None:
+        record = tile_dict.get("_spilled")
+        if record is None:
+            # Reloads set "rgba" before they remove "_spilled".
+            rgba = tile_dict.get("rgba")
+            return _compress_tile_data(rgba)
+        if isinstance(record, _CacheRecord):
+            return record.cache._read(record.offset, record.length)
+        rgba = record.load()
+    return _compress_tile_data(rgba)
+
+
+def _find_tile_data(tile, file_id, offsets):
+    """Finds where a tile's compressed pixels are in a cache file
+
+    :param tuple file_id: (st_dev, st_ino) of the cache file.
+    :param offsets: {tile: (offset, length)} written to the file.
+    :returns: (offset, length), or None if the tile isn't in the file.
+
+    """
+    record = tile.__dict__.get("_spilled")
+    if isinstance(record, _CacheRecord):
+        if record.cache._file_id == file_id:
+            return (record.offset, record.length)
+        return None
+    return offsets.get(tile)
+
+
+def _compress_tile_data(rgba):
+    """Compresses a tile's pixels, or returns None if they're empty"""
+    if rgba is None or not rgba.any():
+        return None
+    return zlib.compress(rgba.tostring(), COMPRESSION_LEVEL)
+
+
+def _read_index(mm):
+    """Reads and decodes the index of a memory-mapped cache file"""
+    tail_size = _TRAILER.size + len(MAGIC)
+    if len(mm) < len(MAGIC) + tail_size:
+        raise ValueError("Tile cache file is truncated")
+    if mm[:len(MAGIC)] != MAGIC or mm[-len(MAGIC):] != MAGIC:
+        raise ValueError("Not a tile cache file")
+    trailer = mm[-tail_size:-len(MAGIC)]
+    offset, length = _TRAILER.unpack(trailer)
+    if offset + length + tail_size != len(mm):
+        raise ValueError("Tile cache index is corrupt")
+    return json.loads(zlib.decompress(mm[offset:offset+length]))
+
+
+def _prune(cache_dir, keep):
+    """Removes the least recently written cache files beyond MAX_FILES"""
+    paths = []
+    for name in os.listdir(cache_dir):
+        if name.endswith(SUFFIX):
+            path = os.path.join(cache_dir, name)
+            if path != keep:
+                paths.append((os.path.getmtime(path), path))
+    paths.sort(reverse=True)
+    for mtime, path in paths[MAX_FILES-1:]:
+        logger.debug("Removing old tile cache %r", path)
+        try:
+            os.unlink(path)
+        except OSError:
+            logger.exception("Failed to remove %r", path)
+
+
+## Module testing
+
+
+def _test():
+    """Run doctest strings"""
+    import doctest
+    doctest.testmod(optionflags=doctest.ELLIPSIS)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG)
+    _test()
@@ -17,6 +17,8 @@ import sys
 import os
 import contextlib
 import logging
+import itertools
+import weakref
 
 from gettext import gettext as _
 import numpy as np
@@ -54,15 +56,22 @@ for sym_type in SYMMETRY_TYPES:
 ## Tile class and marker tile constants
 
 class _Tile (object):
-    """Internal tile storage, with readonly flag
+    """Internal tile storage, with readonly flag and generation stamp
 
     Note: pixels are stored with premultiplied alpha.
     15 bits are used, but fully opaque or white is stored as 2**15
     (requiring 16 bits). This is to allow many calcuations to divide by
     2**15 instead of (2**16-1).
 
+    Each tile is stamped with a generation number when it's created.
+    Tile maps use these to tell which of their tiles are shared with
+    snapshots (see `_TileMap.share_all()`).
+
     """
 
+    #: Source of generation stamps for new tiles.
+    _generations = itertools.count(1)
+
     def __init__(self, copy_from=None):
         super(_Tile, self).__init__()
         if copy_from is None:
@@ -70,6 +79,35 @@ class _Tile (object):
         else:
             self.rgba = copy_from.rgba.copy()
         self.readonly = False
+        self.generation = next(_Tile._generations)
+
+    def __getattr__(self, name):
+        """Reloads pixel data moved to disk by lib.tilespill"""
+        record = self.__dict__.get("_spilled")
+        if name != "rgba" or record is None:
+            raise AttributeError(name)
+        rgba = record.load()
+        # Another thread may have loaded the same record meanwhile, and
+        # even written to its pixels: keep whichever was installed first.
+        rgba = self.__dict__.setdefault("rgba", rgba)
+        self.__dict__.pop("_spilled", None)
+        return rgba
+
+    @classmethod
+    def new_unloaded(cls, record):
+        """New tile whose pixels are loaded from a record when needed
+
+        :param record: Object with a load() method returning the pixels.
+
+        The record is used in the same way as the ones which
+        lib.tilespill makes for tiles it moves to disk.
+
+        """
+        tile = cls.__new__(cls)
+        tile._spilled = record
+        tile.readonly = False
+        tile.generation = next(cls._generations)
+        return tile
 
     def copy(self):
         return _Tile(copy_from=self)
@@ -86,8 +124,359 @@ del mipmap_dirty_tile.rgba
 
 ## Class defs: surfaces
 
+class _TileMap (dict):
+    """Tile dictionary which can be snapshotted in constant time.
+
+    While any snapshots of the map are alive, every write to it is
+    journalled as the position and the tile which was there before
+    (None if the slot was empty). A snapshot just remembers how long
+    the journal was when it was taken. Finding or undoing the changes
+    made since a snapshot only replays the journal from that point, so
+    its cost depends on how many tiles were written, and not on how
+    many tiles the map holds.
+
+    >>> m = _TileMap()
+    >>> m[(0, 0)] = "a"
+    >>> m[(1, 0)] = "b"
+    >>> sshot = _SurfaceSnapshot(m)
+    >>> m[(0, 0)] = "c"
+    >>> del m[(1, 0)]
+    >>> m[(2, 0)] = "d"
+    >>> sorted(m.get_changes_since(sshot).items())
+    [((0, 0), 'a'), ((1, 0), 'b'), ((2, 0), None)]
+    >>> sorted(sshot.tiledict.items())
+    [((0, 0), 'a'), ((1, 0), 'b')]
+
+    The journal is discarded when no snapshots need it any more.
+
+    >>> del sshot
+    >>> m[(3, 0)] = "e"
+    >>> len(m._journal)
+    0
+
+    Snapshots share all the map's existing tiles, so that they aren't
+    written to in place any more. Other maps' tiles aren't affected.
+
+    >>> t1 = _Tile()
+    >>> t2 = _Tile()
+    >>> m1 = _TileMap({(0, 0): t1})
+    >>> m2 = _TileMap({(0, 0): t2})
+    >>> m1.is_shared(t1)
+    False
+    >>> sshot = _SurfaceSnapshot(m1)
+    >>> m1.is_shared(t1), m2.is_shared(t2)
+    (True, False)
+    >>> m1.is_shared(t1.copy())
+    False
+
+    """
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self._journal = []  # [(pos, old_tile_or_None)]
+        self._journal_start = 0  # journal index of self._journal[0]
+        self._snapshots = weakref.WeakSet()
+        self._trackers = weakref.WeakSet()
+        self._shared_generation = 0  # tiles up to this one are shared
+
+    ## Sharing tiles
+
+    def share_all(self):
+        """Marks all the tiles in the map as shared, in constant time
+
+        Shared tiles must be copied before they're written to. Sharing
+        is done by remembering the latest tile generation, so tiles
+        created from now on are not shared.
+
+        """
+        self._shared_generation = next(_Tile._generations)
+
+    def is_shared(self, tile):
+        """True if a tile of this map must be copied before writing"""
+        return tile.readonly or tile.generation <= self._shared_generation
+
+    ## Journalled writes
+
+    def _log(self, pos):
+        if self._trackers:
+            self._note_write(pos, dict.get(self, pos))
+        if self._snapshots:
+            self._journal.append((pos, dict.get(self, pos)))
+        elif self._journal:
+            self._trim_journal()
+
+    def _note_write(self, pos, old_tile):
+        for tracker in self._trackers:
+            tracker._note_write(pos, old_tile)
+
+    def __setitem__(self, pos, tile):
+        if dict.get(self, pos) is not tile:
+            self._log(pos)
+        dict.__setitem__(self, pos, tile)
+
+    def __delitem__(self, pos):
+        self._log(pos)
+        dict.__delitem__(self, pos)
+
+    def pop(self, pos, *default):
+        if pos in self:
+            self._log(pos)
+        return dict.pop(self, pos, *default)
+
+    def popitem(self):
+        pos, tile = dict.popitem(self)
+        if self._trackers:
+            self._note_write(pos, tile)
+        if self._snapshots:
+            self._journal.append((pos, tile))
+        return pos, tile
+
+    def setdefault(self, pos, default=None):
+        if pos not in self:
+            self[pos] = default
+        return dict.__getitem__(self, pos)
+
+    def update(self, *args, **kwargs):
+        for pos, tile in dict(*args, **kwargs).iteritems():
+            self[pos] = tile
+
+    def clear(self):
+        for pos in self.keys():
+            self._log(pos)
+        dict.clear(self)
+
+    ## Write generations
+
+    @property
+    def generation(self):
+        """The map's write generation: the number of journalled writes
+
+        Snapshots record the generation at which they were taken, and
+        the map can be asked which tiles were written since then.
+
+        """
+        return self._journal_start + len(self._journal)
+
+    def track_changes(self):
+        """Starts tracking which tiles change, without keeping any
+
+        :rtype: _ChangeTracker
+
+        """
+        self.share_all()
+        tracker = _ChangeTracker(self)
+        self._trackers.add(tracker)
+        return tracker
+
+    def _add_snapshot(self, sshot):
+        """Registers a new snapshot, returning the current generation"""
+        self.share_all()
+        self._trim_journal()
+        self._snapshots.add(sshot)
+        return self.generation
+
+    def _trim_journal(self):
+        """Drops journal entries which no live snapshot needs"""
+        generations = [s.generation for s in self._snapshots]
+        keep_from = min(generations) if generations else self.generation
+        del self._journal[:keep_from - self._journal_start]
+        self._journal_start = keep_from
+
+    def _iter_journal_since(self, sshot):
+        """Iterates over (pos, old_tile) writes made since a snapshot"""
+        assert sshot.tilemap is self
+        start = sshot.generation - self._journal_start
+        assert start >= 0
+        return itertools.islice(self._journal, start, None)
+
+    def _get_tiles_at(self, sshot):
+        """Returns {pos: tile_or_None} at a snapshot, for positions
+        written to since then"""
+        tiles = {}
+        for pos, old_tile in self._iter_journal_since(sshot):
+            if pos not in tiles:
+                tiles[pos] = old_tile
+        return tiles
+
+    def get_written_since(self, sshot):
+        """Returns the positions of the tiles written since a snapshot
+
+        :param _SurfaceSnapshot sshot: A snapshot of this map.
+        :rtype: set
+
+        The cost is proportional to the number of writes made since the
+        snapshot was taken, not to the number of tiles in the map.
+
+        """
+        return set(pos for (pos, old) in self._iter_journal_since(sshot))
+
+    def get_changes_since(self, sshot):
+        """Returns the tiles changed since a snapshot, with old values
+
+        :param _SurfaceSnapshot sshot: A snapshot of this map.
+        :returns: {(tx, ty): tile_in_snapshot_or_None}
+        :rtype: dict
+
+        Positions which were written to, but which have the same tile
+        now as in the snapshot, are omitted.
+
+        """
+        changes = self._get_tiles_at(sshot)
+        for pos, old_tile in list(changes.items()):
+            if dict.get(self, pos) is old_tile:
+                del changes[pos]
+        return changes
+
+    def get_changes_between(self, sshot1, sshot2):
+        """Returns the tiles which differ between two snapshots
+
+        :param _SurfaceSnapshot sshot1: A snapshot of this map.
+        :param _SurfaceSnapshot sshot2: A later snapshot of this map.
+        :returns: {(tx, ty): (tile1_or_None, tile2_or_None)}
+        :rtype: dict
+
+        >>> m = _TileMap({(0, 0): "a", (1, 0): "b"})
+        >>> s1 = _SurfaceSnapshot(m)
+        >>> m[(0, 0)] = "c"
+        >>> m[(2, 0)] = "d"
+        >>> s2 = _SurfaceSnapshot(m)
+        >>> m[(2, 0)] = "e"
+        >>> m[(1, 0)] = "f"
+        >>> sorted(m.get_changes_between(s1, s2).items())
+        [((0, 0), ('a', 'c')), ((2, 0), (None, 'd'))]
+
+        """
+        assert sshot1.generation <= sshot2.generation
+        tiles1 = self._get_tiles_at(sshot1)
+        tiles2 = self._get_tiles_at(sshot2)
+        changes = {}
+        for pos, tile1 in tiles1.iteritems():
+            tile2 = tiles2.get(pos, dict.get(self, pos))
+            if tile1 is not tile2:
+                changes[pos] = (tile1, tile2)
+        return changes
+
+
 class _SurfaceSnapshot (object):
-    pass
+    """Constant-time snapshot of the tiles of a surface
+
+    Snapshots refer to the live `_TileMap` of the surface, and to its
+    write generation when they were taken. The snapshotted tiles are
+    only copied into a plain dict if something asks for the `tiledict`.
+
+    """
+
+    def __init__(self, tilemap):
+        super(_SurfaceSnapshot, self).__init__()
+        self.tilemap = tilemap
+        self.generation = tilemap._add_snapshot(self)
+        self._tiledict = None
+
+    @property
+    def tiledict(self):
+        """The snapshotted tiles, as a dict (built on first access)"""
+        if self._tiledict is None:
+            d = dict(self.tilemap)
+            changes = self.tilemap.get_changes_since(self)
+            for pos, tile in changes.iteritems():
+                if tile is None:
+                    d.pop(pos, None)
+                else:
+                    d[pos] = tile
+            self._tiledict = d
+        return self._tiledict
+
+    def get_changed_tiles(self, other):
+        """Returns the tiles which differ in another, later snapshot
+
+        :param _SurfaceSnapshot other: A later snapshot.
+        :returns: {(tx, ty): (tile_here_or_None, tile_there_or_None)}
+        :rtype: dict
+
+        For snapshots of the same surface, this only looks at the tiles
+        written between the two. Otherwise, all tiles are compared.
+
+        """
+        if other.tilemap is self.tilemap:
+            return self.tilemap.get_changes_between(self, other)
+        d1 = self.tiledict
+        d2 = other.tiledict
+        changes = {}
+        for pos in set(d1).union(d2):
+            tile1 = d1.get(pos)
+            tile2 = d2.get(pos)
+            if tile1 is not tile2:
+                changes[pos] = (tile1, tile2)
+        return changes
+
+
+class _ChangeTracker (object):
+    """Tracks which tiles of a tile map change, without holding them
+
+    For each position written to since it was made, a tracker records
+    the generation of the tile which was there first. Unlike a
+    snapshot, it keeps no old tiles alive, and it doesn't make the map
+    journal its writes. Making a tracker shares the map's tiles, so any
+    tile still in place when asked has not been written to since.
+
+    >>> old = _Tile()
+    >>> m = _TileMap({(0, 0): old, (1, 0): _Tile()})
+    >>> tracker = m.track_changes()
+    >>> tracker.get_changed()
+    set([])
+    >>> m[(0, 0)] = _Tile()
+    >>> m[(2, 0)] = _Tile()
+    >>> sorted(tracker.get_changed())
+    [(0, 0), (2, 0)]
+
+    Positions which have their old tiles back are unchanged, e.g.
+    after an undo.
+
+    >>> m[(0, 0)] = old
+    >>> del m[(2, 0)]
+    >>> tracker.get_changed()
+    set([])
+
+    """
+
+    def __init__(self, tilemap):
+        super(_ChangeTracker, self).__init__()
+        self._tilemap_ref = weakref.ref(tilemap)
+        self._generations = {}  # {pos: first_generation_or_None}
+
+    @property
+    def tilemap(self):
+        """The tracked tile map, or None if it no longer exists"""
+        return self._tilemap_ref()
+
+    def _note_write(self, pos, old_tile):
+        if pos not in self._generations:
+            self._generations[pos] = _get_tile_generation(old_tile)
+
+    def get_changed(self):
+        """Returns the positions of the tiles changed since tracking began
+
+        :rtype: set
+
+        The cost depends only on how many positions were written to.
+
+        """
+        tilemap = self.tilemap
+        changed = set()
+        for pos, generation in self._generations.iteritems():
+            tile = None
+            if tilemap is not None:
+                tile = dict.get(tilemap, pos)
+            if _get_tile_generation(tile) != generation:
+                changed.add(pos)
+        return changed
+
+
+def _get_tile_generation(tile):
+    """Generation of a tile, or None for empty slots"""
+    if tile is None:
+        return None
+    return tile.generation
 
 
 # TODO:
@@ -104,7 +493,7 @@ class MyPaintSurface (TileAccessible, TileBlittable, TileCompositable):
 
         # TODO: pass just what it needs access to, not all of self
         self._backend = mypaintlib.TiledSurface(self)
-        self.tiledict = {}
+        self.tiledict = _TileMap()
         self.observers = []
 
         # Used to implement repeating surfaces, like Background
@@ -168,7 +557,7 @@ class MyPaintSurface (TileAccessible, TileBlittable, TileCompositable):
 
     def clear(self):
         tiles = self.tiledict.keys()
-        self.tiledict = {}
+        self.tiledict.clear()
         self.notify_observers(*lib.surface.get_tiles_bbox(tiles))
         if self.mipmap:
             self.mipmap.clear()
@@ -304,7 +693,7 @@ class MyPaintSurface (TileAccessible, TileBlittable, TileCompositable):
                 self.tiledict[(tx, ty)] = t
         if t is mipmap_dirty_tile:
             t = self._regenerate_mipmap(t, tx, ty)
-        if t.readonly and not readonly:
+        if not readonly and self.tiledict.is_shared(t):
             # shared memory, get a private copy for writing
             t = t.copy()
             self.tiledict[(tx, ty)] = t
@@ -419,20 +808,49 @@ class MyPaintSurface (TileAccessible, TileBlittable, TileCompositable):
     def save_snapshot(self):
         """Creates and returns a snapshot of the surface
 
-        Snapshotting marks all the tiles of the surface as read-only,
-        then just shallow-copes the tiledict. It's quick. See
-        tile_request() for how new read/write tiles can be unlocked.
+        Snapshotting shares all of the surface's existing tiles by
+        advancing its tile map's shared generation, then records a
+        position in the map's journal of writes. It takes constant time.
+        See tile_request() for how new read/write tiles can be unlocked.
 
         """
-        sshot = _SurfaceSnapshot()
-        for t in self.tiledict.itervalues():
-            t.readonly = True
-        sshot.tiledict = self.tiledict.copy()
-        return sshot
+        return _SurfaceSnapshot(self.tiledict)
 
     def load_snapshot(self, sshot):
-        """Loads a saved snapshot, replacing the internal tiledict"""
-        self._load_tiledict(sshot.tiledict)
+        """Loads a saved snapshot, replacing the internal tiledict
+
+        Snapshots of this surface's own tile map are restored by undoing
+        just the writes made since, so small strokes are quick to undo
+        and redo even on huge layers. Other snapshots are loaded by
+        comparing the whole tiledict.
+
+        >>> surf = MyPaintSurface()
+        >>> with surf.tile_request(0, 0, readonly=False) as t:
+        ...     t[...] = 1<<15
+        >>> before = surf.save_snapshot()
+        >>> with surf.tile_request(1, 0, readonly=False) as t:
+        ...     t[...] = 1<<15
+        >>> after = surf.save_snapshot()
+        >>> surf.load_snapshot(before)
+        >>> sorted(surf.tiledict.keys())
+        [(0, 0)]
+        >>> surf.load_snapshot(after)
+        >>> sorted(surf.tiledict.keys())
+        [(0, 0), (1, 0)]
+
+        """
+        if sshot.tilemap is self.tiledict:
+            changes = self.tiledict.get_changes_since(sshot)
+            for pos, tile in changes.iteritems():
+                if tile is None:
+                    self.tiledict.pop(pos)
+                else:
+                    self.tiledict[pos] = tile
+            self._notify_tiles_changed(changes)
+        else:
+            # The other surface's tiles are shared with it now
+            self._load_tiledict(sshot.tiledict)
+            self.tiledict.share_all()
 
     def _load_tiledict(self, d):
         """Efficiently loads a tiledict, and notifies the observers"""
@@ -441,25 +859,117 @@ class MyPaintSurface (TileAccessible, TileBlittable, TileCompositable):
             # testcase: comparison above (if equal) takes 0.6ms,
             # code below 30ms
             return
-        old = set(self.tiledict.iteritems())
-        self.tiledict = d.copy()
-        new = set(self.tiledict.iteritems())
-        dirty = old.symmetric_difference(new)
-        for pos, tile in dirty:
+        # Update the tile map in place, so that it keeps its journal
+        tiledict = self.tiledict
+        dirty = set(pos for pos in tiledict if pos not in d)
+        for pos in dirty:
+            tiledict.pop(pos)
+        for pos, tile in d.iteritems():
+            if tiledict.get(pos) is not tile:
+                tiledict[pos] = tile
+                dirty.add(pos)
+        self._notify_tiles_changed(dirty)
+
+    def _notify_tiles_changed(self, positions):
+        """Marks tiles' mipmaps dirty, and notifies the observers"""
+        positions = set(positions)
+        for pos in positions:
             self._mark_mipmap_dirty(*pos)
-        bbox = lib.surface.get_tiles_bbox(pos for (pos, tile) in dirty)
+        bbox = lib.surface.get_tiles_bbox(positions)
         if not bbox.empty():
             self.notify_observers(*bbox)
 
+    def get_tiles_changed_since(self, sshot):
+        """Returns the positions of tiles changed since a snapshot
+
+        :param _SurfaceSnapshot sshot: A snapshot of this surface.
+        :rtype: set
+
+        For snapshots of the current tile map, the cost depends only on
+        how many tiles were written since the snapshot was taken.
+
+        >>> surf = MyPaintSurface()
+        >>> sshot = surf.save_snapshot()
+        >>> surf.get_tiles_changed_since(sshot)
+        set([])
+        >>> with surf.tile_request(3, 4, readonly=False) as t:
+        ...     t[...] = 1<<15
+        >>> surf.get_tiles_changed_since(sshot)
+        set([(3, 4)])
+
+        """
+        if sshot.tilemap is self.tiledict:
+            return set(self.tiledict.get_changes_since(sshot))
+        current = self.save_snapshot()
+        return set(sshot.get_changed_tiles(current))
+
+    def track_changes(self):
+        """Starts tracking which tiles of the surface change
+
+        :rtype: _ChangeTracker
+
+        Trackers are cheaper than snapshots for telling whether a
+        surface was changed, because they keep no old tiles alive.
+
+        >>> surf = MyPaintSurface()
+        >>> tracker = surf.track_changes()
+        >>> with surf.tile_request(3, 4, readonly=False) as t:
+        ...     t[...] = 1<<15
+        >>> tracker.get_changed()
+        set([(3, 4)])
+
+        """
+        return self.tiledict.track_changes()
+
+    def get_unloaded_tiles(self):
+        """Returns the tiles whose pixels have yet to be loaded
+
+        :rtype: list
+
+        These are tiles whose pixels were moved out of memory, or which
+        were never loaded yet (see `_Tile.new_unloaded()`). Accessing
+        their `rgba` loads them, from any thread.
+
+        """
+        return [t for t in self.tiledict.itervalues()
+                if "_spilled" in t.__dict__]
+
     ## Loading tile data
 
     def load_from_surface(self, other):
         """Loads tile data from another surface, via a snapshot"""
         self.load_snapshot(other.save_snapshot())
 
+    def take_tiles(self, other):
+        """Moves all the tiles of another surface into this one
+
+        The other surface is left empty. Unlike `load_from_surface()`,
+        this doesn't share the tiles with the other surface, so they
+        can still be written to in place afterwards, unless something
+        else already shares them.
+
+        >>> src = MyPaintSurface()
+        >>> with src.tile_request(0, 0, readonly=False) as t:
+        ...     t[...] = 1<<15
+        >>> tile = src.tiledict[0, 0]
+        >>> surf = MyPaintSurface()
+        >>> surf.take_tiles(src)
+        >>> len(src.tiledict), surf.tiledict[0, 0] is tile
+        (0, True)
+        >>> surf.tiledict.is_shared(tile)
+        False
+
+        """
+        tiledict = dict(other.tiledict)
+        shared = any(other.tiledict.is_shared(t) for t in tiledict.values())
+        other.tiledict.clear()
+        self._load_tiledict(tiledict)
+        if shared:
+            self.tiledict.share_all()
+
     def _load_from_pixbufsurface(self, s):
         dirty_tiles = set(self.tiledict.keys())
-        self.tiledict = {}
+        self.tiledict.clear()
 
         for tx, ty in s.get_tiles():
             with self.tile_request(tx, ty, readonly=False) as dst:
@@ -508,6 +1018,49 @@ class MyPaintSurface (TileAccessible, TileBlittable, TileCompositable):
         string when conversion or PNG reading fails.
 
         """
+        if sys.platform == 'win32':
+            filename_sys = filename.encode("utf-8")
+        else:
+            filename_sys = filename.encode(sys.getfilesystemencoding())
+            # FIXME: should not do that, should use open(unicode_object)
+        return self._load_from_png_progressive(
+            mypaintlib.load_png_fast_progressive,
+            filename_sys,
+            x, y,
+            progress=progress,
+            convert_to_srgb=convert_to_srgb,
+        )
+
+    def load_from_png_file(self, fp, x, y, progress=None,
+                           convert_to_srgb=True,
+                           **kwargs):
+        """Load from a PNG stream, one tilerow at a time.
+
+        :param fp: File-like object to read the PNG data from
+        :param int x: X-coordinate at which to load the replacement data
+        :param int y: Y-coordinate at which to load the replacement data
+        :param bool convert_to_srgb: If True, convert to sRGB
+        :param progress: Unsized UI feedback obj.
+        :type progress: lib.feedback.Progress or None
+        :param dict \*\*kwargs: Ignored
+
+        This works like `load_from_png()`, but only needs `fp.read()`,
+        so it can decode straight from a zipfile member without
+        extracting it first. Only one row of tiles is held in memory
+        at a time while decoding.
+
+        """
+        return self._load_from_png_progressive(
+            mypaintlib.load_png_fast_progressive_from_file,
+            fp,
+            x, y,
+            progress=progress,
+            convert_to_srgb=convert_to_srgb,
+        )
+
+    def _load_from_png_progressive(self, loader, source, x, y, progress,
+                                   convert_to_srgb):
+        """Load via a mypaintlib progressive PNG loader function"""
         if not progress:
             progress = lib.feedback.Progress()
 
@@ -516,7 +1069,7 @@ class MyPaintSurface (TileAccessible, TileBlittable, TileCompositable):
             raise ValueError("progress arg must be unsized")
 
         dirty_tiles = set(self.tiledict.keys())
-        self.tiledict = {}
+        self.tiledict.clear()
 
         ty0 = int(y // N)
         state = {}
@@ -578,15 +1131,9 @@ class MyPaintSurface (TileAccessible, TileBlittable, TileCompositable):
                     logger.exception("Progress.completed() failed")
                     state["progress"] = None
 
-        if sys.platform == 'win32':
-            filename_sys = filename.encode("utf-8")
-        else:
-            filename_sys = filename.encode(sys.getfilesystemencoding())
-            # FIXME: should not do that, should use open(unicode_object)
-
         try:
-            flags = mypaintlib.load_png_fast_progressive(
-                filename_sys,
+            flags = loader(
+                source,
                 get_buffer,
                 convert_to_srgb,
             )
@@ -1292,15 +1839,20 @@ def flood_fill(src, x, y, color, bbox, tolerance, dst):
 class PNGFileUpdateTask (object):
     """Piecemeal callable: writes to or replaces a PNG file
 
-    See lib.autosave.Autosaveable.
+    See lib.autosave.Autosaveable. Autosaves favour speed over size, so
+    the default `png_compression` profile is "fast".
     """
 
     def __init__(self, surface, filename, rect, alpha,
                  single_tile_pattern=False,
                  save_srgb_chunks=False,
+                 png_compression="fast",
                  **kwargs):
         super(PNGFileUpdateTask, self).__init__()
         self._final_filename = filename
+        compression_args = lib.surface.get_png_compression_args(
+            png_compression,
+        )
         # Sizes. Save at least one tile to allow empty docs to be written
         if not rect:
             rect = surface.get_bbox()
@@ -1324,6 +1876,7 @@ class PNGFileUpdateTask (object):
             w, h,
             alpha,
             save_srgb_chunks,
+            *compression_args
         )
         self._tmp_filename = tmp_filename
         self._tmp_fp = tmp_fp
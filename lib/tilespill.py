@@ -0,0 +1,414 @@
+# This file is part of MyPaint.
+# Copyright (C) 2017 by the MyPaint Development Team.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+"""Compressed on-disk storage for the pixels of undo-only tiles."""
+
+
+## Imports
+
+from __future__ import division, print_function
+
+import os
+import zlib
+import threading
+import collections
+import weakref
+import Queue
+import logging
+
+import numpy as np
+from gi.repository import GLib
+
+import lib.feedback
+
+logger = logging.getLogger(__name__)
+
+
+## Class defs
+
+
+class TileSpillFile (object):
+    """Moves tile pixel data to a compressed file, and back again
+
+    Tiles which are only kept alive by the undo history don't need to
+    occupy memory until the user undoes far enough back to reach them.
+    A spill file compresses the pixel data of such tiles into a single
+    file in the working document's cache dir, and drops the in-memory
+    arrays. Compression and decompression happen in a worker thread,
+    and the results are applied to the tiles in the main thread.
+
+    Spilled tiles reload their pixels transparently when their `rgba`
+    is next accessed (see `lib.tiledsurface._Tile`), so correctness
+    never depends on a background reload having finished.
+
+    >>> import tempfile, shutil
+    >>> from lib.tiledsurface import _Tile
+    >>> tmpdir = tempfile.mkdtemp()
+    >>> spill = TileSpillFile(tmpdir)
+    >>> tile = _Tile()
+    >>> tile.rgba[...] = 42
+    >>> progress = spill.spill([tile])
+    >>> spill.flush()
+    >>> progress.fraction
+    1.0
+    >>> "rgba" in tile.__dict__
+    False
+    >>> int(tile.rgba[0, 0, 0])
+    42
+
+    The space used by spilled tiles which no longer exist is reused.
+
+    >>> size = os.path.getsize(spill.path)
+    >>> del tile
+    >>> tile = _Tile()
+    >>> tile.rgba[...] = 7
+    >>> progress = spill.spill([tile])
+    >>> spill.flush()
+    >>> os.path.getsize(spill.path) == size
+    True
+    >>> spill.close()
+    >>> shutil.rmtree(tmpdir)
+
+    Only tiles which will never be written to in place again can be
+    spilled. Callers must make sure that they're shared by every tile
+    map which holds them (see `lib.tiledsurface._TileMap.share_all()`).
+
+    """
+
+    #: Name of the spill file in the cache dir.
+    FILENAME = u"undo-tiles.spill"
+
+    #: zlib compression level: speed matters more than size here.
+    COMPRESSION_LEVEL = 1
+
+    #: Number of tiles to process before handing results back.
+    BATCH_SIZE = 64
+
+    #: Space in the file is allocated in multiples of this many bytes.
+    EXTENT_GRANULARITY = 1024
+
+    def __init__(self, dirname):
+        """Initialize, creating an empty spill file
+
+        :param unicode dirname: Directory to create the spill file in.
+
+        """
+        super(TileSpillFile, self).__init__()
+        self.path = os.path.join(dirname, self.FILENAME)
+        self._file = open(self.path, "w+b")
+        self._file_lock = threading.Lock()
+        self._jobs = Queue.Queue()
+        self._results = collections.deque()
+        self._thread = None
+        self._records = weakref.WeakSet()
+        self._pending = 0
+        self._closed = False
+        # Space allocation, guarded by the file lock
+        self._end = 0  # end of the allocated space
+        self._free_extents = {}  # {size: [offset]}
+        self._freed = collections.deque()  # [(epoch, offset, size)]
+        self._epoch = 0  # advanced when the file is emptied
+
+    ## Public interface
+
+    def spill(self, tiles, progress=None):
+        """Starts moving the pixel data of tiles to disk
+
+        :param iterable tiles: Tiles to spill.
+        :param progress: Unsized progress object to fill in.
+        :type progress: lib.feedback.Progress or None
+        :returns: The progress object, or None if there was nothing to do
+        :rtype: lib.feedback.Progress
+
+        Read-only tiles, and tiles which are spilled already or are
+        being spilled, are skipped. Tiles being spilled have a "_spilled"
+        attribute of None until they're written, and then one which
+        records where their data went.
+
+        """
+        if self._closed:
+            return None
+        jobs = []
+        for tile in tiles:
+            tile_dict = tile.__dict__
+            rgba = tile_dict.get("rgba")
+            if rgba is None or "_spilled" in tile_dict:
+                continue
+            if tile.readonly:
+                continue
+            tile._spilled = None
+            jobs.append((tile, rgba))
+        if not jobs:
+            return None
+        if progress is None:
+            progress = lib.feedback.Progress()
+        progress.items = len(jobs)
+        self._pending += len(jobs)
+        self._submit(self._write_tiles_job, jobs, progress)
+        return progress
+
+    def prefetch(self, tiles, progress=None):
+        """Starts reloading spilled tiles in the background
+
+        :param iterable tiles: Tiles to reload if they are spilled.
+        :param progress: Unsized progress object to fill in.
+        :type progress: lib.feedback.Progress or None
+        :returns: The progress object, or None if there was nothing to do
+        :rtype: lib.feedback.Progress
+
+        """
+        if self._closed:
+            return None
+        jobs = []
+        for tile in tiles:
+            record = tile.__dict__.get("_spilled")
+            if record is not None:
+                jobs.append((tile, record))
+        if not jobs:
+            return None
+        if progress is None:
+            progress = lib.feedback.Progress()
+        progress.items = len(jobs)
+        self._submit(self._read_tiles_job, jobs, progress)
+        return progress
+
+    def load(self, tiles):
+        """Reloads spilled tiles right away, in the calling thread
+
+        :param iterable tiles: Tiles to reload if they are spilled.
+
+        """
+        for tile in tiles:
+            record = tile.__dict__.get("_spilled")
+            if record is not None:
+                tile.__dict__.setdefault("rgba", record.load())
+                tile.__dict__.pop("_spilled", None)
+
+    def flush(self):
+        """Waits for all background work, and applies its results"""
+        if self._thread is not None:
+            self._jobs.join()
+        self._apply_results_cb()
+
+    def reset(self):
+        """Empties the spill file if nothing refers to its data"""
+        if self._closed or self._pending or len(self._records):
+            return
+        with self._file_lock:
+            self._file.seek(0)
+            self._file.truncate()
+            self._end = 0
+            self._free_extents.clear()
+            self._epoch += 1
+
+    def close(self):
+        """Stops the worker thread
+
+        The file itself stays open for as long as any spilled tile
+        still refers to it.
+
+        """
+        if self._closed:
+            return
+        self._closed = True
+        if self._thread is not None:
+            self._jobs.put(None)
+            self._thread = None
+        if not (self._pending or len(self._records)):
+            self._file.close()
+
+    ## Worker thread
+
+    def _submit(self, func, *args):
+        """Queues a job for the worker thread, starting it if needed"""
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target = self._worker,
+                name = "TileSpillWorker",
+            )
+            self._thread.daemon = True
+            self._thread.start()
+        self._jobs.put((func, args))
+
+    def _worker(self):
+        """Worker thread main loop"""
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                self._jobs.task_done()
+                return
+            try:
+                func, args = job
+                func(*args)
+            except Exception:
+                logger.exception("Tile spill job failed")
+            finally:
+                job = func = args = None  # don't keep tiles alive
+                self._jobs.task_done()
+
+    def _post_result(self, func, *args):
+        """Worker: hands a result callback back to the main thread"""
+        self._results.append((func, args))
+        GLib.idle_add(self._apply_results_cb)
+
+    def _write_tiles_job(self, jobs, progress):
+        """Worker: compresses and writes a list of tiles to the file"""
+        written = []
+        try:
+            for tile, rgba in jobs:
+                data = zlib.compress(rgba.tostring(), self.COMPRESSION_LEVEL)
+                with self._file_lock:
+                    offset = self._allocate(len(data))
+                    self._file.seek(offset)
+                    self._file.write(data)
+                written.append((tile, rgba, offset, len(data)))
+                if len(written) >= self.BATCH_SIZE:
+                    self._post_result(self._tiles_written, written, progress)
+                    written = []
+        except EnvironmentError:
+            logger.exception("Failed to spill tiles to %r", self.path)
+            done = set(id(w[0]) for w in written)
+            for tile, rgba in jobs:
+                if id(tile) not in done:
+                    written.append((tile, rgba, None, None))
+        with self._file_lock:
+            self._file.flush()
+        self._post_result(self._tiles_written, written, progress)
+
+    def _read_tiles_job(self, jobs, progress):
+        """Worker: loads and decompresses a list of spilled tiles"""
+        loaded = []
+        for tile, record in jobs:
+            loaded.append((tile, record, record.load()))
+            if len(loaded) >= self.BATCH_SIZE:
+                self._post_result(self._tiles_loaded, loaded, progress)
+                loaded = []
+        self._post_result(self._tiles_loaded, loaded, progress)
+
+    ## Space allocation
+
+    def _get_extent_size(self, length):
+        """Size of the space allocated for data of a given length"""
+        granularity = self.EXTENT_GRANULARITY
+        return -(-length // granularity) * granularity
+
+    def _allocate(self, length):
+        """Finds space for data, reusing freed space if possible
+
+        Freed space is reused only for data which rounds up to the
+        same size, so finding space takes constant time. Call this
+        with the file lock held.
+
+        """
+        while self._freed:
+            epoch, offset, size = self._freed.popleft()
+            if epoch == self._epoch:
+                self._free_extents.setdefault(size, []).append(offset)
+        size = self._get_extent_size(length)
+        offsets = self._free_extents.get(size)
+        if offsets:
+            return offsets.pop()
+        offset = self._end
+        self._end += size
+        return offset
+
+    def _free(self, epoch, offset, length):
+        """Returns the space used by some data (any thread)
+
+        This doesn't take the file lock, because it's called when
+        records are deleted, which can happen while it's held.
+
+        """
+        self._freed.append((epoch, offset, self._get_extent_size(length)))
+
+    ## Main thread result handling
+
+    def _apply_results_cb(self):
+        """Applies results posted by the worker thread"""
+        while self._results:
+            func, args = self._results.popleft()
+            func(*args)
+        return False
+
+    def _tiles_written(self, written, progress):
+        """Drops the in-memory pixels of tiles written to disk"""
+        epoch = self._epoch
+        for tile, rgba, offset, length in written:
+            self._pending -= 1
+            tile_dict = tile.__dict__
+            unused = (
+                tile_dict.get("_spilled", False) is not None
+                or offset is None
+                or tile_dict.get("rgba") is not rgba
+            )
+            if unused:
+                if offset is not None:
+                    self._free(epoch, offset, length)
+                if tile_dict.get("_spilled", False) is None:
+                    del tile._spilled
+                continue
+            record = _SpillRecord(self, epoch, offset, length, rgba)
+            self._records.add(record)
+            tile._spilled = record
+            del tile.rgba
+        progress += len(written)
+
+    def _tiles_loaded(self, loaded, progress):
+        """Restores the in-memory pixels of tiles loaded from disk"""
+        for tile, record, rgba in loaded:
+            # Tiles can also be loaded by any thread reading their
+            # pixels. Don't replace pixels which are already in place.
+            if tile.__dict__.get("_spilled") is record:
+                tile.__dict__.setdefault("rgba", rgba)
+                tile.__dict__.pop("_spilled", None)
+        progress += len(loaded)
+
+    def _read(self, offset, length):
+        """Reads compressed data from the file (any thread)"""
+        with self._file_lock:
+            self._file.seek(offset)
+            return self._file.read(length)
+
+
+class _SpillRecord (object):
+    """Where the pixels of a spilled tile are, and how to load them"""
+
+    __slots__ = ("store", "epoch", "offset", "length", "shape", "dtype",
+                 "__weakref__")
+
+    def __init__(self, store, epoch, offset, length, rgba):
+        self.store = store
+        self.epoch = epoch
+        self.offset = offset
+        self.length = length
+        self.shape = rgba.shape
+        self.dtype = rgba.dtype
+
+    def load(self):
+        """Returns a new array with the tile's pixels"""
+        data = zlib.decompress(self.store._read(self.offset, self.length))
+        rgba = np.frombuffer(data, dtype=self.dtype)
+        return rgba.reshape(self.shape).copy()
+
+    def __del__(self):
+        """Frees the space in the file when the record goes away"""
+        self.store._free(self.epoch, self.offset, self.length)
+
+
+## Module testing
+
+
+def _test():
+    """Run doctest strings"""
+    import doctest
+    doctest.testmod(optionflags=doctest.ELLIPSIS)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG)
+    _test()
@@ -0,0 +1,239 @@
+# This file is part of MyPaint.
+# Copyright (C) 2017 by the MyPaint Development Team.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+
+"""Threaded background processing, with futures for the results."""
+
+from __future__ import division, print_function
+
+import threading
+import multiprocessing
+import Queue
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+## Futures
+
+
+class Future (object):
+    """The eventual result of a job submitted to a `WorkerPool`
+
+    >>> pool = WorkerPool(2)
+    >>> f = pool.submit(sum, [1, 2, 3])
+    >>> f.result()
+    6
+    >>> f.done()
+    True
+
+    Exceptions raised by the job are re-raised when the result is
+    retrieved.
+
+    >>> pool.submit(int, "x").result()  # doctest: +ELLIPSIS
+    Traceback (most recent call last):
+    ...
+    ValueError: ...
+
+    Callbacks can be run when the job finishes, for example to tell
+    the main thread about it with GLib.idle_add().
+
+    >>> finished = []
+    >>> f.add_done_callback(finished.append)
+    >>> finished == [f]
+    True
+    >>> pool.shutdown()
+
+    """
+
+    def __init__(self):
+        super(Future, self).__init__()
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._result = None
+        self._exception = None
+
+    def done(self):
+        """True if the job has finished"""
+        return self._event.is_set()
+
+    def wait(self, timeout=None):
+        """Waits for the job to finish
+
+        :param float timeout: Maximum time to wait (seconds), or None.
+        :returns: True if the job has finished
+        :rtype: bool
+
+        """
+        self._event.wait(timeout)
+        return self._event.is_set()
+
+    def result(self, timeout=None):
+        """Waits for the job to finish, and returns its result
+
+        :param float timeout: Maximum time to wait (seconds), or None.
+        :raises RuntimeError: The job didn't finish within the timeout.
+
+        """
+        if not self.wait(timeout):
+            raise RuntimeError("Job did not finish in time")
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def add_done_callback(self, func):
+        """Arranges for a function to be called when the job finishes
+
+        :param callable func: Called with the future as its argument.
+
+        The function is called in the worker thread which ran the job,
+        or right away in the calling thread if the job has finished.
+        It must not touch GTK or the model, and should be quick.
+
+        """
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(func)
+                return
+        func(self)
+
+    def _set_result(self, result):
+        self._result = result
+        self._finish()
+
+    def _set_exception(self, exception):
+        self._exception = exception
+        self._finish()
+
+    def _finish(self):
+        with self._lock:
+            self._event.set()
+            callbacks = self._callbacks
+            self._callbacks = []
+        for func in callbacks:
+            try:
+                func(self)
+            except Exception:
+                logger.exception("Callback %r for a job failed", func)
+
+
+## Worker pools
+
+
+class WorkerPool (object):
+    """A pool of daemon threads which run submitted jobs in order
+
+    Jobs are run outside the main thread, so they must not touch GTK,
+    or any model objects which the main thread might be changing.
+    They're worth running in a pool when most of their time is spent
+    in code which releases the GIL, such as zlib or some mypaintlib
+    routines.
+
+    """
+
+    def __init__(self, nworkers=None, name="Worker"):
+        """Initialize, without starting any threads yet
+
+        :param int nworkers: Number of threads (default: CPU count).
+        :param str name: Prefix for naming the threads.
+
+        """
+        super(WorkerPool, self).__init__()
+        if nworkers is None:
+            try:
+                nworkers = multiprocessing.cpu_count()
+            except NotImplementedError:
+                nworkers = 2
+        self._nworkers = max(1, int(nworkers))
+        self._name = name
+        self._jobs = Queue.Queue()
+        self._threads = []
+
+    @property
+    def nworkers(self):
+        """The number of worker threads"""
+        return self._nworkers
+
+    def submit(self, func, *args, **kwargs):
+        """Queues a job, starting the worker threads if needed
+
+        :param callable func: The job to run in a worker thread.
+        :param *args: Passed to func.
+        :param **kwargs: Passed to func.
+        :returns: A future for the job's result.
+        :rtype: Future
+
+        """
+        if not self._threads:
+            self._start()
+        future = Future()
+        self._jobs.put((future, func, args, kwargs))
+        return future
+
+    def shutdown(self):
+        """Stops the worker threads once the queued jobs are done"""
+        for thread in self._threads:
+            self._jobs.put(None)
+        self._threads = []
+
+    def _start(self):
+        for i in xrange(self._nworkers):
+            thread = threading.Thread(
+                target = self._worker,
+                name = "%s-%d" % (self._name, i),
+            )
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _worker(self):
+        """Worker thread main loop"""
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                return
+            future, func, args, kwargs = job
+            job = None
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                logger.debug("Job %r failed", func, exc_info=True)
+                future._set_exception(e)
+            else:
+                future._set_result(result)
+            future = func = args = kwargs = result = None
+
+
+_POOL = None
+
+
+def get_pool():
+    """Gets the shared worker pool
+
+    :rtype: WorkerPool
+
+    """
+    global _POOL
+    if _POOL is None:
+        _POOL = WorkerPool(name="SharedWorker")
+    return _POOL
+
+
+## Module testing
+
+
+def _test():
+    """Run doctest strings"""
+    import doctest
+    doctest.testmod(optionflags=doctest.ELLIPSIS)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG)
+    _test()
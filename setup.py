@@ -462,6 +462,13 @@ def pkgconfig(packages, **kwopts):
     return kwopts
 
 
+def pkgconfig_exists(package):
+    """True if pkg-config knows about a package."""
+    with open(os.devnull, "w") as devnull:
+        cmd = ["pkg-config", "--exists", package]
+        return subprocess.call(cmd, stderr=devnull) == 0
+
+
 def get_ext_modules():
     """Return a list of binary Extensions for setup() to process."""
 
@@ -492,18 +499,28 @@ def get_ext_modules():
         extra_link_args.append('-Wl,-z,origin')
         extra_link_args.append('-Wl,-rpath,$ORIGIN')
 
+    packages = [
+        "pygobject-3.0",
+        "glib-2.0",
+        "libpng",
+        "libjpeg",
+        "lcms2",
+        "gtk+-3.0",
+        "libmypaint-2.0",
+    ]
+    libraries = []
+    # Older distributions (e.g. Ubuntu 14.04, CentOS 7) have no
+    # libjpeg.pc, but the library is in the default search path.
+    if not pkgconfig_exists("libjpeg"):
+        packages.remove("libjpeg")
+        libraries.append("jpeg")
+
     mypaintlib_opts = pkgconfig(
-        packages=[
-            "pygobject-3.0",
-            "glib-2.0",
-            "libpng",
-            "lcms2",
-            "gtk+-3.0",
-            "libmypaint-2.0",
-        ],
+        packages=packages,
         include_dirs=[
             numpy.get_include(),
         ],
+        libraries=libraries,
         extra_link_args=extra_link_args,
         extra_compile_args=extra_compile_args,
     )
@@ -524,6 +541,7 @@ def get_ext_modules():
             'lib/gdkpixbuf2numpy.cpp',
             'lib/pixops.cpp',
             'lib/fastpng.cpp',
+            'lib/fastjpeg.cpp',
             'lib/brushsettings.cpp',
         ],
         swig_opts=mypaintlib_swig_opts,
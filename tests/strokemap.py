@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+
+# Imports:
+
+from __future__ import division, print_function
+
+import unittest
+from cStringIO import StringIO
+
+import numpy as np
+
+import paths
+from lib.strokemap import StrokeShape
+from lib.strokemap import _Tile
+from lib.strokemap import N
+from lib.layer.data import StrokemappedPaintingLayer
+from lib.layer.data import _write_strokemap
+
+
+# Helpers:
+
+def _make_strokes(ntiles, tiles_per_stroke=1000):
+    """Make a list of stroke shapes covering ntiles tiles in total"""
+    array = np.zeros((N, N), 'uint8')
+    array[N//4:N//2, :] = 1
+    strokes = []
+    for i in xrange(0, ntiles, tiles_per_stroke):
+        shape = StrokeShape()
+        shape.brush_string = "brush%d" % (len(strokes) % 3,)
+        for j in xrange(i, min(ntiles, i + tiles_per_stroke)):
+            shape.strokemap[j % 1000, j // 1000] = _Tile.new_from_array(array)
+        strokes.append(shape)
+    return strokes
+
+
+class _CountingFile (object):
+    """File-like wrapper counting the calls and bytes passing through"""
+
+    def __init__(self, f):
+        super(_CountingFile, self).__init__()
+        self._f = f
+        self.calls = 0
+        self.nbytes = 0
+
+    def write(self, s):
+        self.calls += 1
+        self.nbytes += len(s)
+        self._f.write(s)
+
+    def writelines(self, seq):
+        for s in seq:
+            self.write(s)
+
+    def read(self, size):
+        s = self._f.read(size)
+        self.calls += 1
+        self.nbytes += len(s)
+        return s
+
+
+# Test cases:
+
+class Serialization (unittest.TestCase):
+    """Strokemap save and load must scale linearly with size"""
+
+    def test_many_tiles_per_stroke(self):
+        self._run_test(ntiles=10000, tiles_per_stroke=10000)
+
+    def test_few_tiles_per_stroke(self):
+        self._run_test(ntiles=10000, tiles_per_stroke=10)
+
+    def _run_test(self, ntiles, tiles_per_stroke):
+        strokes = _make_strokes(ntiles, tiles_per_stroke)
+        nstrokes = len(strokes)
+        sio = StringIO()
+        writer = _CountingFile(sio)
+        _write_strokemap(writer, strokes, 0, 0)
+        data = sio.getvalue()
+        # Every byte is written exactly once, in a bounded number of
+        # writes per stroke and per tile.
+        self.assertEqual(writer.nbytes, len(data))
+        self.assertLessEqual(writer.calls, 3*3 + 3*nstrokes + 2*ntiles + 1)
+
+        layer = StrokemappedPaintingLayer()
+        reader = _CountingFile(StringIO(data))
+        layer._load_strokemap_from_file(reader, 0, 0)
+        # Every byte is read exactly once, and not tile by tile.
+        self.assertEqual(reader.nbytes, len(data))
+        self.assertLessEqual(reader.calls, 3*3 + 3*nstrokes + 1)
+        loaded = sum(len(s.strokemap) for s in layer.strokes)
+        self.assertEqual(loaded, ntiles)
+
+
+if __name__ == '__main__':
+    unittest.main()
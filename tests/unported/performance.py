@@ -190,6 +190,16 @@ def save_png():
     yield stop_measurement
 
 
+@nogui_test
+def save_jpg():
+    from lib import document
+    d = document.Document()
+    d.load('bigimage.ora')
+    yield start_measurement
+    d.save('test_save.jpg')
+    yield stop_measurement
+
+
 @nogui_test
 def save_png_layer():
     from lib import document
@@ -200,6 +210,58 @@ def save_png_layer():
     yield stop_measurement
 
 
+def _save_png_layer_compressed(png_compression):
+    from lib import document
+    d = document.Document()
+    d.load('biglayer.png')
+    yield start_measurement
+    d.layer_stack.current.save_as_png(
+        'test_save.png',
+        png_compression=png_compression,
+    )
+    yield stop_measurement
+    print('size =', os.path.getsize('test_save.png'))
+
+
+@nogui_test
+def save_png_layer_fast():
+    return _save_png_layer_compressed("fast")
+
+
+@nogui_test
+def save_png_layer_balanced():
+    return _save_png_layer_compressed("balanced")
+
+
+@nogui_test
+def save_png_layer_small():
+    return _save_png_layer_compressed("small")
+
+
+@nogui_test
+def strokemap_save_load():
+    from cStringIO import StringIO
+    from lib import strokemap
+    from lib.layer.data import StrokemappedPaintingLayer
+    from lib.layer.data import _write_strokemap
+    array = np.zeros((strokemap.N, strokemap.N), 'uint8')
+    array[strokemap.N // 4:strokemap.N // 2, :] = 1
+    strokes = []
+    for i in range(0, 100000, 10):
+        shape = strokemap.StrokeShape()
+        shape.brush_string = "brush%d" % (len(strokes) % 3,)
+        for j in range(i, i + 10):
+            tile = strokemap._Tile.new_from_array(array)
+            shape.strokemap[j % 1000, j // 1000] = tile
+        strokes.append(shape)
+    yield start_measurement
+    sio = StringIO()
+    _write_strokemap(sio, strokes, 0, 0)
+    layer = StrokemappedPaintingLayer()
+    layer._load_strokemap_from_file(StringIO(sio.getvalue()), 0, 0)
+    yield stop_measurement
+
+
 @nogui_test
 def brushengine_paint_hires():
     from lib import tiledsurface, brush